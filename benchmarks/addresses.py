@@ -0,0 +1,65 @@
+""" Address index rebuild and balance lookups.
+
+    Fills a database with synthetic blocks, rebuilds the address index
+    with one process and with one per CPU, then compares the balance of
+    a key read from the index with a scan of transaction_output. The
+    outputs are spread over NUM_OWNERS keys.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.addresses
+"""
+import multiprocessing
+import time
+
+from indiecoin.blockchain import addressindex, database
+
+from . import common
+
+NUM_BLOCKS = 20000
+TRANSACTIONS_PER_BLOCK = 5
+NUM_OWNERS = 1000
+REPEAT = 200
+FILE_NAME = 'benchmark_addresses'
+
+
+class Database(database.Database):
+    """ Exposes the scan the address index replaces.
+    """
+    def balance(self, public_key):
+        return self.__query(
+            'SELECT SUM(amount) as balance FROM transaction_output '
+            'WHERE public_key_owner = ? AND unspent = 1', (database.to_blob(public_key),))[0]['balance']
+
+
+def main():
+    path = common.database_path(FILE_NAME)
+    config = database.StorageConfig(address_index=True)
+    db = Database(file_name=path, config=config)
+    common.fill_chain(path, NUM_BLOCKS, TRANSACTIONS_PER_BLOCK)
+
+    with database.get_connection_manager(path).transaction() as connection:
+        connection.execute(
+            'UPDATE transaction_output SET public_key_owner = '
+            'CAST(public_key_owner || printf("%04d", id % ?) AS BLOB)', (NUM_OWNERS,))
+
+    public_key = common.PUBLIC_KEY_GENESIS + '0007'.encode('hex')
+    addresses = addressindex.Database(file_name=path)
+
+    print('outputs: {}'.format(NUM_BLOCKS * TRANSACTIONS_PER_BLOCK))
+
+    for processes in [1, multiprocessing.cpu_count()]:
+        start = time.time()
+        addresses.rebuild(processes=processes)
+        print('rebuild, {} processes: {:>10.1f} ms'.format(processes, (time.time() - start) * 1e3))
+
+    print('balance, scan:  {:>10.1f} us'.format(
+        common.timed(lambda i: db.balance(public_key), REPEAT)))
+    print('balance, index: {:>10.1f} us'.format(
+        common.timed(lambda i: addresses.get_balance(public_key), REPEAT)))
+
+    common.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+""" Repeated block and transaction lookups with and without the caches.
+
+    Fills a database with synthetic blocks, then looks up blocks by
+    height and transactions by hash drawn from a small hot set, the way
+    syncing peers ask for recent blocks and inputs reference popular
+    transactions. Runs once with the caches disabled and once with the
+    default budgets.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.cache
+"""
+import random
+
+from indiecoin.blockchain import BlockChain, block, database
+
+from . import common
+
+NUM_BLOCKS = 10000
+TRANSACTIONS_PER_BLOCK = 10
+HOT_BLOCKS = 500
+REPEAT = 5000
+FILE_NAME = 'benchmark_cache'
+
+
+def run(config):
+    """ Returns the mean latency of both lookups and the cache counters.
+    """
+    path = common.database_path(FILE_NAME)
+    database.Database(file_name=path, config=config)
+    common.fill_chain(path, NUM_BLOCKS, TRANSACTIONS_PER_BLOCK)
+    blockchain = BlockChain(database=block.Database(file_name=path))
+
+    heights = [random.randint(NUM_BLOCKS - HOT_BLOCKS, NUM_BLOCKS) for i in range(REPEAT)]
+    indexes = [random.randint(0, TRANSACTIONS_PER_BLOCK - 1) for i in range(REPEAT)]
+
+    results = [
+        common.timed(lambda i: blockchain.get_block_height(heights[i]), REPEAT),
+        common.timed(lambda i: blockchain.get_transaction(common.transaction_hash(heights[i], indexes[i])), REPEAT),
+    ]
+    stats = blockchain.cache_stats()
+
+    common.remove(path)
+    return results, stats
+
+
+def main():
+    print('{:>10} {:>12} {:>12} {:>16} {:>16}'.format(
+        'caches', 'block (us)', 'tx (us)', 'block hits', 'tx hits'))
+
+    configs = [
+        ('off', database.StorageConfig(block_cache_entries=0, transaction_cache_entries=0)),
+        ('on', database.StorageConfig()),
+    ]
+
+    for name, config in configs:
+        results, stats = run(config)
+        print('{:>10} {:>12.1f} {:>12.1f} {:>16} {:>16}'.format(
+            name, results[0], results[1], stats['blocks']['hits'], stats['transactions']['hits']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import time
+
+from indiecoin.blockchain import database
+from indiecoin.blockchain.headers import pack_header
+from indiecoin.util.hash import merkle_root, sha256
+
+GENESIS_BLOCK_HASH = '1465242b9a4e246136f1d76344d625efff9acb6b33525eed1c1373b9225a21c2'
+PUBLIC_KEY_GENESIS = (
+    '005ec5005a6e1dc0fad36333b839f5351190090cd3ed57879a0b664f1504fe04f108e586112033129ddb2865'
+    '3f0289f417c354cb358df7adb9ca4a8007777daedd5d01e0b49e11e51dce33063c0241f03ed0afa5f1e11a57'
+    '7b96e580fec6c1cc9f047c22b9881da9bbf9818f00a69005607d72b75d42f954621df4591f56a246fdda3837')
+TIMESTAMP = 1490477410
+
+_block_hashes = {1: GENESIS_BLOCK_HASH}
+
+
+def block_hash(height):
+    """ Hash of the synthetic block at height written by the last call
+        to fill_chain().
+    """
+    return _block_hashes[height]
+
+
+def transaction_hash(height, index):
+    """ Deterministic hash of the synthetic transaction index of block height.
+    """
+    return sha256('transaction-{}-{}'.format(height, index))
+
+
+def database_path(file_name):
+    """ Returns the path of a benchmark database inside a fresh temporary
+        directory. Database objects are given it as their file_name, the
+        path being absolute it is used as it is.
+    """
+    return os.path.join(tempfile.mkdtemp(prefix='indiecoin-bench-'), file_name)
+
+
+def fill_chain(path, num_blocks, transactions_per_block=1):
+    """ Writes a synthetic chain of coinbase only blocks straight into
+        the sqlite file at path, on top of the genesis block.
+
+        Rows are written in one transaction through the connection
+        manager so the file can be filled with many blocks quickly.
+        Hashes and keys are stored as bytes, see database.to_blob().
+
+        Each block hash is the sha256 of its header, with a merkle root
+        over its transactions, so the chain is checked as a real one by
+        snapshot imports.
+    """
+    manager = database.get_connection_manager(path)
+
+    with manager.writing() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT MAX(id) FROM ic_transaction')
+        transaction_id = cursor.fetchone()[0]
+
+        for height in range(2, num_blocks + 1):
+            hash_merkle_root = merkle_root([transaction_hash(height, index) for index in range(transactions_per_block)])
+            _block_hashes[height] = sha256(pack_header(
+                block_hash(height - 1), hash_merkle_root, TIMESTAMP + height, 0, 0))
+
+            cursor.execute(
+                'INSERT INTO block (hash, previous_block_hash, hash_merkle_root, num_transactions, nonce, '
+                'difficulty, timestamp, is_orphan, height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (database.to_blob(block_hash(height)), database.to_blob(block_hash(height - 1)),
+                 database.to_blob(hash_merkle_root), transactions_per_block, 0, 0, TIMESTAMP + height, 0, height))
+            block_id = cursor.lastrowid
+
+            for index in range(transactions_per_block):
+                transaction_id += 1
+                cursor.execute(
+                    'INSERT INTO ic_transaction (id, hash, num_inputs, num_outputs, timestamp, '
+                    'is_coinbase, is_orphan, block_id, block_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (transaction_id, database.to_blob(transaction_hash(height, index)), 0, 1, TIMESTAMP + height,
+                     1, 0, block_id, database.to_blob(block_hash(height))))
+                cursor.execute(
+                    'INSERT INTO transaction_output (id_transaction, public_key_owner, unspent, amount) '
+                    'VALUES (?, ?, ?, ?)',
+                    (transaction_id, database.to_blob(PUBLIC_KEY_GENESIS), 1, 5))
+        connection.commit()
+
+
+def timed(function, repeat):
+    """ Calls function repeat times and returns the mean latency in microseconds.
+    """
+    start = time.time()
+
+    for i in range(repeat):
+        function(i)
+
+    return (time.time() - start) * 1e6 / repeat
+
+
+def remove(path):
+    """ Closes the connections to a benchmark database and removes the
+        temporary directory holding it.
+    """
+    database.get_connection_manager(path).close()
+    shutil.rmtree(os.path.dirname(path))
@@ -0,0 +1,61 @@
+""" Tip height and block hash lookups, sqlite versus the header index.
+
+    Fills databases of increasing size with synthetic blocks, then
+    measures the queries the node used to run for MAX_BLOCK_HEIGHT and
+    for the hash of a block at some height against the in memory header
+    index of block.Database. The time to load the index is also shown.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.headers
+"""
+import random
+import time
+
+from indiecoin.blockchain import block, database
+
+from . import common
+
+SIZES = [1000, 10000, 50000]
+REPEAT = 2000
+FILE_NAME = 'benchmark_headers'
+
+
+class Database(database.Database):
+    """ Exposes the raw queries answered by the header index.
+    """
+    def height(self):
+        return self.__query('SELECT MAX(height) as height from block where is_orphan = 0')[0]['height']
+
+    def block_hash(self, height):
+        return self.__query('SELECT hash FROM block WHERE height = ?', (height,))[0]['hash']
+
+
+def main():
+    print('{:>8} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+        'blocks', 'load (ms)', 'sql tip (us)', 'tip (us)', 'sql hash (us)', 'hash (us)'))
+
+    for size in SIZES:
+        path = common.database_path(FILE_NAME)
+        db = Database(file_name=path)
+        common.fill_chain(path, size)
+
+        start = time.time()
+        blocks = block.Database(file_name=path)
+        load = (time.time() - start) * 1e3
+
+        heights = [random.randint(1, size) for i in range(REPEAT)]
+
+        results = [
+            common.timed(lambda i: db.height(), REPEAT),
+            common.timed(lambda i: blocks.get_height(), REPEAT),
+            common.timed(lambda i: db.block_hash(heights[i]), REPEAT),
+            common.timed(lambda i: blocks.get_block_hash(heights[i]), REPEAT),
+        ]
+
+        print('{:>8} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}'.format(size, load, *results))
+        common.remove(path)
+
+
+if __name__ == '__main__':
+    main()
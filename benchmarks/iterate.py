@@ -0,0 +1,57 @@
+""" Walking the whole chain block by block.
+
+    Fills a database with synthetic blocks, then reads every block with
+    its transactions the way indexers do, once calling get_block_height()
+    for each height and once through iter_blocks(), which reads batches
+    of heights and prefetches the next one. The caches are disabled so
+    both walks read every block from sqlite.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.iterate
+"""
+import time
+
+from indiecoin.blockchain import BlockChain, block, database
+
+from . import common
+
+NUM_BLOCKS = 20000
+TRANSACTIONS_PER_BLOCK = 5
+BATCH_SIZES = [10, 100, 1000]
+FILE_NAME = 'benchmark_iterate'
+
+
+def walk(blocks):
+    """ Reads every transaction of blocks, returns the blocks per second.
+    """
+    start = time.time()
+    transactions = 0
+
+    for current in blocks:
+        transactions += len(current.transactions)
+
+    assert transactions == (NUM_BLOCKS - 1) * TRANSACTIONS_PER_BLOCK + 1
+    return NUM_BLOCKS / (time.time() - start)
+
+
+def main():
+    path = common.database_path(FILE_NAME)
+    config = database.StorageConfig(block_cache_entries=0, transaction_cache_entries=0)
+    database.Database(file_name=path, config=config)
+    common.fill_chain(path, NUM_BLOCKS, TRANSACTIONS_PER_BLOCK)
+    blockchain = BlockChain(database=block.Database(file_name=path))
+
+    print('{:>24} {:>12}'.format('walk', 'blocks/s'))
+    print('{:>24} {:>12.0f}'.format('get_block_height', walk(
+        blockchain.get_block_height(height) for height in range(1, NUM_BLOCKS + 1))))
+
+    for batch_size in BATCH_SIZES:
+        print('{:>24} {:>12.0f}'.format('iter_blocks {}'.format(batch_size), walk(
+            blockchain.iter_blocks(batch_size=batch_size))))
+
+    common.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+""" Lookup latency as the chain grows.
+
+    Fills databases of increasing size with synthetic blocks and measures
+    the mean latency of the block and transaction lookups used during
+    validation. With the indexes declared in genesis/database.json the
+    latency should stay flat as the number of blocks grows.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.lookup
+"""
+import random
+
+from indiecoin.blockchain import database
+
+from . import common
+
+SIZES = [1000, 10000, 50000]
+REPEAT = 2000
+FILE_NAME = 'benchmark_lookup'
+
+
+class Database(database.Database):
+    """ Exposes the raw lookup helpers, the same way block.Database and
+        transaction.Database reach them.
+    """
+    def block(self, block_hash):
+        return self.__get_block(block_hash)
+
+    def block_height(self, height):
+        return self.__get_block_height(height)
+
+    def transaction(self, transaction_hash):
+        return self.__get_transaction(transaction_hash)
+
+    def transactions_block(self, block_hash):
+        return self.__get_transactions_block(block_hash)
+
+
+def main():
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'blocks', 'hash (us)', 'height (us)', 'tx (us)', 'block tx (us)'))
+
+    for size in SIZES:
+        path = common.database_path(FILE_NAME)
+        db = Database(file_name=path)
+        common.fill_chain(path, size)
+
+        heights = [random.randint(1, size) for i in range(REPEAT)]
+
+        results = [
+            common.timed(lambda i: db.block(common.block_hash(heights[i])), REPEAT),
+            common.timed(lambda i: db.block_height(heights[i]), REPEAT),
+            common.timed(lambda i: db.transaction(common.transaction_hash(max(heights[i], 2), 0)), REPEAT),
+            common.timed(lambda i: db.transactions_block(common.block_hash(heights[i])), REPEAT),
+        ]
+
+        print('{:>8} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}'.format(size, *results))
+        common.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+""" Hashrate of the miner against the size of the block.
+
+    Compares hashing the whole encoding of the block for each nonce, as
+    the block hash used to be defined, with hashing its 80 bytes header,
+    as Miner.main_loop() does now, packing the part before the nonce once.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.mining
+"""
+import time
+
+from indiecoin.blockchain import storage
+from indiecoin.blockchain.headers import NONCE
+from indiecoin.util.hash import sha256
+
+from .serialization import build_block
+
+TRANSACTIONS = [1, 10, 100, 1000]
+NONCES = 2000
+
+
+def whole_block(new_block):
+    for nonce in xrange(NONCES):
+        new_block.set_nonce(nonce)
+        int(sha256(new_block.to_bytes()), 16)
+
+
+def header_only(new_block):
+    header = new_block.header_bytes()[:-NONCE.size]
+
+    for nonce in xrange(NONCES):
+        int(sha256(header + NONCE.pack(nonce)), 16)
+
+
+def hashrate(function, new_block):
+    """ Returns the nonces per second tried by function.
+    """
+    start = time.time()
+    function(new_block)
+    return NONCES / (time.time() - start)
+
+
+def main():
+    memory = storage.MemoryStorage()
+
+    print('{:>6} {:>14} {:>14}'.format('txs', 'block hash/s', 'header hash/s'))
+
+    for num_transactions in TRANSACTIONS:
+        new_block = build_block(num_transactions, memory)
+
+        print('{:>6} {:>14.0f} {:>14.0f}'.format(
+            num_transactions, hashrate(whole_block, new_block), hashrate(header_only, new_block)))
+
+
+if __name__ == '__main__':
+    main()
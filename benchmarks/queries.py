@@ -0,0 +1,49 @@
+""" Block and transaction lookup on a 100k transaction database.
+
+    Fills a database with 10,000 synthetic blocks of 10 coinbase
+    transactions each and measures the mean latency of loading a
+    transaction by hash and the transactions of a block by block hash.
+    The transaction cache is disabled, see benchmarks.cache. The
+    statements that took the most time are printed at the end.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.queries
+"""
+import random
+
+from indiecoin.blockchain import database, querystats, transaction
+
+from . import common
+
+NUM_BLOCKS = 10000
+TRANSACTIONS_PER_BLOCK = 10
+REPEAT = 5000
+FILE_NAME = 'benchmark_queries'
+
+
+def main():
+    path = common.database_path(FILE_NAME)
+    db = transaction.Database(file_name=path, config=database.StorageConfig(transaction_cache_entries=0))
+    common.fill_chain(path, NUM_BLOCKS, TRANSACTIONS_PER_BLOCK)
+
+    database.get_connection_manager(path).query_stats.reset()
+    heights = [random.randint(2, NUM_BLOCKS) for i in range(REPEAT)]
+    indexes = [random.randint(0, TRANSACTIONS_PER_BLOCK - 1) for i in range(REPEAT)]
+
+    get_transaction = common.timed(
+        lambda i: db.get_transaction(common.transaction_hash(heights[i], indexes[i])), REPEAT)
+    get_block_transactions = common.timed(
+        lambda i: db.get_block_transactions(common.block_hash(heights[i])), REPEAT // 10)
+
+    print('transactions: {}'.format(NUM_BLOCKS * TRANSACTIONS_PER_BLOCK))
+    print('get_transaction:        {:>10.1f} us'.format(get_transaction))
+    print('get_block_transactions: {:>10.1f} us'.format(get_block_transactions))
+    print('')
+    print(querystats.format_stats(db.query_stats(), limit=5))
+
+    common.remove(path)
+
+
+if __name__ == '__main__':
+    main()
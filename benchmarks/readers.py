@@ -0,0 +1,69 @@
+""" Concurrent readers on the read connection pool.
+
+    Fills a database with synthetic blocks, then runs the same number of
+    transaction lookups split over a growing number of threads, each
+    serving a batch of lookups and giving its connection back like a
+    node handler does. The transaction cache is disabled so every lookup
+    reaches sqlite, which runs without the GIL, so throughput grows with
+    the number of threads up to the number of cores.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.readers
+"""
+import random
+import threading
+import time
+
+from indiecoin.blockchain import database, transaction
+
+from . import common
+
+NUM_BLOCKS = 10000
+TRANSACTIONS_PER_BLOCK = 10
+LOOKUPS = 20000
+LOOKUPS_PER_THREAD = 100
+THREADS = [1, 2, 4, 8, 16]
+FILE_NAME = 'benchmark_readers'
+
+
+def run(db, manager, num_threads):
+    """ Returns the lookups per second with num_threads reading at once.
+    """
+    lookups = LOOKUPS // num_threads // LOOKUPS_PER_THREAD * num_threads * LOOKUPS_PER_THREAD
+    batches = [lookups // num_threads // LOOKUPS_PER_THREAD] * num_threads
+
+    def read(batch):
+        for b in range(batch):
+            for i in range(LOOKUPS_PER_THREAD):
+                height = random.randint(2, NUM_BLOCKS)
+                db.get_transaction(common.transaction_hash(height, random.randint(0, TRANSACTIONS_PER_BLOCK - 1)))
+
+            manager.release()
+
+    threads = [threading.Thread(target=read, args=(batch,)) for batch in batches]
+    start = time.time()
+
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+
+    return lookups / (time.time() - start)
+
+
+def main():
+    path = common.database_path(FILE_NAME)
+    db = transaction.Database(file_name=path, config=database.StorageConfig(transaction_cache_entries=0))
+    common.fill_chain(path, NUM_BLOCKS, TRANSACTIONS_PER_BLOCK)
+    manager = database.get_connection_manager(path)
+
+    print('{:>10} {:>14} {:>10}'.format('threads', 'lookups/s', 'opened'))
+
+    for num_threads in THREADS:
+        throughput = run(db, manager, num_threads)
+        print('{:>10} {:>14.0f} {:>10}'.format(num_threads, throughput, manager.pool_stats()['opened']))
+
+    common.remove(path)
+
+
+if __name__ == '__main__':
+    main()
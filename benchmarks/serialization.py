@@ -0,0 +1,126 @@
+""" Encoding, decoding and hashing blocks.
+
+    Builds a block of signed transactions in memory and compares the
+    canonical binary encoding, to_bytes() and the readers behind
+    from_bytes(), with the dictionary and JSON path, serialize(),
+    to_json() and json.loads(). Hashing compares sha256 over the header
+    with the first definition, sha256 of str() of serialize().
+
+    Encodings and hashes are memoized, so each of them is timed on fresh
+    copies of the block, the last column times to_json() once memoized,
+    as when a block is relayed to many peers.
+
+    Nothing is validated, decoding only parses, so no storage is read.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.serialization
+"""
+import json
+import time
+
+from indiecoin.blockchain import block, storage, transaction
+from indiecoin.blockchain.headers import HEADER, unpack_header
+from indiecoin.util.hash import sha256
+from indiecoin.util.serialization import BinaryReader
+from indiecoin.wallet.address import Address
+
+TRANSACTIONS = [1, 10, 100]
+REPEAT = 200
+
+
+def build_block(num_transactions, memory):
+    """ Returns a block of num_transactions transactions with one input
+        and two outputs each, built without validation.
+    """
+    address = Address()
+    transactions = []
+
+    for index in range(num_transactions):
+        spent = sha256(str(index))
+        transactions.append(transaction.Transaction.from_storage(
+            hash='', block_hash='', num_inputs=1, num_outputs=2, timestamp=1490477410 + index,
+            is_coinbase=0, is_orphan=0, database=memory,
+            tx_inputs=[transaction.TransactionInput(
+                signature=address.sign(spent), hash_transaction=spent, prev_out_index=0, database=memory)],
+            tx_outputs=[
+                transaction.TransactionOutput(amount=25, public_key_owner=address.public_key, unspent=1),
+                transaction.TransactionOutput(amount=25, public_key_owner=address.public_key, unspent=1)]))
+        transactions[-1].hash = transactions[-1].valid_hash()
+
+    return block.Block.from_storage(
+        hash='', timestamp=1490477410, nonce=0, num_transactions=num_transactions, is_orphan=0,
+        previous_block_hash=sha256('previous'), height=2, transactions=transactions, database=memory)
+
+
+def copy_block(new_block, memory):
+    """ Returns a copy of a block with nothing memoized.
+    """
+    data = new_block.serialize()
+
+    for tx in data['transactions']:
+        tx['database'] = memory
+
+        for tx_in in tx['tx_inputs']:
+            tx_in['database'] = memory
+
+    return block.Block.from_storage(database=memory, **data)
+
+
+def fresh_copies(new_block, memory):
+    """ Returns REPEAT copies of a block with nothing memoized, one per
+        timed call.
+    """
+    return [copy_block(new_block, memory) for i in range(REPEAT)]
+
+
+def decode(data):
+    """ Parses the bytes of a block, as Block.from_bytes() does before
+        validating it.
+    """
+    reader = BinaryReader(data)
+    unpack_header(reader.read(HEADER.size))
+    reader.unpack(block.HEIGHT)
+    transactions = [transaction.read_transaction(reader) for i in range(reader.unpack(transaction.COUNT)[0])]
+    reader.close()
+    return transactions
+
+
+def timed(function, blocks):
+    """ Returns the mean latency in microseconds of function called on
+        each of blocks.
+    """
+    start = time.time()
+
+    for new_block in blocks:
+        function(new_block)
+
+    return (time.time() - start) * 1e6 / len(blocks)
+
+
+def main():
+    memory = storage.MemoryStorage()
+
+    print('{:>6} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'txs', 'bytes', 'json', 'to_bytes', 'to_json', 'decode', 'loads', 'hash', 'str hash', 'memoized'))
+
+    for num_transactions in TRANSACTIONS:
+        new_block = build_block(num_transactions, memory)
+        data = new_block.to_bytes()
+        text = new_block.to_json()
+
+        print('{:>6} {:>10} {:>10} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            num_transactions, len(data), len(text),
+            timed(lambda b: b.to_bytes(), fresh_copies(new_block, memory)),
+            timed(lambda b: b.to_json(), fresh_copies(new_block, memory)),
+            timed(lambda b: decode(data), [new_block] * REPEAT),
+            timed(lambda b: json.loads(text), [new_block] * REPEAT),
+            timed(lambda b: b.valid_hash(), fresh_copies(new_block, memory)),
+            timed(lambda b: sha256(str(b.serialize())), fresh_copies(new_block, memory)),
+            timed(lambda b: b.to_json(), [new_block] * REPEAT)))
+
+    print('latencies in us')
+
+
+if __name__ == '__main__':
+    main()
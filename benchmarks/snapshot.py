@@ -0,0 +1,62 @@
+""" Snapshot export and import.
+
+    Fills a database with synthetic blocks, exports a snapshot of its
+    headers and unspent outputs to a file, then imports it into a new
+    database, the way a fresh node would start.
+
+    Run from the repository root:
+
+        $ python -m benchmarks.snapshot
+"""
+import os
+import time
+
+from indiecoin.blockchain import database, snapshot
+
+from . import common
+
+NUM_BLOCKS = 20000
+TRANSACTIONS_PER_BLOCK = 5
+FILE_NAME = 'benchmark_snapshot'
+IMPORT_FILE_NAME = 'benchmark_snapshot_import'
+
+
+def main():
+    path = common.database_path(FILE_NAME)
+    import_path = common.database_path(IMPORT_FILE_NAME)
+    snapshot_path = os.path.join(os.path.dirname(path), 'benchmark.snapshot')
+
+    database.Database(file_name=path)
+    common.fill_chain(path, NUM_BLOCKS, TRANSACTIONS_PER_BLOCK)
+
+    # fill_chain does not touch the unspent output set, it is rebuilt
+    # from the outputs when the database is opened with an empty one.
+    with database.get_connection_manager(path).transaction() as connection:
+        connection.execute('DELETE FROM unspent_output')
+
+    database.get_connection_manager(path).close()
+    database._managers.clear()
+    database.Database(file_name=path)
+
+    start = time.time()
+
+    with open(snapshot_path, 'wb') as stream:
+        snapshot.Database(file_name=path).export_snapshot(stream)
+
+    print('outputs: {}'.format(NUM_BLOCKS * TRANSACTIONS_PER_BLOCK))
+    print('export: {:>10.1f} ms'.format((time.time() - start) * 1e3))
+    print('size:   {:>10.1f} MB'.format(os.path.getsize(snapshot_path) / 1024.0 / 1024))
+
+    start = time.time()
+
+    with open(snapshot_path, 'rb') as stream:
+        snapshot.Database(file_name=import_path).import_snapshot(stream)
+
+    print('import: {:>10.1f} ms'.format((time.time() - start) * 1e3))
+
+    common.remove(path)
+    common.remove(import_path)
+
+
+if __name__ == '__main__':
+    main()
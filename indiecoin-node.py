@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 import argparse
+import logging
 
 from indiecoin.node.ic_node import IndieCoinNode
 from indiecoin.miner import Miner
+from indiecoin.blockchain import addressindex
+from indiecoin.blockchain import database
+from indiecoin.blockchain import prune
+from indiecoin.blockchain import querystats
+from indiecoin.blockchain import snapshot
+from indiecoin.blockchain import storage
 
 
 def main():
@@ -42,7 +49,160 @@ def main():
         type=int,
         help="port to connect on (default: 6666)")
 
+    storage_group = parser.add_argument_group(title="Storage")
+
+    storage_group.add_argument(
+        '--storage',
+        default=storage.BACKEND_SQLITE,
+        choices=sorted(storage.BACKENDS),
+        help="storage backend, memory keeps the chain only while running (default: sqlite)")
+
+    storage_group.add_argument(
+        '--journal-mode',
+        default='WAL',
+        choices=['WAL', 'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'OFF'],
+        help="sqlite journal mode (default: WAL)")
+
+    storage_group.add_argument(
+        '--synchronous',
+        default='NORMAL',
+        choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'],
+        help="sqlite synchronous setting (default: NORMAL)")
+
+    storage_group.add_argument(
+        '--cache-size',
+        default=-16000,
+        type=int,
+        help="sqlite page cache per connection, negative values in KiB (default: -16000)")
+
+    storage_group.add_argument(
+        '--mmap-size',
+        default=64 * 1024 * 1024,
+        type=int,
+        help="bytes of the database to memory map (default: 67108864)")
+
+    storage_group.add_argument(
+        '--temp-store',
+        default='MEMORY',
+        choices=['DEFAULT', 'FILE', 'MEMORY'],
+        help="where sqlite keeps temporary tables (default: MEMORY)")
+
+    storage_group.add_argument(
+        '--read-only',
+        default=False,
+        action='store_true',
+        help="open the database without writing to it, to serve or export the chain of a file "
+             "another process writes to")
+
+    storage_group.add_argument(
+        '--block-files',
+        default=False,
+        action='store_true',
+        help="also keep saved blocks serialized in blk*.dat files to serve them without rebuilding")
+
+    storage_group.add_argument(
+        '--block-cache-bytes',
+        default=64 * 1024 * 1024,
+        type=int,
+        help="memory budget of the cache of recently used blocks (default: 67108864)")
+
+    storage_group.add_argument(
+        '--transaction-cache-bytes',
+        default=32 * 1024 * 1024,
+        type=int,
+        help="memory budget of the cache of recently used transactions (default: 33554432)")
+
+    storage_group.add_argument(
+        '--address-index',
+        default=False,
+        action='store_true',
+        help="index outputs by owner to answer balance and history queries")
+
+    storage_group.add_argument(
+        '--rebuild-address-index',
+        default=False,
+        action='store_true',
+        help="rebuild the address index using every CPU and exit")
+
+    storage_group.add_argument(
+        '--prune',
+        default=None,
+        type=prune.parse_target,
+        metavar="BLOCKS|MB",
+        help="delete the bodies of old blocks, keeping that many blocks below the tip (e.g. 1000) "
+             "or keeping the database under a size (e.g. 550MB)")
+
+    storage_group.add_argument(
+        '--export-snapshot',
+        default=None,
+        metavar="PATH",
+        help="write the headers and unspent outputs of the chain to a snapshot file and exit")
+
+    storage_group.add_argument(
+        '--import-snapshot',
+        default=None,
+        metavar="PATH",
+        help="start a new database from a snapshot file and exit")
+
+    storage_group.add_argument(
+        '--migrate-storage',
+        default=False,
+        action='store_true',
+        help="convert the database to the current schema, compact it and exit")
+
+    storage_group.add_argument(
+        '--slow-query-ms',
+        default=None,
+        type=float,
+        metavar="MS",
+        help="log the storage queries slower than MS milliseconds with their query plan")
+
+    storage_group.add_argument(
+        '--query-stats',
+        default=None,
+        type=float,
+        metavar="SECONDS",
+        help="print the count, time, rows and p50/p99 latency of every storage query every SECONDS seconds, "
+             "or once done with a command that exits")
+
     args = parser.parse_args()
+    logging.basicConfig(format='%(message)s')
+    prune_blocks, prune_bytes = args.prune or (None, None)
+
+    if args.prune and args.storage != storage.BACKEND_SQLITE:
+        parser.error('--prune needs the sqlite storage')
+
+    if args.read_only and args.storage != storage.BACKEND_SQLITE:
+        parser.error('--read-only needs the sqlite storage')
+
+    if args.read_only and (args.mine or args.prune or args.import_snapshot or args.migrate_storage or
+                           args.rebuild_address_index):
+        parser.error('--read-only can not be used to mine, prune, import a snapshot, migrate or rebuild')
+
+    if (args.slow_query_ms is not None or args.query_stats is not None) and args.storage != storage.BACKEND_SQLITE:
+        parser.error('--slow-query-ms and --query-stats need the sqlite storage')
+
+    storage.configure(args.storage)
+
+    database.configure(database.StorageConfig(
+        journal_mode=args.journal_mode,
+        synchronous=args.synchronous,
+        cache_size=args.cache_size,
+        mmap_size=args.mmap_size,
+        temp_store=args.temp_store,
+        read_only=args.read_only,
+        block_files=args.block_files,
+        block_cache_bytes=args.block_cache_bytes,
+        transaction_cache_bytes=args.transaction_cache_bytes,
+        address_index=args.address_index,
+        prune_blocks=prune_blocks,
+        prune_bytes=prune_bytes,
+        slow_query_ms=args.slow_query_ms))
+
+    if run_command(args):
+        if args.query_stats is not None:
+            print_query_stats()
+        return
 
     miner = None
 
@@ -57,7 +217,51 @@ def main():
             node.addpeer(peer, host, port)
 
     node.start()
-    node.bootstrap()
+
+    if args.query_stats is not None:
+        node.startstabilizer(print_query_stats, args.query_stats)
+
+    if not args.read_only:
+        node.bootstrap()
+
+
+def run_command(args):
+    """ Runs the storage command given in args, if any.
+
+        Returns
+        -------
+            ran: boolean
+                True if a command ran and the program should exit.
+    """
+    if args.migrate_storage:
+        size, migrated_size = database.migrate()
+        print('Database migrated, {} bytes before, {} bytes after'.format(size, migrated_size))
+        return True
+
+    if args.export_snapshot:
+        with open(args.export_snapshot, 'wb') as stream:
+            height = snapshot.Database().export_snapshot(stream)
+        print('Snapshot of height {} written to {}'.format(height, args.export_snapshot))
+        return True
+
+    if args.import_snapshot:
+        with open(args.import_snapshot, 'rb') as stream:
+            height, outputs = snapshot.Database().import_snapshot(stream)
+        print('Imported snapshot of height {} with {} unspent outputs'.format(height, outputs))
+        return True
+
+    if args.rebuild_address_index:
+        outputs = addressindex.Database().rebuild()
+        print('Indexed {} outputs'.format(outputs))
+        return True
+
+    return False
+
+
+def print_query_stats():
+    """ Prints the counters of the queries run on the database.
+    """
+    print(querystats.format_stats(database.Database().query_stats()))
 
 
 if __name__ == '__main__':
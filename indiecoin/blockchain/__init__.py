@@ -1,4 +1,5 @@
 from . import block
+from . import storage
 
 
 class BlockChain(object):
@@ -10,22 +11,23 @@ class BlockChain(object):
 
         Attributes
         ----------
-            _blocks: indiecoin.blockchain.block.Database
-                A database object representing a connection to
-                a db endpoint. can be revieved for testing
-                purposes.
+            _storage: indiecoin.blockchain.storage.Storage
+                storage backend holding the chain. can be revieved
+                for testing purposes.
     """
     def __init__(self, database=None):
         """ BlockChain Contructor.
 
-            Can receive a database object to query at specific database.
-            If None is receieved, created a new instance which will
-            point to default database.
+            Can receive a storage, or a block.Database which is wrapped
+            in a SqliteStorage, to query at specific database. If None is
+            receieved, uses the default storage, see storage.configure().
         """
-        self._blocks = database
+        self._storage = database
 
-        if self._blocks is None:
-            self._blocks = block.Database()
+        if self._storage is None:
+            self._storage = storage.default_storage()
+        elif isinstance(self._storage, block.Database):
+            self._storage = storage.SqliteStorage(blocks=self._storage)
 
     def get_block(self, block_hash):
         """ Return a block by it's hash
@@ -35,7 +37,7 @@ class BlockChain(object):
                 block: indiecoin.blockchain.block.Block
                     block object instance for that hash.
         """
-        return self._blocks.get_block(block_hash)
+        return self._storage.get_block(block_hash)
 
     def get_block_height(self, height):
         """ Return a block by it's height
@@ -45,7 +47,76 @@ class BlockChain(object):
                 block: indiecoin.blockchain.block.Block
                     block object instance for that height.
         """
-        return self._blocks.get_block_height(height)
+        return self._storage.get_block_height(height)
+
+    def iter_blocks(self, start=1, end=None, headers_only=False, batch_size=100):
+        """ Iterates over the blocks of the chain from height start to
+            height end, both included, end defaulting to the tip. Blocks
+            are read in batches of batch_size, the next batch while the
+            current one is being used, so memory stays bounded whatever
+            the length of the chain.
+
+            Returns
+            -------
+                blocks: iterator
+                    indiecoin.blockchain.block.Block objects, or
+                    indiecoin.blockchain.headers.BlockHeader objects with
+                    headers_only.
+
+            Raises
+            ------
+                ValueError:
+                    if blocks are requested from a pruned height.
+        """
+        return self._storage.iter_blocks(start, end=end, headers_only=headers_only, batch_size=batch_size)
+
+    def get_block_header(self, block_hash):
+        """ Return the header of a block by it's hash, without its
+            transactions.
+
+            Returns
+            -------
+                header: indiecoin.blockchain.headers.BlockHeader
+                    header of the block, None if it does not exist.
+        """
+        return self._storage.get_block_header(block_hash)
+
+    def is_pruned(self, block_hash):
+        """ Checks if the body of a block was pruned by a node running
+            with --prune, its header is still known.
+
+            Returns
+            -------
+                pruned: boolean
+        """
+        return self._storage.is_pruned(block_hash)
+
+    def get_block_hash(self, height):
+        """ Return the hash of the block at height without loading it.
+
+            Returns
+            -------
+                block_hash: string or None
+                    hash of the block, None if there is no block at height.
+        """
+        return self._storage.get_block_hash(height)
+
+    def get_block_bytes(self, block_hash):
+        """ Return a block serialized as JSON by it's hash, read straight
+            from the block files when they are enabled.
+
+            Returns
+            -------
+                data: buffer, string or None
+                    JSON of the block, None if it does not exist.
+        """
+        return self._storage.get_block_bytes(block_hash)
+
+    def get_block_height_bytes(self, height):
+        """ Return a block serialized as JSON by it's height, see
+            get_block_bytes().
+        """
+        return self._storage.get_block_height_bytes(height)
 
     def get_height(self):
         """ Returns the height of local blockchain
@@ -55,16 +126,57 @@ class BlockChain(object):
                 height: int
                     height, number of blocks in database.
         """
-        return self._blocks.get_height()
+        return self._storage.get_height()
+
+    def save_blocks(self, blocks):
+        """ Saves many blocks in a single commit, used while syncing.
+
+            Returns
+            -------
+                block_ids: list
+                    id of each newly created block.
+        """
+        return self._storage.save_blocks(blocks)
 
     def get_transaction(self, transaction_hash):
         """ Returns a transaction by its hash
 
-            @TODO: CUSTOM DATABASE
-
             Returns
             -------
                 transaction: indiecoin.blockchain.transaction.Transaction
                     transaction object for specified hash.
         """
-        return block.transaction.Database().get_transaction(transaction_hash)
+        return self._storage.get_transaction(transaction_hash)
+
+    def get_balance(self, public_key):
+        """ Returns the sum of the unspent outputs owned by a public key,
+            served from the address index.
+
+            Returns
+            -------
+                balance: int
+        """
+        return self._storage.get_balance(public_key)
+
+    def iter_address_history(self, public_key, offset=0, limit=100):
+        """ Iterates over a page of the outputs owned by a public key,
+            newest first, served from the address index. The next page
+            starts at offset + limit.
+
+            Returns
+            -------
+                outputs: iterator
+                    dictionaries with hash_transaction, out_index, amount,
+                    height and unspent.
+        """
+        return self._storage.iter_address_history(public_key, offset=offset, limit=limit)
+
+    def cache_stats(self):
+        """ Returns the hit and miss counters of the storage caches.
+
+            Returns
+            -------
+                stats: dict
+                    counters and usage of each cache by name.
+        """
+        return self._storage.cache_stats()
@@ -0,0 +1,223 @@
+import logging
+import multiprocessing
+import sqlite3
+
+from ..util.hash import sha256
+from .database import Database, PRUNED_HEIGHT, from_blob, to_blob
+
+REBUILD_CHUNK_SIZE = 5000
+HISTORY_PAGE_SIZE = 100
+
+# Set in the chain_state table once the index was found behind the chain of
+# a pruned database, it can never hold the history of the pruned blocks.
+UNAVAILABLE = 'address_index_unavailable'
+
+logger = logging.getLogger(__name__)
+
+OUTPUTS_SQL = (
+    'SELECT ic_transaction.hash, transaction_output.id_transaction, transaction_output.amount, '
+    'transaction_output.public_key_owner, transaction_output.unspent, block.height '
+    'FROM transaction_output JOIN ic_transaction '
+    'ON transaction_output.id_transaction = ic_transaction.id '
+    'JOIN block ON ic_transaction.block_hash = block.hash '
+    'WHERE block.is_orphan = 0 AND transaction_output.id_transaction BETWEEN ? AND ? '
+    'ORDER BY transaction_output.id')
+
+INSERT_SQL = (
+    'INSERT OR REPLACE INTO address_output '
+    '(owner, hash_transaction, out_index, amount, height, unspent) VALUES (?, ?, ?, ?, ?, ?)')
+
+
+def owner_hash(public_key):
+    """ Returns the key the outputs of a public key are indexed by.
+    """
+    return sha256(public_key)
+
+
+def index_outputs(job):
+    """ Reads the outputs of a range of transaction ids and returns their
+        address index rows, with the owner and the transaction hash in
+        hex. Runs in the worker processes of Database.rebuild(), so it
+        opens its own connection.
+
+        Parameters
+        ----------
+            job: tuple
+                (path to the sqlite file, first transaction id, last
+                transaction id).
+    """
+    path, first, last = job
+    connection = sqlite3.connect(path)
+
+    try:
+        connection.execute('PRAGMA query_only = ON')
+        rows = []
+        indexes = {}
+
+        for hash_transaction, id_transaction, amount, public_key, unspent, height in \
+                connection.execute(OUTPUTS_SQL, (first, last)):
+            index = indexes.get(id_transaction, 0)
+            indexes[id_transaction] = index + 1
+            rows.append((
+                owner_hash(from_blob(public_key)), from_blob(hash_transaction),
+                index, int(amount), height, int(unspent)))
+
+        return rows
+    finally:
+        connection.close()
+
+
+class Database(Database):
+    """ Database Object for the index of outputs by owner.
+
+        Every output of the best chain is kept in the address_output
+        table under the hash of the public key owning it, flagged spent
+        or unspent, so the balance and history of a key are read through
+        one index instead of scanning transaction_output.
+
+        The index is optional, see StorageConfig.address_index. Once
+        enabled block.Database keeps it up to date as blocks are
+        connected. When a database is opened with the index behind the
+        chain, for instance because it was just enabled, it is rebuilt.
+        If blocks were pruned it can not be, the index is marked
+        unavailable for good and queries on it raise ValueError.
+    """
+    def __init__(self, file_name=None, config=None):
+        super(Database, self).__init__(file_name=file_name, config=config)
+
+        config = self.__manager.config
+        self.__available = config.address_index
+
+        if config.address_index and not config.read_only:
+            self.__available = self.__shared('address_index', self.__catch_up)
+
+    def __catch_up(self):
+        """ Rebuilds the index if it does not reach the tip of the chain.
+
+            Returns
+            -------
+                available: boolean
+                    False if the index is behind and blocks were pruned.
+        """
+        if self.__get_chain_state(UNAVAILABLE, 0):
+            return False
+
+        indexed = self.__query('SELECT MAX(height) as height FROM address_output')[0]['height']
+        height = self.__query('SELECT MAX(height) as height FROM block WHERE is_orphan = 0')[0]['height']
+
+        if indexed is None or indexed < height:
+            if self.__get_chain_state(PRUNED_HEIGHT, 0):
+                logger.warning('The address index is behind the chain and blocks have been pruned, it is unavailable')
+                self.__set_chain_state(UNAVAILABLE, 1)
+                return False
+
+            self.rebuild()
+        return True
+
+    def __check_enabled(self):
+        if not self.__manager.config.address_index:
+            raise ValueError('The address index is not enabled')
+
+        if not self.__available:
+            raise ValueError('The address index is unavailable, blocks were pruned before it was built')
+
+    def get_balance(self, public_key):
+        """ Returns the sum of the unspent outputs owned by public_key.
+
+            Raises
+            ------
+                ValueError:
+                    if the address index is not enabled or unavailable.
+        """
+        self.__check_enabled()
+        balance = self.__get_address_balance(owner_hash(public_key))[0]['balance']
+        return int(balance) if balance is not None else 0
+
+    def iter_history(self, public_key, offset=0, limit=HISTORY_PAGE_SIZE):
+        """ Yields a page of the outputs owned by public_key, newest first.
+
+            Each output is a dictionary with hash_transaction, out_index,
+            amount, height and unspent. Pages are read with offset and
+            limit, the next page starts at offset + limit.
+
+            Raises
+            ------
+                ValueError:
+                    if the address index is not enabled or unavailable,
+                    when called rather than on the first output.
+        """
+        self.__check_enabled()
+        return self.__iter_history(owner_hash(public_key), int(offset), int(limit))
+
+    def __iter_history(self, owner, offset, limit):
+        for row in self.__get_address_outputs(owner, offset, limit):
+            yield dict(zip(row.keys(), row))
+
+    def rebuild(self, processes=None):
+        """ Rebuilds the whole index from the stored outputs.
+
+            Ranges of transactions are read and hashed by a pool of
+            processes, the main process writes the rows they return in
+            one sqlite transaction, so new blocks wait until it is done.
+            The workers read while that transaction is open, which needs
+            the WAL journal mode.
+
+            Parameters
+            ----------
+                processes: int
+                    number of worker processes, by default one per CPU.
+                    With 1 no pool is started.
+
+            Returns
+            -------
+                outputs: int
+                    number of outputs indexed.
+
+            Raises
+            ------
+                ValueError:
+                    if blocks have been pruned, their outputs can't be
+                    indexed again.
+        """
+        if self.__get_chain_state(PRUNED_HEIGHT, 0):
+            raise ValueError('The address index can not be rebuilt once blocks have been pruned')
+
+        with self.__manager.writing():
+            return self.__rebuild(processes)
+
+    def __rebuild(self, processes):
+        """ Runs rebuild() holding the writer, so no block is connected
+            between reading the transaction ids and writing the index.
+        """
+        path = self.__get_sqlite_file_name()
+        indexed = 0
+        bounds = self.__query('SELECT MIN(id) as first, MAX(id) as last FROM ic_transaction')[0]
+        jobs = []
+
+        if bounds['first'] is not None:
+            jobs = [
+                (path, first, min(first + REBUILD_CHUNK_SIZE - 1, bounds['last']))
+                for first in range(bounds['first'], bounds['last'] + 1, REBUILD_CHUNK_SIZE)]
+
+        pool = None
+
+        if processes != 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(index_outputs, jobs)
+        else:
+            results = (index_outputs(job) for job in jobs)
+
+        try:
+            with self.__manager.transaction() as connection:
+                self.__write(connection, 'DELETE FROM address_output')
+
+                for rows in results:
+                    self.__write(
+                        connection, INSERT_SQL, [(to_blob(row[0]), to_blob(row[1])) + row[2:] for row in rows], many=True)
+                    indexed += len(rows)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return indexed
@@ -1,11 +1,75 @@
 import json
+import struct
+import sys
+import threading
+import Queue
 
-from ..util.serialization import remove_dict_prefix
-from ..util.hash import sha256
+from ..util.serialization import remove_dict_prefix, BinaryReader
+from ..util.hash import sha256, merkle_root
 
 from . import transaction
+from . import storage
+from . import addressindex
+from .headers import BlockHeader, HeaderIndex, HEADER, is_whole, pack_prefix, pack_nonce, unpack_header
+from .cache import LRUCache, block_size
 
-from database import Database
+from database import Database, PRUNED_HEIGHT, release_readers
+
+ITER_BATCH_SIZE = 100
+
+HEIGHT = struct.Struct('<I')
+PREFETCH_TIMEOUT = 0.1
+
+
+def prefetch(load, arguments):
+    """ Yields load(argument) for each of arguments, loading the next
+        one in a thread while the caller works on the current one.
+
+        At most one result is loaded ahead. If the caller stops early the
+        thread stops after its current load, an exception raised by load
+        is raised to the caller. The thread gives its read connections
+        back to the pool once it is done.
+    """
+    results = Queue.Queue(maxsize=1)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=PREFETCH_TIMEOUT)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            for argument in arguments:
+                if not put((load(argument), None)):
+                    return
+        except Exception:
+            put((None, sys.exc_info()))
+            return
+        finally:
+            release_readers()
+        put((None, None))
+
+    worker = threading.Thread(target=work)
+    worker.daemon = True
+    worker.start()
+
+    try:
+        while True:
+            result, error = results.get()
+
+            if error is not None:
+                raise error[0], error[1], error[2]
+
+            if result is None:
+                return
+            yield result
+    finally:
+        stopped.set()
 
 
 class Block(object):
@@ -16,6 +80,19 @@ class Block(object):
         where we can deal with all the logic. Validates information inside
         a block and serializes if.
 
+        A block is a header and a body. The header has a fixed layout of
+        80 bytes, see indiecoin.blockchain.headers.pack_header(), and
+        commits to the body, the transactions, through their merkle root.
+        The hash of the block, and its proof of work, are computed over
+        the header only.
+
+        The header without its nonce, the encoding of the body, the valid
+        hash and the JSON of the block are computed once and memoized, the
+        fields they cover must be changed through set_nonce(),
+        set_timestamp() and set_hash(), which drop only what they made
+        stale. The JSON holds the JSON of the transactions, memoized by
+        each of them, see Transaction.set_block_hash().
+
         Attributtes
         -----------
 
@@ -25,6 +102,11 @@ class Block(object):
                 UNIX time representation of time block was created.
             nonce: string
                 variable value to change in proof of work.
+            difficulty: int
+                number of leading zero bits the hash must have.
+            hash_merkle_root: string
+                merkle root of the hashes of the transactions, computed
+                once when the block is built.
             num_transaction: int
                 number of transaction inside block
             is_orphan: boolean
@@ -35,9 +117,12 @@ class Block(object):
                 height of block (number of blocks behind it)
             transactions: list
                 list of indiecoin.blockchain.transactions.Transaction objets
-                inside block.
-            __database: indiecoin.blockchain.block.Database
-                database object instance to which data will be queried and save.
+                inside block. Blocks built by from_storage() without them
+                are header only, they are loaded on first access.
+            __database: indiecoin.blockchain.storage.Storage
+                storage to which data will be queried and save, any object
+                with get_block_header, get_block_transactions and
+                save_block, such as block.Database.
 
 
     """
@@ -45,64 +130,229 @@ class Block(object):
         """ Construtor for Block
 
             Turns transaction data into objects if their type is different.
-            Creates default database if none provided.
+            Uses the default storage if no database is provided. A hash
+            given along must be the one of the header, see is_valid(). Only
+            blocks from our own storage can be header only, see
+            from_storage(), so transactions are required.
 
             Raises
             ------
                 AssertionError:
-                    if block is not valid (see is_valid() function)
+                    if block is not valid (see is_valid() function) or
+                    has no transactions.
+        """
+        if 'transactions' not in kwargs:
+            raise AssertionError('Block has no transactions')
+
+        self.__load(kwargs, trusted=False)
+
+        if not self.hash_merkle_root:
+            self.hash_merkle_root = self.compute_merkle_root()
+
+        if len(self.hash) != 64:  # If no has was provided we can compute it.
+            self.hash = self.valid_hash()
+
+        if not self.is_valid():
+            raise AssertionError('Block is not valid')
+
+    @classmethod
+    def from_storage(cls, **kwargs):
+        """ Builds a block read from our own storage.
+
+            Blocks are validated before they are saved, so is_valid() is
+            not run again, neither on the block nor on its transactions.
+            Blocks received from peers must go through the constructor.
+        """
+        block = cls.__new__(cls)
+        block.__load(kwargs, trusted=True)
+        return block
+
+    @classmethod
+    def from_bytes(cls, data, database=None):
+        """ Builds a block from the bytes of to_bytes(), its hash and the
+            hashes of its transactions are computed from them, the hash
+            of the block from its header only. It goes
+            through the constructor, so it is validated against database,
+            an indiecoin.blockchain.storage.Storage.
+
+            Raises
+            ------
+                ValueError:
+                    if data is not a serialized block.
+                AssertionError:
+                    if the block is not valid.
+        """
+        reader = BinaryReader(data)
+        header = unpack_header(reader.read(HEADER.size))
+        height, = reader.unpack(HEIGHT)
+        transactions = [
+            transaction.read_transaction(reader, database)
+            for i in xrange(reader.unpack(transaction.COUNT)[0])]
+        reader.close()
+
+        block_hash = sha256(data[:HEADER.size])
+
+        for tx in transactions:
+            tx['block_hash'] = block_hash
+            tx['database'] = database
+
+        return cls(
+            hash=block_hash, height=height, num_transactions=len(transactions), is_orphan=0,
+            transactions=transactions, database=database, **header)
+
+    def __load(self, kwargs, trusted):
+        """ Sets the attributes of the block from kwargs, see the
+            constructor. If trusted, transactions given as dictionaries
+            are built with Transaction.from_storage() and they may be left
+            out to build a header only block.
         """
         self.hash = kwargs['hash']
         self.timestamp = kwargs['timestamp']
         self.nonce = kwargs['nonce']
+        self.difficulty = kwargs.get('difficulty', '')
+        self.hash_merkle_root = kwargs.get('hash_merkle_root') or ''
         self.num_transactions = kwargs['num_transactions']
         self.is_orphan = True if kwargs['is_orphan'] == 1 else False
         self.previous_block_hash = kwargs['previous_block_hash']
         self.height = kwargs['height']
-        self.transactions = [transaction.Transaction(**tx) if type(tx) != transaction.Transaction else tx for tx in kwargs['transactions']]
+
+        if not trusted or 'transactions' in kwargs:
+            build = transaction.Transaction.from_storage if trusted else transaction.Transaction
+            self.transactions = [build(**tx) if type(tx) != transaction.Transaction else tx for tx in kwargs['transactions']]
 
         self.__database = kwargs.get('database')
 
         if self.__database is None:
-            self.__database = Database()
+            self.__database = storage.default_storage()
 
-        if len(self.hash) != 64:  # If no has was provided we can compute it.
-            self.hash = self.valid_hash()
+        self.__prefix = None
+        self.__body = None
+        self.__valid_hash = None
+        self.__json = None
 
-        if not self.is_valid():
-            raise AssertionError('Block is not valid')
+    def __getattr__(self, name):
+        """ Loads the transactions of a header only block the first time
+            they are accessed.
+        """
+        if name != 'transactions':
+            raise AttributeError(name)
 
-    def valid_hash(self):
-        """ Computes the valid sha256 hash of a block.
+        self.transactions = self.__database.get_block_transactions(self.hash)
+        return self.transactions
+
+    @property
+    def header_only(self):
+        """ True while the transactions of the block have not been loaded.
+        """
+        return 'transactions' not in self.__dict__
+
+    def set_nonce(self, nonce):
+        """ Sets the nonce, the header stays packed but for the nonce.
+        """
+        self.nonce = nonce
+        self.__valid_hash = None
+        self.__json = None
+
+    def set_timestamp(self, timestamp):
+        """ Sets the timestamp, the header is packed again.
+        """
+        self.timestamp = timestamp
+        self.__prefix = None
+        self.__valid_hash = None
+        self.__json = None
+
+    def set_hash(self, block_hash):
+        """ Sets the hash of the block, once the miner has found it.
+        """
+        self.hash = block_hash
+        self.__json = None
+
+    def compute_merkle_root(self):
+        """ Computes the merkle root of the hashes of the transactions.
+        """
+        return merkle_root([tx.hash for tx in self.transactions])
+
+    def header_bytes(self):
+        """ Returns the 80 bytes of the header of the block, see
+            indiecoin.blockchain.headers.pack_header().
+
+            Blocks stored before merkle roots were have an empty one, it
+            is computed the first time it is needed and the JSON memoized
+            without it is dropped.
+        """
+        if self.__prefix is None:
+            if not self.hash_merkle_root:
+                self.hash_merkle_root = self.compute_merkle_root()
+                self.__json = None
 
-            Removes the hash field from serialized object.
+            self.__prefix = pack_prefix(
+                self.previous_block_hash, self.hash_merkle_root, self.timestamp, self.difficulty)
+
+        return self.__prefix + pack_nonce(self.nonce)
+
+    def valid_hash(self):
+        """ Computes the valid sha256 hash of a block, over its header.
 
             Returns
             -------
                 hash: string
                     sha256 digest of block
         """
-        data = self.serialize()
-        [data.pop(field, None) for field in ['hash']]
-
-        return sha256(str(data))
+        if self.__valid_hash is None:
+            self.__valid_hash = sha256(self.header_bytes())
+        return self.__valid_hash
 
     def is_valid(self):
         """ Checks if a block is valid.
 
-            Verifies number of transactions, verifies only one coinbase
-            transaction. verifies that each transaction is valid, that
-            block has a previous block and height matches.
+            Verifies that the hash of the block is the one of its header,
+            verifies number of transactions, verifies only one coinbase
+            transaction. verifies that no output is spent twice inside
+            the block, that each transaction is valid, that block has a
+            previous block and height matches, and that the merkle root
+            of the header is the one of the transactions. The header must
+            hold every field as it is, so the timestamp, difficulty and
+            nonce must be whole numbers that fit in it.
 
             @TODO:
                 Validate Proof-of-work
         """
+        if not all(is_whole(value) for value in [self.timestamp, self.difficulty, self.nonce]):
+            return False
+
+        try:
+            if self.hash != self.valid_hash():
+                return False
+        except ValueError:
+            return False
+
+        if self.height > 1:
+            previous_block = self.__database.get_block_header(self.previous_block_hash)
+
+            if previous_block is None:
+                return False
+
+            if previous_block.height != self.height - 1:
+                return False
+
         coinbase_transactions = 0
+        spent = set()
+
         if len(self.transactions) != self.num_transactions:
             print("a")
             return False
 
+        if self.hash_merkle_root != self.compute_merkle_root():
+            return False
+
         for tx in self.transactions:
+            for tx_input in tx.tx_inputs:
+                outpoint = (tx_input.hash_transaction, tx_input.prev_out_index)
+
+                if outpoint in spent:
+                    return False
+                spent.add(outpoint)
+
             if tx.is_coinbase:
                 coinbase_transactions += 1
                 if coinbase_transactions > 1:
@@ -112,15 +362,6 @@ class Block(object):
             if not tx.is_valid():
                 return False
 
-        if self.height > 1:
-            previous_block = self.__database.get_block(self.previous_block_hash)
-
-            if previous_block is None:
-                return False
-
-            if previous_block.height != self.height - 1:
-                return False
-
         return True
 
     def exists(self):
@@ -131,7 +372,7 @@ class Block(object):
                 exists : boolean value
                     boolean indicating if block exists in database.
         """
-        db_block = self.__database.get_block(self.hash)
+        db_block = self.__database.get_block_header(self.hash)
         if db_block is not None:
             return True
         return False
@@ -139,9 +380,15 @@ class Block(object):
     def save(self):
         """ Saves a block object to the database.
 
-            Removes transactions data from serialized block,
-            saves block to database and then save each transaction
-            making reference to the newly created block.
+            The block and all of its transactions, inputs and outputs
+            are written in one sqlite transaction along with the update
+            of the unspent output set, either all of them are saved or
+            none is.
+
+            Raises
+            ------
+                AssertionError:
+                    if the block spends an output that is not unspent.
 
             @TODO:
                 Implement update on exists
@@ -155,23 +402,19 @@ class Block(object):
         if self.exists():
             raise NotImplemented('No update Implemented')
 
-        block_data = self.serialize()
-        [block_data.pop(field, None) for field in ['transactions']]
-
-        block_id = self.__database.save_block(block_data)
-
-        if block_id:
-            for tx in self.transactions:
-                tx.set_block_hash(self.hash)
-                tx.save(block_id=block_id)
-
-        return block_id
+        return self.__database.save_block(self)
 
-    def serialize(self):
+    def serialize(self, transactions=True):
         """ Serializes a block object into a dictionary representation.
 
             To serialize each input and output we call its serialize method.
 
+            Parameters
+            ----------
+                transactions: bool
+                    serialize the transactions too, False for the fields
+                    of the block only, without loading them.
+
             Returns
             -------
                 data : dict
@@ -183,15 +426,42 @@ class Block(object):
                 serialization hence removed.
         """
         data = remove_dict_prefix(self.__dict__, '_Block')
-        [data.pop(field, None) for field in ['__database']]
-        data['transactions'] = [tx.serialize() for tx in data['transactions']]
+        [data.pop(field, None) for field in ['__database', '__prefix', '__body', '__valid_hash', '__json', 'transactions']]
+
+        if transactions:
+            data['transactions'] = [tx.serialize() for tx in self.transactions]
 
         return data
 
+    def to_bytes(self):
+        """ Returns the canonical binary encoding of the block.
+
+            It holds the header, see header_bytes(), the height and the
+            transactions preceded by their count, see
+            Transaction.to_bytes(). Its own hash and whether it is orphan
+            are not part of it.
+        """
+        if self.__body is None:
+            transactions = self.transactions  # Loads them if header only.
+            self.__body = (
+                HEIGHT.pack(int(self.height)) + transaction.COUNT.pack(len(transactions)) +
+                ''.join(tx.to_bytes() for tx in transactions))
+
+        return self.header_bytes() + self.__body
+
     def to_json(self):
         """ Returns a strins representation in JSON of Block object.
+
+            The fields of the block are dumped once, the JSON of each
+            transaction is appended to them as it is memoized by the
+            transaction, so a transaction whose block hash was set since
+            is dumped again on its own.
         """
-        return json.dumps(self.serialize())
+        if self.__json is None:
+            self.__json = json.dumps(self.serialize(transactions=False))
+
+        return '{}, "transactions": [{}]}}'.format(
+            self.__json[:-1], ', '.join(tx.to_json() for tx in self.transactions))
 
     def __str__(self):
         transactions = '{}\n'.format(''.join(
@@ -202,42 +472,339 @@ class Block(object):
 class Database(Database):
     """ Database Object abstraction for Blocks that
         will interact directly with the database.
+
+        Attributes
+        ----------
+            headers: indiecoin.blockchain.headers.HeaderIndex
+                index of the best chain shared by every Database of the
+                same file, answers heights and hashes without queries.
+                Reloaded when another process moved the tip.
+            cache: indiecoin.blockchain.cache.LRUCache
+                blocks by hash, shared by every Database of the same
+                file. Blocks by height go through it using headers.
     """
-    def __init__(self, file_name=None):
+    def __init__(self, file_name=None, config=None):
         self.file_name = file_name
-        super(Database, self).__init__(file_name=file_name)
+        super(Database, self).__init__(file_name=file_name, config=config)
+        self.transactions = transaction.Database(file_name=file_name, config=config)
+        self.__headers = self.__shared('headers', lambda: HeaderIndex(
+            (BlockHeader(**row) for row in self.__get_headers()),
+            pruned_height=self.__get_chain_state(PRUNED_HEIGHT, 0)))
+
+        config = self.__manager.config
+        self.cache = self.__shared('blocks', lambda: LRUCache(
+            config.block_cache_entries, config.block_cache_bytes, block_size))
+
+    @property
+    def headers(self):
+        """ The header index, checked against the file first if another
+            connection committed to it since the last check.
+        """
+        if self.__manager.data_changed():
+            self.__reload_headers()
+        return self.__headers
+
+    def __reload_headers(self):
+        """ Reloads the header index if the tip or the pruned height in
+            the file differ from its own, as when another process saved,
+            orphaned or pruned blocks. The cached blocks and transactions
+            may be stale as well, they are dropped along with it.
+
+            Commits of other processes that do not touch the chain, such
+            as a rebuild of the address index, leave the index as it is.
+        """
+        tip = self.__get_tip()
+        tip_hash = tip[0]['hash'] if tip else None
+        pruned_height = self.__get_chain_state(PRUNED_HEIGHT, 0)
+        indexed = self.__headers.tip
+
+        if tip_hash == (indexed.hash if indexed else None) and pruned_height == self.__headers.pruned_height:
+            return
+
+        self.__headers.reload((BlockHeader(**row) for row in self.__get_headers()), pruned_height)
+        self.cache.clear()
+        self.transactions.cache.clear()
 
     def __assemble(self, block):
-        """ Turns database block data into block object, does
-            the same for transactions inside block.
+        """ Turns database block data into a header only block object,
+            its transactions are loaded when first accessed.
         """
         if block == []:
             return None
 
-        block = block[0]
-        transactions = transaction.Database(
-            file_name=self.file_name).get_block_transactions(block['hash'])
-        block['transactions'] = transactions
-        block['database'] = self
-        return Block(**block)
+        return Block.from_storage(database=self, **block[0])
 
     def get_block(self, block_hash):
-        """ Retrieves a block through a hash
+        """ Retrieves a block through a hash, from the cache if it was
+            retrieved recently. None if it does not exist or if its body
+            was pruned, see is_pruned().
         """
-        return(self.__assemble(self.__get_block(block_hash)))
+        if self.is_pruned(block_hash):
+            return None
+
+        block = self.cache.get(block_hash)
+
+        if block is None:
+            block = self.__assemble(self.__get_block(block_hash))
+
+            if block is not None:
+                self.cache.put(block_hash, block)
+        return block
+
+    def is_pruned(self, block_hash):
+        """ Checks if the body of a block was pruned, only its header is
+            kept. See indiecoin.blockchain.prune.
+        """
+        pruned_height = self.headers.pruned_height
+
+        if not pruned_height:
+            return False
+
+        header = self.get_block_header(block_hash)
+        return header is not None and header.height <= pruned_height
+
+    def cache_stats(self):
+        """ Returns the hit and miss counters and usage of the block and
+            transaction caches.
+        """
+        return {
+            'blocks': self.cache.stats(),
+            'transactions': self.transactions.cache.stats(),
+        }
+
+    def get_block_header(self, block_hash):
+        """ Retrieves the header of a block through a hash.
+
+            Served from the header index, blocks outside of it such as
+            orphans or blocks saved earlier in the current transaction
+            cost one indexed row read.
+
+            Returns
+            -------
+                header: indiecoin.blockchain.headers.BlockHeader or None
+        """
+        header = self.headers.get(block_hash)
+
+        if header is None:
+            block = self.__get_block(block_hash)
+            header = BlockHeader(**block[0]) if block else None
+        return header
+
+    def get_block_transactions(self, block_hash):
+        """ Retrieves the transactions of a block through its hash.
+        """
+        return self.transactions.get_block_transactions(block_hash)
 
     def get_block_height(self, height):
         """ Retrieves a block through height
         """
-        return(self.__assemble(self.__get_block_height(height)))
+        block_hash = self.get_block_hash(height)
+
+        if block_hash is None:
+            return None
+        return self.get_block(block_hash)
+
+    def get_block_hash(self, height):
+        """ Returns the hash of the block at height from the header index,
+            None if there is no block at that height.
+        """
+        try:
+            return self.headers.get_hash(int(height))
+        except ValueError:
+            return None
+
+    def get_block_bytes(self, block_hash):
+        """ Retrieves a block serialized as JSON through a hash.
+
+            If block files are enabled the stored bytes are returned as
+            they were written, without building nor serializing a block.
+            Otherwise the block is loaded and serialized.
+
+            Returns
+            -------
+                data: buffer, string or None
+                    JSON of the block, None if it does not exist.
+        """
+        data = self.__read_block_bytes(self.__get_block_location(block_hash))
+
+        if data is None:
+            block = self.get_block(block_hash)
+            return block.to_json() if block else None
+        return data
+
+    def get_block_height_bytes(self, height):
+        """ Retrieves a block serialized as JSON through height, see
+            get_block_bytes().
+        """
+        block_hash = self.get_block_hash(height)
+
+        if block_hash is None:
+            return None
+        return self.get_block_bytes(block_hash)
 
     def get_height(self):
         """ Retrieves the current height of local blockchain.
         """
-        return(self.__get_height()[0]['height'])
+        return self.headers.height
+
+    def iter_blocks(self, start=1, end=None, headers_only=False, batch_size=ITER_BATCH_SIZE):
+        """ Yields the blocks of the best chain from height start to height
+            end, both included, end defaulting to the tip.
+
+            Headers come from the header index without any query. Blocks
+            are read batch_size heights at a time, each batch with four
+            queries walking the height index, and the next batch is read
+            in a thread while the caller works on the current one. At
+            most three batches are in memory whatever the length of the
+            chain, they do not go through the block cache.
+
+            Parameters
+            ----------
+                headers_only: bool
+                    yield indiecoin.blockchain.headers.BlockHeader objects
+                    instead of blocks.
+
+            Raises
+            ------
+                ValueError:
+                    if blocks are requested from a pruned height, see
+                    is_pruned().
+        """
+        start = max(int(start), 1)
+        end = self.get_height() if end is None else min(int(end), self.get_height())
 
-    def save_block(self, block_data):
+        if headers_only:
+            return self.__iter_headers(start, end)
+
+        if start <= self.headers.pruned_height:
+            raise ValueError('Blocks up to height {} have been pruned'.format(self.headers.pruned_height))
+
+        batches = ((first, min(first + batch_size - 1, end)) for first in xrange(start, end + 1, batch_size))
+        return (block for blocks in prefetch(self.__load_heights, batches) for block in blocks)
+
+    def __iter_headers(self, start, end):
+        for height in xrange(start, end + 1):
+            header = self.headers.get(self.headers.get_hash(height))
+
+            if header is not None:
+                yield header
+
+    def __load_heights(self, heights):
+        """ Builds the blocks with a height in the range heights, with
+            their transactions.
+        """
+        start, end = heights
+        transactions = self.transactions.get_heights_transactions(start, end)
+
+        return [
+            Block.from_storage(database=self, transactions=transactions.get(row['hash'], []), **row)
+            for row in self.__get_blocks_heights(start, end)]
+
+    def save_block(self, block):
         """ Saves block object to database.
+
+            Removes transactions data from serialized block, saves
+            block and then its transactions making reference to the
+            newly created block. Everything is committed once.
         """
+        with self.__transaction():
+            return self.__save_block(block)
+
+    def save_blocks(self, blocks):
+        """ Saves many block objects committing them all at once.
+
+            Used to group commit blocks while syncing. blocks can be
+            any iterable, if it is a generator each block is built
+            inside the sqlite transaction, so it can be validated
+            against the blocks saved before it. If anything fails
+            none of the blocks is saved.
+
+            Returns
+            -------
+                block_ids: list
+                    id of each newly created block.
+        """
+        with self.__transaction():
+            return [self.__save_block(block) for block in blocks]
+
+    def __save_block(self, block):
+        """ Writes a block and its transactions, must be called inside
+            __transaction().
+        """
+        block_data = block.serialize(transactions=False)
         block_id = self.__insert('block', block_data)
+
+        for tx in block.transactions:
+            tx.set_block_hash(block.hash)
+
+        self.transactions.save_transactions(
+            [tx.serialize() for tx in block.transactions], block_id=block_id)
+        self.__connect_transactions(block.transactions, block.height)
+        self.__store_block_bytes(block.hash, block.height, block.to_json())
+
+        if not block.is_orphan:
+            header = BlockHeader.from_block(block)
+            self.__manager.after_commit(lambda: self.headers.add(header))
+
+        self.__invalidate_connected(block)
+
         return block_id
+
+    def __invalidate_connected(self, block):
+        """ Once the block is committed drops from the caches the objects
+            it made stale: its own transactions, the transactions whose
+            outputs it spends and the blocks holding them.
+        """
+        spent = set(tx_in.hash_transaction for tx in block.transactions for tx_in in tx.tx_inputs)
+        transaction_hashes = spent.union(tx.hash for tx in block.transactions)
+        block_hashes = [block.hash]
+
+        if spent:
+            block_hashes.extend(row['block_hash'] for row in self.__get_transactions_block_hashes(list(spent)))
+
+        def invalidate():
+            for block_hash in block_hashes:
+                self.cache.invalidate(block_hash)
+            for transaction_hash in transaction_hashes:
+                self.transactions.cache.invalidate(transaction_hash)
+
+        self.__manager.after_commit(invalidate)
+
+    def __connect_transactions(self, transactions, height):
+        """ Updates the unspent output set with the transactions of a
+            block. Every output they create is added and every output
+            they spend is removed. The address index is updated in the
+            same way when it is enabled.
+
+            Raises
+            ------
+                AssertionError:
+                    if one of the outputs spent is not in the set,
+                    which means the block double spends.
+        """
+        created = []
+        spent = []
+
+        for tx in transactions:
+            for index, tx_out in enumerate(tx.tx_outputs):
+                created.append({
+                    'hash_transaction': tx.hash,
+                    'out_index': index,
+                    'amount': tx_out.amount,
+                    'public_key_owner': tx_out.public_key_owner})
+
+            spent.extend((tx_in.hash_transaction, tx_in.prev_out_index) for tx_in in tx.tx_inputs)
+
+        self.__insert_many('unspent_output', created)
+
+        if self.__manager.config.address_index:
+            self.__insert_many('address_output', [{
+                'owner': addressindex.owner_hash(output['public_key_owner']),
+                'hash_transaction': output['hash_transaction'],
+                'out_index': output['out_index'],
+                'amount': output['amount'],
+                'height': int(height),
+                'unspent': 1} for output in created])
+
+        if self.__spend_outputs(spent) != len(spent):
+            raise AssertionError('Block spends an output that is not unspent')
@@ -0,0 +1,193 @@
+import mmap
+import os
+import re
+import struct
+import threading
+
+MAX_BLOCK_FILE_SIZE = 128 * 1024 * 1024
+BLOCK_FILE_NAME = 'blk{:05d}.dat'
+BLOCK_FILE_PATTERN = re.compile(r'^blk(\d{5})\.dat$')
+RECORD_MAGIC = 'ICBK'
+RECORD_HEADER = struct.Struct('<4sI')
+
+
+class BlockFileStore(object):
+    """ Append-only store of serialized blocks in rotating blk*.dat files.
+
+        Each block is appended as a record made of a magic string, the
+        length of the block and the serialized block itself. Once a file
+        reaches MAX_BLOCK_FILE_SIZE a new one is started. The store does
+        not index blocks, append() returns where the block was written
+        and the caller keeps that location (see block.Database).
+
+        Reads go through a memory map of each file and return a buffer
+        over the mapped bytes, so no copy is made until the data is sent.
+
+        Appends are not synced to disk one by one, the caller calls sync()
+        once the sqlite transaction recording their locations commits, or
+        truncate() to drop them if it rolls back.
+
+        Attributes
+        ----------
+            directory: string
+                directory holding the blk*.dat files.
+            max_file_size: int
+                size after which a new file is started.
+    """
+    def __init__(self, directory, max_file_size=MAX_BLOCK_FILE_SIZE):
+        self.directory = directory
+        self.max_file_size = max_file_size
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        self.__lock = threading.Lock()
+        self.__maps = {}
+        self.__unsynced = set()
+        self.__file_number = self.__last_file_number()
+
+    def __last_file_number(self):
+        """ Returns the number of the newest blk*.dat file in directory.
+        """
+        numbers = [
+            int(match.group(1)) for match in
+            [BLOCK_FILE_PATTERN.match(name) for name in os.listdir(self.directory)]
+            if match]
+        return max(numbers) if numbers else 0
+
+    def __path(self, file_number):
+        """ Returns the complete path to a blk*.dat file.
+        """
+        return os.path.join(self.directory, BLOCK_FILE_NAME.format(file_number))
+
+    def append(self, data):
+        """ Appends a serialized block to the current file, rotating to a
+            new file if it would grow past max_file_size.
+
+            Returns
+            -------
+                location: tuple
+                    (file_number, offset, length) of the block data.
+        """
+        with self.__lock:
+            path = self.__path(self.__file_number)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+
+            if size > 0 and size + RECORD_HEADER.size + len(data) > self.max_file_size:
+                self.__file_number += 1
+                path = self.__path(self.__file_number)
+                size = 0
+
+            with open(path, 'ab') as block_file:
+                block_file.write(RECORD_HEADER.pack(RECORD_MAGIC, len(data)))
+                block_file.write(data)
+
+            self.__unsynced.add(self.__file_number)
+            return self.__file_number, size + RECORD_HEADER.size, len(data)
+
+    def sync(self):
+        """ Flushes to disk every file appended to since the last sync.
+        """
+        with self.__lock:
+            for file_number in sorted(self.__unsynced):
+                with open(self.__path(file_number), 'ab') as block_file:
+                    os.fsync(block_file.fileno())
+
+            self.__unsynced = set()
+
+    def truncate(self, file_number, offset):
+        """ Drops the record of a block and every record appended after
+            it, such as the blocks of a rolled back transaction. Files
+            started after its file are removed.
+        """
+        with self.__lock:
+            for number in range(file_number + 1, self.__file_number + 1):
+                self.__maps.pop(number, None)
+                self.__unsynced.discard(number)
+
+                if os.path.exists(self.__path(number)):
+                    os.remove(self.__path(number))
+
+            # A map over the dropped bytes would fault once they are gone.
+            self.__maps.pop(file_number, None)
+            self.__file_number = file_number
+
+            with open(self.__path(file_number), 'r+b') as block_file:
+                block_file.truncate(offset - RECORD_HEADER.size)
+
+    def read(self, file_number, offset, length):
+        """ Returns the bytes of a block without copying them.
+
+            Returns
+            -------
+                data: buffer
+                    read-only buffer over the memory mapped file.
+        """
+        block_map = self.__map(file_number, offset + length)
+        return buffer(block_map, offset, length)
+
+    def __map(self, file_number, size):
+        """ Returns a memory map of a file covering at least size bytes.
+
+            Files only grow, so a file is mapped again when a block past
+            the end of its current map is requested.
+        """
+        with self.__lock:
+            block_map = self.__maps.get(file_number)
+
+            if block_map is None or len(block_map) < size:
+                with open(self.__path(file_number), 'rb') as block_file:
+                    block_map = mmap.mmap(block_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.__maps[file_number] = block_map
+
+            return block_map
+
+    def remove(self, file_number):
+        """ Deletes a blk*.dat file once none of its blocks is needed.
+            The file being appended to is never removed.
+
+            Returns
+            -------
+                removed: boolean
+                    True if the file was deleted.
+        """
+        with self.__lock:
+            if file_number >= self.__file_number:
+                return False
+
+            # Buffers returned by read() may still be in use, the map is
+            # closed once they are released.
+            self.__maps.pop(file_number, None)
+            path = self.__path(file_number)
+
+            if not os.path.exists(path):
+                return False
+
+            os.remove(path)
+            return True
+
+    def close(self):
+        """ Releases every memory map.
+        """
+        with self.__lock:
+            for block_map in self.__maps.values():
+                block_map.close()
+            self.__maps = {}
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_block_file_store(directory):
+    """ Returns the process-wide BlockFileStore of a directory, creating it
+        the first time the directory is used.
+    """
+    with _stores_lock:
+        store = _stores.get(directory)
+
+        if store is None:
+            store = BlockFileStore(directory)
+            _stores[directory] = store
+
+        return store
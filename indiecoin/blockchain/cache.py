@@ -0,0 +1,127 @@
+import collections
+import threading
+
+OBJECT_OVERHEAD = 256
+TRANSACTION_SIZE = 2048
+
+
+class LRUCache(object):
+    """ Least recently used cache bounded by entries and by bytes.
+
+        When putting a value pushes the cache over either budget the
+        least recently used values are evicted. The size of each value is
+        given by sizeof, an estimate is enough, the budget is only meant
+        to keep memory bounded.
+
+        Attributes
+        ----------
+            max_entries: int
+                maximum number of values kept, None for no limit.
+            max_bytes: int
+                maximum sum of the sizes of the values, None for no limit.
+            hits: int
+                number of get() calls that found their key.
+            misses: int
+                number of get() calls that did not.
+            size: int
+                sum of the sizes of the values kept.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.__sizeof = sizeof if sizeof is not None else (lambda value: 1)
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def get(self, key):
+        """ Returns the value of key and marks it as recently used, None
+            if it is not cached.
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value):
+        """ Caches value under key, evicting the least recently used values
+            if a budget is exceeded. A value larger than max_bytes is not
+            cached.
+        """
+        size = self.__sizeof(value)
+
+        if self.max_entries == 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+
+        with self.__lock:
+            self.__remove(key)
+            self.__entries[key] = (value, size)
+            self.size += size
+
+            while ((self.max_entries is not None and len(self.__entries) > self.max_entries) or
+                   (self.max_bytes is not None and self.size > self.max_bytes)):
+                self.size -= self.__entries.popitem(last=False)[1][1]
+
+    def invalidate(self, key):
+        """ Drops key from the cache if it is cached.
+        """
+        with self.__lock:
+            self.__remove(key)
+
+    def __remove(self, key):
+        entry = self.__entries.pop(key, None)
+
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        """ Drops every value, the counters are kept.
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Returns the counters and usage of the cache as a dictionary.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.__entries),
+            'bytes': self.size,
+        }
+
+
+def transaction_size(transaction):
+    """ Estimates the memory taken by a Transaction object, counting its
+        strings and a fixed overhead per object.
+    """
+    return (
+        OBJECT_OVERHEAD * (1 + len(transaction.tx_inputs) + len(transaction.tx_outputs)) +
+        len(transaction.hash) + len(transaction.block_hash) +
+        sum(len(tx_in.signature) + len(tx_in.hash_transaction) for tx_in in transaction.tx_inputs) +
+        sum(len(tx_out.public_key_owner) for tx_out in transaction.tx_outputs))
+
+
+def block_size(block):
+    """ Estimates the memory taken by a Block object. The transactions of
+        a header only block are counted as TRANSACTION_SIZE each, as they
+        are kept once loaded.
+    """
+    if block.header_only:
+        return OBJECT_OVERHEAD + int(block.num_transactions) * TRANSACTION_SIZE
+    return OBJECT_OVERHEAD + sum(transaction_size(tx) for tx in block.transactions)
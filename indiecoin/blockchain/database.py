@@ -1,22 +1,705 @@
+import binascii
 import sqlite3
 import json
+import logging
 import os
+import sys
+import threading
+import contextlib
+import time
 
 from .. import util
+from . import blockfile
+from .querystats import QueryStats
 
 TABLE_NAME = 'table_name'
 TABLE_FIELDS = 'fields'
 FIELD_NAME = 'name'
 FIELD_TYPE = 'type'
 CONSTRAINTS = 'constraints'
+INDEXES = 'indexes'
+INDEX_NAME = 'name'
+INDEX_COLUMNS = 'columns'
+INDEX_UNIQUE = 'unique'
+
+MAX_READ_CONNECTIONS = 16
+READ_CONNECTION_WAIT = 0.5
+READ_CONNECTION_POLL = 0.05
+DATA_VERSION_INTERVAL = 0.1
+STATEMENT_CACHE_SIZE = 256
+# Below SQLITE_MAX_VARIABLE_NUMBER, 999 on older sqlite builds.
+MAX_QUERY_PARAMETERS = 500
+
+DEFAULT_FILE_NAME = 'indiecoin.sqlite'
+PRUNED_HEIGHT = 'pruned_height'
+SCHEMA_VERSION = 2
+HEX_TYPE = 'HEXBLOB'
+
+GENESIS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'genesis')
+
+logger = logging.getLogger(__name__)
+
+with open(os.path.join(GENESIS_PATH, 'database.json')) as database_definition_file:
+    DATABASE_DEFINITION = json.load(database_definition_file)
+
+HEX_COLUMNS = dict(
+    (table[TABLE_NAME], frozenset(
+        field[FIELD_NAME] for field in table[TABLE_FIELDS] if field[FIELD_TYPE] == HEX_TYPE))
+    for table in DATABASE_DEFINITION)
+
+
+def to_blob(value):
+    """ Converts an hex string to the raw bytes stored in HEXBLOB
+        columns, None is kept as NULL.
+
+        Hashes, public keys and signatures are hex everywhere outside
+        of the database, they are only stored as bytes, which takes half
+        the space in the tables, the indexes and the page cache.
+
+        Raises
+        ------
+            ValueError:
+                if value is not an hex string.
+    """
+    if value is None or isinstance(value, buffer):
+        return value
+
+    try:
+        return sqlite3.Binary(binascii.unhexlify(value))
+    except (TypeError, binascii.Error):
+        raise ValueError('Not an hex string: {!r}'.format(value))
+
+
+def from_blob(value):
+    """ Converts the bytes of a HEXBLOB column back to an hex string.
+    """
+    return binascii.hexlify(value).decode('ascii')
+
+
+def decode_row(cursor, row):
+    """ Row factory of every connection, returns rows as sqlite3.Row
+        with their HEXBLOB columns read back as hex strings.
+
+        HEXBLOB columns are the only ones holding blobs. A converter
+        registered for the type is not used because sqlite3 reads empty
+        blobs as None before calling it.
+    """
+    return sqlite3.Row(cursor, tuple(from_blob(value) if isinstance(value, buffer) else value for value in row))
+
+
+def hex_parameter(value):
+    """ Converts a lookup parameter for a HEXBLOB column. Values that
+        are not hex can't be stored, they are bound as they are and
+        match no row.
+    """
+    try:
+        return to_blob(value)
+    except ValueError:
+        return value
+
+
+def encode_row(table_name, data):
+    """ Returns a copy of the dictionary data with its HEXBLOB columns
+        of table_name converted with to_blob().
+    """
+    hex_columns = HEX_COLUMNS.get(table_name, ())
+    return dict(
+        (column, to_blob(value) if column in hex_columns else value)
+        for column, value in data.iteritems())
+
+
+def sqlite_file_name(data_dir=None, file_name=None):
+    """ Returns the complete path to a sqlite database file, by default
+        indiecoin.sqlite in the default data directory.
+    """
+    if data_dir is None:
+        data_dir = util.default_data_directory()
+
+    if file_name is None:
+        file_name = DEFAULT_FILE_NAME
+    return os.path.join(data_dir, file_name)
+
+
+class StorageConfig(object):
+    """ Sqlite settings applied to every connection of a database file.
+
+        Attributes
+        ----------
+            journal_mode: string
+                sqlite journal mode, WAL lets readers proceed while the
+                writer commits.
+            synchronous: string
+                how often sqlite waits for data to reach the disk, NORMAL
+                is safe in WAL mode.
+            cache_size: int
+                page cache per connection, negative values are KiB.
+            mmap_size: int
+                bytes of the file to access through memory mapping.
+            temp_store: string
+                where temporary tables and indexes are kept.
+            read_only: boolean
+                if True every connection refuses writes and the schema
+                is not created, for processes that only read.
+            block_files: boolean
+                if True saved blocks are also appended serialized to
+                blk*.dat files, see indiecoin.blockchain.blockfile.
+            address_index: boolean
+                if True the outputs of every connected block are also
+                indexed by owner, see indiecoin.blockchain.addressindex.
+            block_cache_entries, block_cache_bytes: int
+                budgets of the cache of blocks by hash, see
+                indiecoin.blockchain.cache.LRUCache.
+            transaction_cache_entries, transaction_cache_bytes: int
+                budgets of the cache of transactions by hash.
+            prune_blocks: int
+                if set, the bodies of the blocks deeper than this many
+                blocks below the tip are pruned, see
+                indiecoin.blockchain.prune.
+            prune_bytes: int
+                if set, the bodies of the oldest blocks are pruned while
+                the database holds more than this many bytes.
+            slow_query_ms: float
+                if set, statements slower than this many milliseconds are
+                logged with their query plan, see
+                indiecoin.blockchain.querystats.
+    """
+    def __init__(self, journal_mode='WAL', synchronous='NORMAL', cache_size=-16000,
+                 mmap_size=64 * 1024 * 1024, temp_store='MEMORY', read_only=False,
+                 block_files=False, address_index=False, block_cache_entries=1024, block_cache_bytes=64 * 1024 * 1024,
+                 transaction_cache_entries=16384, transaction_cache_bytes=32 * 1024 * 1024,
+                 prune_blocks=None, prune_bytes=None, slow_query_ms=None):
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = int(cache_size)
+        self.mmap_size = int(mmap_size)
+        self.temp_store = temp_store
+        self.read_only = read_only
+        self.block_files = block_files
+        self.address_index = address_index
+        self.block_cache_entries = block_cache_entries
+        self.block_cache_bytes = block_cache_bytes
+        self.transaction_cache_entries = transaction_cache_entries
+        self.transaction_cache_bytes = transaction_cache_bytes
+        self.prune_blocks = prune_blocks
+        self.prune_bytes = prune_bytes
+        self.slow_query_ms = slow_query_ms
+
+    def pragmas(self):
+        """ Returns the PRAGMA statements to run on a new connection.
+        """
+        return [
+            'PRAGMA synchronous = {}'.format(self.synchronous),
+            'PRAGMA cache_size = {}'.format(self.cache_size),
+            'PRAGMA mmap_size = {}'.format(self.mmap_size),
+            'PRAGMA temp_store = {}'.format(self.temp_store),
+        ]
+
+
+_default_config = StorageConfig()
+
+
+def configure(config):
+    """ Sets the StorageConfig used by databases opened without one.
+
+        Must be called before the first database is opened, a file
+        keeps the configuration it was opened with.
+    """
+    global _default_config
+    _default_config = config
+
+
+def default_config():
+    """ Returns the StorageConfig used by databases opened without one.
+    """
+    return _default_config
+
+
+class ConnectionManager(object):
+    """ Process-wide owner of the sqlite connections for one database file.
+
+        Every Database object pointing to the same file shares a single
+        ConnectionManager, so building a Block, Transaction or BlockChain
+        no longer opens a new connection nor re-runs schema creation.
+
+        Writes go through one writer connection serialized by write_lock.
+        Reads are served by a bounded pool of read connections. A thread
+        is handed a connection on its first read and owns it until it
+        calls release() or exits, then the connection goes back to the
+        pool for the next thread, without being closed. When every
+        connection is owned by a live thread, a read waits up to
+        READ_CONNECTION_WAIT seconds for one to be released, then falls
+        back to the writer connection.
+
+        Commits of other connections to the file, such as those of another
+        process, are found with PRAGMA data_version at most once every
+        DATA_VERSION_INTERVAL seconds, see data_changed().
+
+        Read connections are opened with query_only, they can never write.
+        With the WAL journal mode they keep reading while the writer holds
+        a transaction open or commits.
+
+        Attributes
+        ----------
+            path: string
+                complete path to the sqlite file.
+            writer: sqlite3.Connection
+                only connection used to modify the database.
+            write_lock: threading.RLock
+                lock held while the writer connection is in use.
+            config: indiecoin.blockchain.database.StorageConfig
+                settings applied to every connection.
+            initialized: boolean
+                True once the schema and genesis block have been checked.
+            caches: dict
+                in memory structures built from this file, such as the
+                header index, dropped along with the manager.
+            query_stats: indiecoin.blockchain.querystats.QueryStats
+                counters of the statements run by Database objects.
+    """
+    def __init__(self, path, config=None, max_readers=MAX_READ_CONNECTIONS):
+        self.path = path
+        self.config = config if config is not None else default_config()
+        self.max_readers = max_readers
+        self.write_lock = threading.RLock()
+        self.writer = self.__connect(read_only=self.config.read_only)
+        self.initialized = False
+        self.caches = {}
+        self.query_stats = QueryStats(self.config.slow_query_ms)
+
+        if not self.config.read_only:
+            self.writer.execute('PRAGMA journal_mode = {}'.format(self.config.journal_mode))
+
+        self.__inode = os.stat(path).st_ino
+        self.__readers = {}
+        self.__idle_readers = []
+        self.__opened_readers = 0
+        self.__readers_lock = threading.Lock()
+        self.__reader_released = threading.Condition(self.__readers_lock)
+        self.__writer_thread = None
+        self.__transaction_depth = 0
+        self.__on_commit = []
+        self.__on_rollback = []
+        self.__watcher = self.__connect()
+        self.__watcher_lock = threading.Lock()
+        self.__data_version = self.__watcher.execute('PRAGMA data_version').fetchone()[0]
+        self.__data_version_changed = False
+        self.__next_data_version_check = 0
+
+    def __connect(self, read_only=True):
+        """ Opens a new connection that may be closed from any thread.
+
+            Rows are returned as sqlite3.Row, which can be read by column
+            name or unpacked with ** straight into object constructors.
+            HEXBLOB columns are read back as hex strings.
+        """
+        connection = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE)
+        connection.row_factory = decode_row
+
+        for pragma in self.config.pragmas():
+            connection.execute(pragma)
+
+        if read_only:
+            connection.execute('PRAGMA query_only = ON')
+
+        return connection
+
+    def is_stale(self):
+        """ Checks if the file this manager was opened on has been removed
+            or replaced since.
+        """
+        try:
+            return os.stat(self.path).st_ino != self.__inode
+        except OSError:
+            return True
+
+    def data_changed(self):
+        """ Checks if a connection other than the writer, such as one of
+            another process writing to the same file, committed since the
+            last call. True once per change, so only one caller reloads
+            what it cached.
+
+            The file is checked at most once every DATA_VERSION_INTERVAL
+            seconds, calls in between return False unless a commit of the
+            writer found a change first.
+
+            Always False for the thread holding the writer, its reads see
+            its own uncommitted changes, which must not be cached.
+        """
+        if self.__writer_thread == threading.current_thread().ident:
+            return False
+
+        if not self.__data_version_changed and time.time() < self.__next_data_version_check:
+            return False
+
+        with self.__watcher_lock:
+            if time.time() >= self.__next_data_version_check:
+                self.__check_data_version()
+
+            changed, self.__data_version_changed = self.__data_version_changed, False
+        return changed
+
+    def __check_data_version(self):
+        """ Flags a change if the data_version of the file moved since
+            it was last read. Called with the watcher lock held.
+        """
+        version = self.__watcher.execute('PRAGMA data_version').fetchone()[0]
+
+        if version != self.__data_version:
+            self.__data_version = version
+            self.__data_version_changed = True
+
+        self.__next_data_version_check = time.time() + DATA_VERSION_INTERVAL
+
+    def __commit(self, connection, wrote):
+        """ Commits the writer connection. If the transaction wrote, the
+            data_version it leaves is recorded, so data_changed() does not
+            report this process' own commits.
+
+            Changes of other connections are looked for first. Once the
+            writer has written it holds the write lock of the file, no one
+            else can commit until it does.
+        """
+        if not wrote:
+            connection.commit()
+            return
+
+        with self.__watcher_lock:
+            self.__check_data_version()
+            connection.commit()
+            self.__data_version = self.__watcher.execute('PRAGMA data_version').fetchone()[0]
+
+    @contextlib.contextmanager
+    def writing(self):
+        """ Context manager holding the writer connection for the calling
+            thread. Reads issued by the same thread while inside it are
+            served by the writer so they see uncommitted changes.
+        """
+        with self.write_lock:
+            outer = self.__writer_thread
+            self.__writer_thread = threading.current_thread().ident
+            try:
+                yield self.writer
+            finally:
+                self.__writer_thread = outer
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Context manager grouping every write issued by the calling
+            thread inside it in one sqlite transaction.
+
+            Transactions can be nested, only the outermost one commits.
+            If an exception escapes the outermost one every write is
+            rolled back, so no partial data reaches the file, and the
+            callbacks given to on_rollback() undo what was written
+            outside of it.
+
+            Raises
+            ------
+                RuntimeError:
+                    if a rollback callback failed, once every other one
+                    ran, with the exception that made the transaction
+                    roll back as its __cause__.
+        """
+        with self.writing() as connection:
+            self.__transaction_depth += 1
+            changes = connection.total_changes
+            committed = False
+            error = None
+
+            try:
+                yield connection
+                committed = True
+            except BaseException:
+                error = sys.exc_info()
+                raise
+            finally:
+                self.__transaction_depth -= 1
+
+                if self.__transaction_depth == 0:
+                    callbacks, self.__on_commit = self.__on_commit, []
+                    rollbacks, self.__on_rollback = self.__on_rollback, []
+
+                    if committed:
+                        try:
+                            self.__commit(connection, connection.total_changes != changes)
+                        except Exception:
+                            error = sys.exc_info()
+                            connection.rollback()
+                            self.__rolled_back(rollbacks, error)
+                            raise error[0], error[1], error[2]
+
+                        for callback in callbacks:
+                            callback()
+                    else:
+                        connection.rollback()
+                        self.__rolled_back(rollbacks, error)
+
+    def __rolled_back(self, rollbacks, error):
+        """ Runs the rollback callbacks, the last registered first, then
+            raises what they raised chained onto error, the exception that
+            made the transaction roll back, as returned by sys.exc_info().
+        """
+        failures = []
+
+        for callback in reversed(rollbacks):
+            try:
+                callback()
+            except Exception:
+                failures.append(sys.exc_info())
+
+        if failures:
+            cause = error[1] if error else None
+            rollback_error = RuntimeError('Rollback left writes behind after {!r}: {}'.format(
+                cause, '; '.join(repr(failure[1]) for failure in failures)))
+            rollback_error.__cause__ = cause
+            raise rollback_error, None, failures[0][2]
+
+    def after_commit(self, callback):
+        """ Runs callback once the current transaction commits, or right
+            away outside of a transaction. Dropped if it rolls back.
+
+            Used to update in memory structures only with data that has
+            reached the file.
+        """
+        with self.write_lock:
+            if self.__transaction_depth > 0:
+                self.__on_commit.append(callback)
+                return
+
+        callback()
+
+    def on_rollback(self, callback):
+        """ Runs callback if the current transaction rolls back, dropped
+            once it commits or outside of a transaction.
+
+            Used to undo writes made outside of sqlite, such as appends
+            to the block files.
+        """
+        with self.write_lock:
+            if self.__transaction_depth > 0:
+                self.__on_rollback.append(callback)
+
+    @contextlib.contextmanager
+    def reading(self):
+        """ Context manager yielding a connection suitable for reads in
+            the calling thread.
+        """
+        ident = threading.current_thread().ident
+
+        if self.__writer_thread == ident:
+            yield self.writer
+            return
+
+        connection = self.__reader(ident)
+
+        if connection is None:
+            with self.writing() as connection:
+                yield connection
+            return
+
+        yield connection
+
+    def __reader(self, ident):
+        """ Returns the read connection owned by thread ident. A thread
+            without one is handed an idle connection, or a new one if the
+            pool still has room. When it is full the connections owned by
+            threads that are no longer alive are reclaimed first, then it
+            waits for one to be released. None if none was in time.
+        """
+        deadline = time.time() + READ_CONNECTION_WAIT
+
+        with self.__readers_lock:
+            connection = self.__readers.get(ident)
+
+            if connection is not None:
+                return connection
+
+            while not self.__idle_readers and len(self.__readers) >= self.max_readers:
+                alive = set(thread.ident for thread in threading.enumerate())
+
+                for owner in list(self.__readers):
+                    if owner not in alive:
+                        self.__idle_readers.append(self.__readers.pop(owner))
+
+                remaining = deadline - time.time()
+
+                if self.__idle_readers or remaining <= 0:
+                    break
+
+                self.__reader_released.wait(min(remaining, READ_CONNECTION_POLL))
+
+            if self.__idle_readers:
+                connection = self.__idle_readers.pop()
+            elif len(self.__readers) < self.max_readers:
+                connection = self.__connect()
+                self.__opened_readers += 1
+            else:
+                return None
+
+            self.__readers[ident] = connection
+            return connection
+
+    def release(self):
+        """ Gives the read connection of the calling thread back to the
+            pool. To be called by short lived threads once they are done
+            reading, it must not be called inside reading().
+        """
+        ident = threading.current_thread().ident
+
+        with self.__readers_lock:
+            connection = self.__readers.pop(ident, None)
+
+            if connection is not None:
+                self.__idle_readers.append(connection)
+                self.__reader_released.notify()
+
+    def pool_stats(self):
+        """ Returns the number of read connections owned by a thread, idle
+            in the pool and opened since the manager was created.
+        """
+        with self.__readers_lock:
+            return {
+                'owned': len(self.__readers),
+                'idle': len(self.__idle_readers),
+                'opened': self.__opened_readers,
+            }
+
+    def close(self):
+        """ Closes every connection held by this manager.
+        """
+        with self.__readers_lock:
+            for connection in self.__readers.values() + self.__idle_readers:
+                connection.close()
+            self.__readers = {}
+            self.__idle_readers = []
+
+        with self.write_lock:
+            self.writer.close()
+
+        with self.__watcher_lock:
+            self.__watcher.close()
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def explain_query_plan(path, sql, parameters=()):
+    """ Returns the lines of the query plan sqlite picks for a statement.
+
+        It runs on a connection of its own, EXPLAIN would commit the open
+        transaction of the writer connection.
+    """
+    connection = sqlite3.connect(path)
+
+    try:
+        return [row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+    finally:
+        connection.close()
+
+
+def release_readers():
+    """ Gives the read connections of the calling thread back to the pool
+        of every database file, see ConnectionManager.release().
+    """
+    with _managers_lock:
+        managers = list(_managers.values())
+
+    for manager in managers:
+        manager.release()
+
+
+def remove_journal(path):
+    """ Removes the WAL and shared memory files of a database file.
+
+        Only safe when the database file itself does not exist, a WAL
+        left behind by a removed database must not be replayed into a
+        new file created with the same name.
+    """
+    for suffix in ['-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def get_connection_manager(path, config=None):
+    """ Returns the process-wide ConnectionManager for a sqlite file,
+        creating it the first time the file is used. config is only
+        used when the manager is created.
+
+        If the file was deleted or replaced after its manager was created,
+        the old connections are closed and a new manager is returned.
+    """
+    with _managers_lock:
+        manager = _managers.get(path)
+
+        if manager is not None and manager.is_stale():
+            manager.close()
+            manager = None
+
+        if manager is None:
+            if not os.path.exists(path):
+                remove_journal(path)
+
+            manager = ConnectionManager(path, config)
+            _managers[path] = manager
+
+        return manager
+
+
+def migrate(data_dir=None, file_name=None):
+    """ Converts a database file to SCHEMA_VERSION and compacts it.
+
+        Opening a database already converts it, this also runs VACUUM so
+        the file shrinks to the size of the new schema.
+
+        Returns
+        -------
+            sizes: tuple
+                size of the file in bytes before and after.
+    """
+    path = sqlite_file_name(data_dir, file_name)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    return size, Database(data_dir=data_dir, file_name=file_name).vacuum()
 
 
 class Database(object):
 
     """ Database Object for generic table generation
+
+        Connections are not owned by this object, they are drawn from the
+        process-wide ConnectionManager of the sqlite file, so creating a
+        Database is cheap and the schema is only checked once per file.
+
+        A StorageConfig can be given to tune the sqlite connections, if
+        None the one set with configure() is used.
+
+        Concurrency
+        -----------
+        A Database object holds no connection, it can be shared by any
+        number of threads.
+
+        Reads run on a read connection owned by the calling thread, taken
+        from the bounded pool of the ConnectionManager on its first read.
+        Threads never share a read connection, so they read in parallel,
+        and with the WAL journal mode they only see committed data while a
+        write is in progress. Queries return lists of rows, no cursor or
+        connection ever leaves the thread that used it. Threads serving a
+        single request, such as the node handlers, should call
+        release_readers() once done so the next one reuses their
+        connection. When every pooled connection is owned by a live
+        thread, a read waits for one to be released, and after
+        READ_CONNECTION_WAIT seconds goes through the writer connection.
+
+        Writes are serialized on the single writer connection. Reads made
+        by a thread inside transaction() go through the writer and see the
+        rows it has not committed yet. The header index and the caches
+        are only updated once a transaction commits.
     """
 
-    def __init__(self, data_dir=None, file_name=None):
+    def __init__(self, data_dir=None, file_name=None, config=None):
 
         if data_dir is None:
             data_dir = util.default_data_directory()
@@ -27,8 +710,55 @@ class Database(object):
         if not os.path.exists(self.__data_dir):
             os.makedirs(self.__data_dir)
 
-        self.__connection = sqlite3.connect(self.__get_sqlite_file_name())
-        self.__initialize_database()
+        self.__manager = get_connection_manager(self.__get_sqlite_file_name(), config)
+        self.__block_files = None
+
+        if self.__manager.config.block_files:
+            self.__block_files = blockfile.get_block_file_store(
+                '{}-blocks'.format(self.__get_sqlite_file_name()))
+
+        if self.__manager.config.read_only:
+            self.__manager.initialized = True
+
+        if not self.__manager.initialized:
+            with self.__manager.writing():
+                if not self.__manager.initialized:
+                    self.__initialize_database()
+                    self.__manager.initialized = True
+
+    def transaction(self):
+        """ Returns a context manager that groups every write made inside
+            it by the calling thread in one sqlite transaction, see
+            ConnectionManager.transaction().
+        """
+        return self.__manager.transaction()
+
+    def is_current(self):
+        """ Checks if the connection manager of this object is still the
+            one of its file, it is replaced once the file is removed or
+            replaced, see get_connection_manager().
+        """
+        with _managers_lock:
+            manager = _managers.get(self.__get_sqlite_file_name())
+
+        return manager is self.__manager and not manager.is_stale()
+
+    def vacuum(self):
+        """ Rebuilds the database file without its free pages, which
+            returns to the filesystem the space left by a migration or by
+            deleted rows.
+
+            Returns
+            -------
+                size: int
+                    size of the file in bytes once compacted.
+        """
+        with self.__manager.writing() as connection:
+            connection.commit()
+            self.__write(connection, 'VACUUM')
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        return os.path.getsize(self.__get_sqlite_file_name())
 
     def __initialize_database(self):
         """ Initializes the database in case it is the first time running indiecoin.
@@ -42,23 +772,137 @@ class Database(object):
 
             The create table function creates the table if they don't exist, then we
             check if the genesis block exists, if it doesn't we inser it.
-        """
-        path = os.path.dirname(os.path.abspath(__file__))
 
-        with open(os.path.join(path, 'genesis/database.json')) as database_definition_file:
-            database_definition = json.load(database_definition_file)
+            Indexes are created after the tables, this also upgrades databases
+            created before an index was added to the definition. In the same
+            way the unspent output set is built from the stored transactions
+            if it is empty.
 
-        with open(os.path.join(path, 'genesis/genesis.json')) as genesis_data_file:
+            The version of the schema is kept in PRAGMA user_version, files
+            created before SCHEMA_VERSION are converted first, see
+            __migrate_tables().
+        """
+        with open(os.path.join(GENESIS_PATH, 'genesis.json')) as genesis_data_file:
             genesis_data = json.load(genesis_data_file)
 
-        for table in database_definition:
+        tables = self.__get_table_names()
+
+        if not tables:
+            self.__execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        elif self.__query('PRAGMA user_version')[0][0] < SCHEMA_VERSION:
+            self.__migrate_tables(tables)
+
+        for table in DATABASE_DEFINITION:
             self.__create_table(table)
+            self.__create_indexes(table)
 
         genesis_block = self.__get_block(genesis_data['block']['hash'])
 
         if len(genesis_block) == 0:
-            for table, data in genesis_data.iteritems():
-                self.__insert(table, data)
+            with self.__manager.transaction():
+                for table, data in genesis_data.iteritems():
+                    self.__insert(table, data)
+
+        if not self.__query('SELECT 1 FROM unspent_output LIMIT 1'):
+            self.__rebuild_unspent_outputs()
+
+    def __get_table_names(self):
+        """ Returns the names of the tables of the database file.
+        """
+        return set(row['name'] for row in self.__query('SELECT name FROM sqlite_master WHERE type = "table"'))
+
+    def __migrate_tables(self, tables):
+        """ Converts the tables of a file created before SCHEMA_VERSION.
+
+            Version 2 stores hashes, public keys and signatures as raw
+            bytes in HEXBLOB columns instead of hex text, and indexes and
+            amounts as integers. Each table is renamed, created again from
+            the definition and its rows copied over. Everything runs in
+            one sqlite transaction, on error the file is left untouched.
+            The indexes are created again by __initialize_database().
+
+            Raises
+            ------
+                ValueError:
+                    if a stored hash, key or signature is not hex.
+        """
+        with self.__manager.writing() as connection:
+            connection.commit()
+            isolation_level = connection.isolation_level
+            connection.isolation_level = None
+            connection.execute('PRAGMA legacy_alter_table = ON')
+
+            try:
+                connection.execute('BEGIN')
+
+                for table in DATABASE_DEFINITION:
+                    table_name = table[TABLE_NAME]
+
+                    if table_name in tables:
+                        self.__migrate_table(connection, table)
+
+                connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            finally:
+                connection.execute('PRAGMA legacy_alter_table = OFF')
+                connection.isolation_level = isolation_level
+
+    def __migrate_table(self, connection, table_data):
+        """ Copies a table into a new one built from its definition,
+            converting its HEXBLOB columns. See __migrate_tables().
+        """
+        table_name = table_data[TABLE_NAME]
+        old_table = '{}_v1'.format(table_name)
+        self.__write(connection, 'ALTER TABLE {} RENAME TO {}'.format(table_name, old_table))
+        self.__create_table(table_data)
+
+        old_columns = set(row[1] for row in connection.execute('PRAGMA table_info({})'.format(old_table)))
+        columns = [field[FIELD_NAME] for field in table_data[TABLE_FIELDS] if field[FIELD_NAME] in old_columns]
+        hex_columns = HEX_COLUMNS[table_name]
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table_name, ', '.join(columns), ', '.join('?' * len(columns)))
+
+        rows = connection.execute('SELECT {} FROM {}'.format(', '.join(columns), old_table))
+        self.__write(connection, sql, (
+            [to_blob(value) if column in hex_columns else value for column, value in zip(columns, row)]
+            for row in rows), many=True)
+        self.__write(connection, 'DROP TABLE {}'.format(old_table))
+
+    def __rebuild_unspent_outputs(self):
+        """ Fills the unspent output set from every stored output that is
+            not referenced by a stored input, and flags the others as spent.
+
+            The index of an output is its position inside its transaction.
+        """
+        sql = ('SELECT ic_transaction.hash, transaction_output.id_transaction, '
+               'transaction_output.amount, transaction_output.public_key_owner '
+               'FROM transaction_output JOIN ic_transaction '
+               'ON transaction_output.id_transaction = ic_transaction.id '
+               'ORDER BY transaction_output.id')
+        spent = set(
+            (row['hash_transaction'], int(row['prev_out_index']))
+            for row in self.__query('SELECT hash_transaction, prev_out_index FROM transaction_input'))
+
+        unspent = []
+        indexes = {}
+
+        for row in self.__query(sql):
+            index = indexes.get(row['id_transaction'], 0)
+            indexes[row['id_transaction']] = index + 1
+
+            if (row['hash'], index) not in spent:
+                unspent.append({
+                    'hash_transaction': row['hash'],
+                    'out_index': index,
+                    'amount': row['amount'],
+                    'public_key_owner': row['public_key_owner']})
+
+        with self.__manager.transaction():
+            self.__insert_many('unspent_output', unspent)
+            self.__spend_outputs(list(spent))
 
     def __create_table(self, table_data):
         """ Creates a databsae table.
@@ -78,6 +922,27 @@ class Database(object):
         sql = '{});'.format(sql[:-2])
         self.__execute(sql)
 
+    def __create_indexes(self, table_data):
+        """ Creates the indexes of a table if they don't exist yet.
+
+            Creating them on every start is an idempotent migration for
+            databases built with an older definition. If a unique index
+            can't be built because the table already holds duplicates, a
+            non unique index is created instead so lookups stay indexed.
+        """
+        for index in table_data.get(INDEXES, []):
+            columns = ', '.join(index[INDEX_COLUMNS])
+            sql = 'CREATE {}INDEX IF NOT EXISTS {} ON {} ({});'
+
+            if index.get(INDEX_UNIQUE, False):
+                try:
+                    self.__execute(sql.format('UNIQUE ', index[INDEX_NAME], table_data[TABLE_NAME], columns))
+                    continue
+                except sqlite3.IntegrityError:
+                    pass
+
+            self.__execute(sql.format('', index[INDEX_NAME], table_data[TABLE_NAME], columns))
+
     def __insert(self, table_name, data):
         """ Inserts dictionary data into a column.
 
@@ -91,78 +956,382 @@ class Database(object):
                 dictionary where key represents column name
                 and value actual data.
 
+            Notes
+            ------
+                The row is committed right away unless the call is made
+                inside __transaction(), then it is committed with it.
+                Hashes, keys and signatures are given as hex and stored as
+                bytes, see to_blob().
         """
+        data = encode_row(table_name, data)
         columns = ', '.join(data.keys())
         placeholders = ', '.join('?' * len(data))
         sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table_name, columns, placeholders)
-        cursor = self.__connection.cursor()
-        cursor.execute(sql, data.values())
-        self.__connection.commit()
+
+        with self.__manager.transaction() as connection:
+            cursor = self.__write(connection, sql, data.values())
         return cursor.lastrowid
 
+    def __insert_many(self, table_name, rows):
+        """ Inserts a list of dictionaries into a table with a single
+            executemany.
+
+            Parameters:
+            ----------
+
+            table_name : string
+                name of table into where insert data
+
+            rows : list
+                list of dictionaries sharing the same keys, where
+                each key represents a column name.
+        """
+        if not rows:
+            return
+
+        columns = rows[0].keys()
+        hex_columns = HEX_COLUMNS.get(table_name, ())
+        placeholders = ', '.join('?' * len(columns))
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table_name, ', '.join(columns), placeholders)
+
+        values = [
+            [to_blob(row[column]) if column in hex_columns else row[column] for column in columns]
+            for row in rows]
+
+        with self.__manager.transaction() as connection:
+            self.__write(connection, sql, values, many=True)
+
+    def __spend_outputs(self, outpoints):
+        """ Removes outputs from the unspent output set and flags their
+            transaction_output row as spent, and their address index row
+            if the index is enabled.
+
+            Parameters:
+            ----------
+
+            outpoints : list
+                list of (hash_transaction, out_index) tuples.
+
+            Returns
+            -------
+                spent: int
+                    number of outputs that were removed from the set.
+        """
+        if not outpoints:
+            return 0
+
+        sql = ('UPDATE transaction_output SET unspent = 0 WHERE id = ('
+               'SELECT transaction_output.id FROM transaction_output JOIN ic_transaction '
+               'ON transaction_output.id_transaction = ic_transaction.id '
+               'WHERE ic_transaction.hash = ? ORDER BY transaction_output.id LIMIT 1 OFFSET ?)')
+
+        outpoints = [(to_blob(hash_transaction), out_index) for hash_transaction, out_index in outpoints]
+
+        with self.__manager.transaction() as connection:
+            spent = self.__write(
+                connection, 'DELETE FROM unspent_output WHERE hash_transaction = ? AND out_index = ?',
+                outpoints, many=True).rowcount
+            self.__write(connection, sql, outpoints, many=True)
+
+            if self.__manager.config.address_index:
+                self.__write(
+                    connection, 'UPDATE address_output SET unspent = 0 WHERE hash_transaction = ? AND out_index = ?',
+                    outpoints, many=True)
+
+        return spent
+
+    def __store_block_bytes(self, block_hash, height, data):
+        """ Appends a serialized block to the block files and records
+            where it was written. Does nothing if block files are not
+            enabled in the storage config.
+
+            The files are synced once the transaction commits, whatever
+            the number of blocks it saves, and the block is dropped from
+            them if it rolls back.
+        """
+        if self.__block_files is None:
+            return
+
+        file_number, offset, length = self.__block_files.append(data)
+        self.__manager.on_rollback(lambda: self.__block_files.truncate(file_number, offset))
+        self.__manager.after_commit(self.__block_files.sync)
+        self.__insert('block_file', {
+            'hash': block_hash,
+            'height': height,
+            'file_number': file_number,
+            'offset': offset,
+            'length': length})
+
+    def __read_block_bytes(self, location):
+        """ Reads a serialized block from the block files given the rows
+            of its location, returns None if there are none.
+        """
+        if self.__block_files is None or not location:
+            return None
+
+        location = location[0]
+        return self.__block_files.read(location['file_number'], location['offset'], location['length'])
+
+    def __shared(self, name, factory):
+        """ Returns the object kept under name in the caches of the
+            connection manager, calling factory to build it the first
+            time, so it is shared by every Database of the same file.
+        """
+        value = self.__manager.caches.get(name)
+
+        if value is None:
+            with self.__manager.writing():
+                value = self.__manager.caches.get(name)
+
+                if value is None:
+                    value = factory()
+                    self.__manager.caches[name] = value
+        return value
+
+    def __transaction(self):
+        """ Returns a context manager that groups every write made inside
+            it in one sqlite transaction, committed once on exit.
+        """
+        return self.__manager.transaction()
+
     def __execute(self, sql, data=None):
         """ Executes an sql command in the database.
         """
-        cursor = self.__connection.cursor()
-        cursor.execute(sql)
-
-    def dict_factory(cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+        with self.__manager.writing() as connection:
+            self.__write(connection, sql)
 
     def __get_block(self, block_hash):
         """ Retrieves a block from the database with a hash.
         """
-        sql = 'SELECT * FROM block WHERE hash = "{}";'.format(block_hash)
-        return self.__query(sql)
+        return self.__query('SELECT * FROM block WHERE hash = ?', (hex_parameter(block_hash),))
 
     def __get_block_height(self, height):
-        sql = 'SELECT * FROM block WHERE height = "{}";'.format(height)
-        return self.__query(sql)
+        return self.__query('SELECT * FROM block WHERE height = ?', (height,))
 
     def __get_transactions_block(self, block_hash):
-        """ Retrieves a transaction from the database.
+        """ Retrieves the transactions of a block from the database.
         """
-        sql = 'SELECT * FROM ic_transaction WHERE block_hash = "{}"'.format(block_hash)
-        return self.__query(sql)
+        return self.__query('SELECT * FROM ic_transaction WHERE block_hash = ? ORDER BY id', (hex_parameter(block_hash),))
 
     def __get_transaction(self, hash):
         """ Retrieves a transaction from the database.
         """
-        sql = 'SELECT * FROM ic_transaction WHERE hash = "{}"'.format(hash)
-        return self.__query(sql)
+        return self.__query('SELECT * FROM ic_transaction WHERE hash = ?', (hex_parameter(hash),))
+
+    def __get_headers(self):
+        """ Retrieves the header fields of every block that is not orphan.
+        """
+        return self.__query(
+            'SELECT hash, previous_block_hash, height, timestamp, nonce FROM block '
+            'WHERE is_orphan = 0 ORDER BY height')
+
+    def __get_tip(self):
+        """ Retrieves the hash and height of the highest block that is
+            not orphan.
+        """
+        return self.__query(
+            'SELECT hash, height FROM block WHERE is_orphan = 0 ORDER BY height DESC LIMIT 1')
+
+    def __get_transactions_block_hashes(self, hashes):
+        """ Retrieves the hashes of the blocks holding some transactions,
+            MAX_QUERY_PARAMETERS transactions per query so sqlite never
+            gets more parameters than it accepts.
+        """
+        rows = []
+
+        for start in xrange(0, len(hashes), MAX_QUERY_PARAMETERS):
+            chunk = hashes[start:start + MAX_QUERY_PARAMETERS]
+            rows.extend(self.__query(
+                'SELECT DISTINCT block_hash FROM ic_transaction WHERE hash IN ({})'.format(
+                    ', '.join('?' * len(chunk))),
+                tuple(hex_parameter(hash) for hash in chunk)))
+
+        return rows
+
+    def __get_address_outputs(self, owner, offset, limit):
+        """ Retrieves a page of the indexed outputs of an owner, newest first.
+        """
+        return self.__query(
+            'SELECT hash_transaction, out_index, amount, height, unspent FROM address_output '
+            'WHERE owner = ? ORDER BY height DESC, hash_transaction, out_index LIMIT ? OFFSET ?',
+            (hex_parameter(owner), limit, offset))
 
-    def __get_height(self):
-        sql = 'SELECT MAX(height) as height from block where is_orphan = 0'
-        return self.__query(sql)
+    def __get_address_balance(self, owner):
+        """ Retrieves the sum of the indexed unspent outputs of an owner.
+        """
+        return self.__query(
+            'SELECT SUM(amount) as balance FROM address_output WHERE owner = ? AND unspent = 1',
+            (hex_parameter(owner),))
+
+    def __get_chain_state(self, name, default=None):
+        """ Retrieves a value of the chain_state table, default if it
+            was never set.
+        """
+        row = self.__query('SELECT value FROM chain_state WHERE name = ?', (name,))
+        return row[0]['value'] if row else default
+
+    def __set_chain_state(self, name, value):
+        """ Sets a value of the chain_state table.
+        """
+        with self.__manager.transaction() as connection:
+            self.__write(connection, 'INSERT OR REPLACE INTO chain_state (name, value) VALUES (?, ?)', (name, value))
 
     def __get_transaction_inputs(self, trans_id):
         """ Retrieves transaction inputs from a transaction in the database.
         """
-        sql = 'SELECT * FROM transaction_input WHERE id_transaction = {}'.format(trans_id)
-        return self.__query(sql)
+        return self.__query('SELECT * FROM transaction_input WHERE id_transaction = ? ORDER BY id', (trans_id,))
 
     def __get_transaction_outputs(self, trans_id):
         """ Retrieves transaction outputs from a transaction in the database.
         """
-        sql = 'SELECT * FROM transaction_output WHERE id_transaction = {}'.format(trans_id)
-        return self.__query(sql)
+        return self.__query('SELECT * FROM transaction_output WHERE id_transaction = ? ORDER BY id', (trans_id,))
 
-    def __query(self, sql):
-        self.__connection.row_factory = lambda c, r: dict(
-            [(col[0], r[idx]) for idx, col in enumerate(c.description)])
-        cursor = self.__connection.cursor()
-        cursor.execute(sql)
-        data = cursor.fetchall()
-        return data
+    def __get_block_location(self, block_hash):
+        """ Retrieves where a block was written in the block files.
+        """
+        return self.__query('SELECT * FROM block_file WHERE hash = ?', (hex_parameter(block_hash),))
+
+    def __get_unspent_output(self, hash_transaction, out_index):
+        """ Retrieves an output from the unspent output set.
+        """
+        sql = 'SELECT * FROM unspent_output WHERE hash_transaction = ? AND out_index = ?'
+        return self.__query(sql, (hex_parameter(hash_transaction), out_index))
+
+    def __get_output(self, hash_transaction, out_index):
+        """ Retrieves an output, spent or not, by the hash of its
+            transaction and its position inside it.
+        """
+        sql = ('SELECT transaction_output.* FROM transaction_output JOIN ic_transaction '
+               'ON transaction_output.id_transaction = ic_transaction.id '
+               'WHERE ic_transaction.hash = ? ORDER BY transaction_output.id LIMIT 1 OFFSET ?')
+        return self.__query(sql, (hex_parameter(hash_transaction), out_index))
+
+    def __get_spending_transactions(self, hash_transaction, out_index):
+        """ Retrieves the hashes of the stored transactions with an input
+            spending an output.
+        """
+        sql = ('SELECT ic_transaction.hash FROM transaction_input JOIN ic_transaction '
+               'ON transaction_input.id_transaction = ic_transaction.id '
+               'WHERE transaction_input.hash_transaction = ? AND transaction_input.prev_out_index = ?')
+        return self.__query(sql, (hex_parameter(hash_transaction), out_index))
+
+    def __get_block_transaction_inputs(self, block_hash):
+        """ Retrieves the inputs of every transaction of a block at once.
+        """
+        sql = ('SELECT transaction_input.* FROM transaction_input '
+               'JOIN ic_transaction ON transaction_input.id_transaction = ic_transaction.id '
+               'WHERE ic_transaction.block_hash = ? ORDER BY transaction_input.id')
+        return self.__query(sql, (hex_parameter(block_hash),))
+
+    def __get_block_transaction_outputs(self, block_hash):
+        """ Retrieves the outputs of every transaction of a block at once.
+        """
+        sql = ('SELECT transaction_output.* FROM transaction_output '
+               'JOIN ic_transaction ON transaction_output.id_transaction = ic_transaction.id '
+               'WHERE ic_transaction.block_hash = ? ORDER BY transaction_output.id')
+        return self.__query(sql, (hex_parameter(block_hash),))
+
+    def __get_blocks_heights(self, start, end):
+        """ Retrieves the blocks of the best chain with a height between
+            start and end, in order.
+        """
+        return self.__query(
+            'SELECT * FROM block WHERE height BETWEEN ? AND ? AND is_orphan = 0 ORDER BY height', (start, end))
+
+    def __get_transactions_heights(self, start, end):
+        """ Retrieves the transactions of the blocks of the best chain with
+            a height between start and end.
+        """
+        sql = ('SELECT ic_transaction.* FROM ic_transaction '
+               'JOIN block ON ic_transaction.block_hash = block.hash '
+               'WHERE block.height BETWEEN ? AND ? AND block.is_orphan = 0 ORDER BY ic_transaction.id')
+        return self.__query(sql, (start, end))
+
+    def __get_transaction_inputs_heights(self, start, end):
+        """ Retrieves the inputs of the transactions of the blocks of the
+            best chain with a height between start and end.
+
+            The CROSS JOIN keeps sqlite walking the height index first,
+            otherwise it scans the whole table to avoid sorting by id.
+        """
+        sql = ('SELECT transaction_input.* FROM block '
+               'CROSS JOIN ic_transaction ON ic_transaction.block_hash = block.hash '
+               'CROSS JOIN transaction_input ON transaction_input.id_transaction = ic_transaction.id '
+               'WHERE block.height BETWEEN ? AND ? AND block.is_orphan = 0 ORDER BY transaction_input.id')
+        return self.__query(sql, (start, end))
+
+    def __get_transaction_outputs_heights(self, start, end):
+        """ Retrieves the outputs of the transactions of the blocks of the
+            best chain with a height between start and end.
+        """
+        sql = ('SELECT transaction_output.* FROM block '
+               'CROSS JOIN ic_transaction ON ic_transaction.block_hash = block.hash '
+               'CROSS JOIN transaction_output ON transaction_output.id_transaction = ic_transaction.id '
+               'WHERE block.height BETWEEN ? AND ? AND block.is_orphan = 0 ORDER BY transaction_output.id')
+        return self.__query(sql, (start, end))
+
+    def __query(self, sql, parameters=()):
+        """ Runs a SELECT statement with bound parameters.
+
+            Parameters are never formatted into the sql string, so the
+            statement text stays the same between calls and is reused
+            from the connection's statement cache.
+
+            Returns
+            -------
+                rows: list
+                    list of sqlite3.Row
+        """
+        with self.__manager.reading() as connection:
+            start = time.time()
+            rows = connection.execute(sql, parameters).fetchall()
+
+        self.__record(sql, parameters, start, len(rows))
+        return rows
+
+    def __write(self, connection, sql, parameters=(), many=False):
+        """ Runs a statement that changes the database on the connection
+            of the current transaction and records it like __query().
+            With many the statement runs once for each row of parameters.
+
+            Returns
+            -------
+                cursor: sqlite3.Cursor
+                    cursor of the statement, for its rowcount and lastrowid.
+        """
+        start = time.time()
+
+        if many:
+            cursor = connection.executemany(sql, parameters)
+            parameters = parameters[0] if isinstance(parameters, list) and parameters else ()
+        else:
+            cursor = connection.execute(sql, parameters)
+
+        self.__record(sql, parameters, start, max(cursor.rowcount, 0))
+        return cursor
+
+    def __record(self, sql, parameters, start, rows):
+        """ Adds a statement that started running at start to the query
+            stats of the file, logging it with its plan if it was slow.
+        """
+        seconds = time.time() - start
+
+        if self.__manager.query_stats.record(sql, seconds, rows):
+            try:
+                plan = explain_query_plan(self.__get_sqlite_file_name(), sql, parameters)
+            except sqlite3.Error as e:
+                plan = ['no query plan: {}'.format(e)]
+
+            logger.warning('Slow query %.1f ms: %s%s', seconds * 1e3, sql, ''.join('\n    ' + line for line in plan))
+
+    def query_stats(self):
+        """ Returns the counters of every statement run on the database
+            file by their sql, see
+            indiecoin.blockchain.querystats.QueryStats.stats().
+        """
+        return self.__manager.query_stats.stats()
 
     def __get_sqlite_file_name(self):
         """ Returns the complete path to the sqlite database file.
         """
-        file_name = self.__file_name
-
-        if file_name is None:
-            file_name = 'indiecoin.sqlite'
-        return os.path.join(self.__data_dir, file_name)
+        return sqlite_file_name(self.__data_dir, self.__file_name)
@@ -0,0 +1,230 @@
+import binascii
+import struct
+import threading
+
+VERSION = 1
+
+HEADER = struct.Struct('<I32s32sIII')
+PREFIX = struct.Struct('<I32s32sII')
+NONCE = struct.Struct('<I')
+MAX_NONCE = 2 ** 32 - 1
+
+
+def hash_bytes(value):
+    """ Returns the 32 raw bytes of a hex sha256 digest.
+
+        Raises
+        ------
+            ValueError:
+                if value is not a hex sha256 digest.
+    """
+    try:
+        raw = binascii.unhexlify(value)
+    except (TypeError, binascii.Error):
+        raw = ''
+
+    if len(raw) != 32:
+        raise ValueError('Not a sha256 digest: {!r}'.format(value))
+    return raw
+
+
+def is_whole(value):
+    """ Checks that a timestamp, difficulty or nonce is packed as it is,
+        that is empty or a whole number. Fractions would be dropped by
+        pack_header(), so two values would share one header.
+    """
+    if value is None or value == '':
+        return True
+
+    try:
+        return float(value).is_integer()
+    except (TypeError, ValueError):
+        return False
+
+
+def pack_header(previous_block_hash, hash_merkle_root, timestamp, difficulty, nonce):
+    """ Packs the header of a block in its fixed layout of HEADER.size,
+        80, bytes: version, hash of the previous block, merkle root of
+        its transactions, timestamp, difficulty and nonce. The nonce comes
+        last so a miner can pack the rest once, with pack_prefix(), and
+        only append it, with pack_nonce().
+
+        The timestamp is packed in whole seconds, an empty timestamp,
+        difficulty or nonce is packed as 0.
+
+        Raises
+        ------
+            ValueError:
+                if a hash is not a sha256 digest or a field does not fit.
+    """
+    return pack_prefix(previous_block_hash, hash_merkle_root, timestamp, difficulty) + pack_nonce(nonce)
+
+
+def pack_prefix(previous_block_hash, hash_merkle_root, timestamp, difficulty):
+    """ Packs every field of the header but the nonce, see pack_header().
+    """
+    try:
+        return PREFIX.pack(
+            VERSION, hash_bytes(previous_block_hash), hash_bytes(hash_merkle_root),
+            int(float(timestamp or 0)), int(difficulty or 0))
+    except struct.error as e:
+        raise ValueError('Block header field out of range: {}'.format(e))
+
+
+def pack_nonce(nonce):
+    """ Packs the nonce of the header, see pack_header().
+    """
+    try:
+        return NONCE.pack(int(nonce or 0))
+    except struct.error as e:
+        raise ValueError('Block header nonce out of range: {}'.format(e))
+
+
+def unpack_header(data):
+    """ Reads back the fields packed by pack_header(), as a dictionary
+        with its parameters as keys.
+
+        Raises
+        ------
+            ValueError:
+                if data is not a header of a known version.
+    """
+    if len(data) != HEADER.size:
+        raise ValueError('Block header is {} bytes, not {}'.format(len(data), HEADER.size))
+
+    version, previous_block_hash, hash_merkle_root, timestamp, difficulty, nonce = HEADER.unpack(data)
+
+    if version != VERSION:
+        raise ValueError('Unknown block header version {}'.format(version))
+
+    return {
+        'previous_block_hash': binascii.hexlify(previous_block_hash),
+        'hash_merkle_root': binascii.hexlify(hash_merkle_root),
+        'timestamp': timestamp,
+        'difficulty': difficulty,
+        'nonce': nonce,
+    }
+
+
+class BlockHeader(object):
+    """ Header fields of a block, without its transactions.
+
+        Attributes
+        ----------
+            hash: string
+                string representation of sha256 hash digest of block.
+            previous_block_hash: string
+                string representation of sha256 hash digest of previous block.
+            height: int
+                height of block (number of blocks behind it)
+            timestamp: string
+                UNIX time representation of time block was created.
+            nonce: string
+                variable value to change in proof of work.
+    """
+    __slots__ = ['hash', 'previous_block_hash', 'height', 'timestamp', 'nonce']
+
+    def __init__(self, **kwargs):
+        self.hash = kwargs['hash']
+        self.previous_block_hash = kwargs['previous_block_hash']
+        self.height = int(kwargs['height'])
+        self.timestamp = kwargs['timestamp']
+        self.nonce = kwargs['nonce']
+
+    @classmethod
+    def from_block(cls, block):
+        """ Takes the header fields of a Block object.
+        """
+        return cls(
+            hash=block.hash,
+            previous_block_hash=block.previous_block_hash,
+            height=block.height,
+            timestamp=block.timestamp,
+            nonce=block.nonce)
+
+    def serialize(self):
+        """ Returns the header fields as a dictionary.
+        """
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+
+class HeaderIndex(object):
+    """ In memory index of the headers of the best chain.
+
+        Maps height to hash and hash to header, so the tip height, the
+        hash of a block and walks over its ancestors never reach the
+        database. It is loaded once per database file with every block
+        that is not orphan, updated when a block is connected and reloaded
+        when another process moves the tip of the file.
+
+        Attributes
+        ----------
+            tip: indiecoin.blockchain.headers.BlockHeader
+                header with the highest height, None if the index is empty.
+            pruned_height: int
+                height up to which the bodies of the blocks have been
+                pruned, 0 if none was, see indiecoin.blockchain.prune.
+                Their headers are kept.
+    """
+    def __init__(self, headers=(), pruned_height=0):
+        self.tip = None
+        self.pruned_height = pruned_height
+        self.__lock = threading.Lock()
+        self.__headers = {}
+        self.__hashes = {}
+
+        for header in headers:
+            self.add(header)
+
+    def __len__(self):
+        return len(self.__headers)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.__headers
+
+    @property
+    def height(self):
+        """ Height of the tip, None if the index is empty.
+        """
+        tip = self.tip
+        return tip.height if tip is not None else None
+
+    def add(self, header):
+        """ Connects a header to the index, moving the tip if it is higher.
+        """
+        with self.__lock:
+            self.__headers[header.hash] = header
+            self.__hashes[header.height] = header.hash
+
+            if self.tip is None or header.height > self.tip.height:
+                self.tip = header
+
+    def reload(self, headers, pruned_height=0):
+        """ Replaces every header of the index at once, readers see either
+            the old or the new headers, never a mix of them.
+        """
+        index = HeaderIndex(headers, pruned_height)
+
+        with self.__lock:
+            self.__headers, self.__hashes = index.__headers, index.__hashes
+            self.tip, self.pruned_height = index.tip, index.pruned_height
+
+    def get(self, block_hash):
+        """ Returns the header of a block, None if it is not indexed.
+        """
+        return self.__headers.get(block_hash)
+
+    def get_hash(self, height):
+        """ Returns the hash of the block at height, None if there is none.
+        """
+        return self.__hashes.get(height)
+
+    def ancestors(self, block_hash):
+        """ Yields the header of a block followed by the header of each of
+            its ancestors, down to the genesis block.
+        """
+        header = self.__headers.get(block_hash)
+
+        while header is not None:
+            yield header
+            header = self.__headers.get(header.previous_block_hash)
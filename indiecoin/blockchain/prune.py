@@ -0,0 +1,168 @@
+import re
+
+from .database import Database, PRUNED_HEIGHT
+from . import block
+
+MIN_PRUNE_DEPTH = 100
+PRUNE_BATCH_BLOCKS = 50
+PRUNE_INTERVAL = 10
+
+TARGET_PATTERN = re.compile(r'^(\d+)\s*(MB)?$', re.IGNORECASE)
+
+
+def parse_target(value):
+    """ Parses the value of --prune, a number of blocks to keep, at least
+        MIN_PRUNE_DEPTH, or a size in megabytes such as 550MB.
+
+        Returns
+        -------
+            target: tuple
+                (prune_blocks, prune_bytes), one of them None.
+
+        Raises
+        ------
+            ValueError:
+                if value is neither, or keeps less than MIN_PRUNE_DEPTH
+                blocks.
+    """
+    match = TARGET_PATTERN.match(value.strip())
+
+    if match is None:
+        raise ValueError('Prune target must be a number of blocks or of MB: {}'.format(value))
+
+    if match.group(2):
+        return None, int(match.group(1)) * 1024 * 1024
+
+    if int(match.group(1)) < MIN_PRUNE_DEPTH:
+        raise ValueError('Prune target must keep at least {} blocks: {}'.format(MIN_PRUNE_DEPTH, value))
+    return int(match.group(1)), None
+
+
+class Database(Database):
+    """ Database Object that prunes the history of the chain.
+
+        Pruning a block deletes the inputs, the outputs and the
+        transactions of its body, and its copy in the block files. Its
+        header is kept, and so are the outputs still unspent, which live
+        in the unspent_output table. The address index is kept as it was.
+
+        Blocks are pruned from the bottom of the chain, so the bodies
+        pruned are the ones up to a height, kept as pruned_height in the
+        chain_state table and in the header index. The MIN_PRUNE_DEPTH
+        blocks below the tip are never pruned.
+
+        The target comes from the StorageConfig, prune_blocks keeps that
+        many blocks below the tip and prune_bytes prunes until the
+        database holds less than that many bytes. Deleted rows leave free
+        pages that sqlite reuses, the file itself does not shrink.
+
+        Attributes
+        ----------
+            blocks: indiecoin.blockchain.block.Database
+                database of the blocks being pruned.
+    """
+    def __init__(self, file_name=None, config=None):
+        super(Database, self).__init__(file_name=file_name, config=config)
+        self.blocks = block.Database(file_name=file_name, config=config)
+
+    def prune(self):
+        """ Prunes up to the target of the config, in batches of
+            PRUNE_BATCH_BLOCKS blocks each committed on its own. The
+            writer is released between batches, so saving a block never
+            waits for more than one batch.
+
+            Returns
+            -------
+                pruned: int
+                    number of block heights pruned.
+        """
+        pruned = 0
+        step = self.prune_step()
+
+        while step:
+            pruned += step
+            step = self.prune_step()
+
+        return pruned
+
+    def prune_step(self):
+        """ Prunes the next batch of blocks if the target is not reached.
+
+            Returns
+            -------
+                pruned: int
+                    number of block heights pruned, 0 once there is
+                    nothing left to prune.
+        """
+        with self.__manager.writing():
+            start = self.blocks.headers.pruned_height + 1
+            end = min(self.__target_height(), start + PRUNE_BATCH_BLOCKS - 1)
+
+            if end < start:
+                return 0
+
+            self.__prune_blocks(start, end)
+            return end - start + 1
+
+    def __target_height(self):
+        """ Returns the height up to which blocks should be pruned.
+        """
+        config = self.__manager.config
+        height = self.blocks.get_height() or 0
+        deepest = height - max(config.prune_blocks or 0, MIN_PRUNE_DEPTH)
+
+        if config.prune_blocks is not None:
+            return deepest
+
+        if config.prune_bytes is not None and self.__used_bytes() > config.prune_bytes:
+            return deepest
+
+        return 0
+
+    def __used_bytes(self):
+        """ Returns the bytes of the database file holding data, without
+            its free pages.
+        """
+        page_size = self.__query('PRAGMA page_size')[0][0]
+        page_count = self.__query('PRAGMA page_count')[0][0]
+        free_pages = self.__query('PRAGMA freelist_count')[0][0]
+        return (page_count - free_pages) * page_size
+
+    def __prune_blocks(self, start, end):
+        """ Deletes the bodies of the blocks with a height between start
+            and end in one transaction. The caches and the header index
+            are updated once it commits.
+        """
+        block_hashes = [row['hash'] for row in self.__query(
+            'SELECT hash FROM block WHERE height BETWEEN ? AND ?', (start, end))]
+        transactions = self.__query(
+            'SELECT ic_transaction.id, ic_transaction.hash FROM ic_transaction JOIN block '
+            'ON ic_transaction.block_hash = block.hash WHERE block.height BETWEEN ? AND ?', (start, end))
+        ids = [(row['id'],) for row in transactions]
+        block_files = [row['file_number'] for row in self.__query(
+            'SELECT file_number FROM block_file GROUP BY file_number HAVING MAX(height) <= ?', (end,))]
+
+        with self.__manager.transaction() as connection:
+            self.__write(connection, 'DELETE FROM transaction_input WHERE id_transaction = ?', ids, many=True)
+            self.__write(connection, 'DELETE FROM transaction_output WHERE id_transaction = ?', ids, many=True)
+            self.__write(connection, 'DELETE FROM ic_transaction WHERE id = ?', ids, many=True)
+            self.__write(connection, 'DELETE FROM block_file WHERE height BETWEEN ? AND ?', (start, end))
+            self.__set_chain_state(PRUNED_HEIGHT, end)
+
+            self.__manager.after_commit(
+                lambda: self.__pruned(end, block_hashes, [row['hash'] for row in transactions], block_files))
+
+    def __pruned(self, height, block_hashes, transaction_hashes, block_files):
+        """ Forgets the pruned blocks once their deletion is committed.
+        """
+        self.blocks.headers.pruned_height = height
+
+        for block_hash in block_hashes:
+            self.blocks.cache.invalidate(block_hash)
+
+        for transaction_hash in transaction_hashes:
+            self.blocks.transactions.cache.invalidate(transaction_hash)
+
+        if self.__block_files is not None:
+            for file_number in block_files:
+                self.__block_files.remove(file_number)
@@ -0,0 +1,112 @@
+import collections
+import threading
+
+LATENCY_SAMPLES = 1024
+
+
+class StatementStats(object):
+    """ Counters of one sql statement.
+
+        Attributes
+        ----------
+            count: int
+                number of times it ran.
+            seconds: float
+                time spent running it.
+            rows: int
+                rows it returned, or wrote for inserts.
+            latencies: collections.deque
+                the last LATENCY_SAMPLES latencies in seconds, the
+                percentiles are computed over them.
+    """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def percentile(self, percent):
+        """ Returns a percentile of the recent latencies in seconds.
+        """
+        if not self.latencies:
+            return 0.0
+
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * percent / 100.0), len(latencies) - 1)]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': self.seconds * 1e3,
+            'rows': self.rows,
+            'p50_ms': self.percentile(50) * 1e3,
+            'p99_ms': self.percentile(99) * 1e3,
+        }
+
+
+class QueryStats(object):
+    """ Counters of every sql statement run on a database file, kept by
+        its ConnectionManager and filled by Database.__query(),
+        __insert(), __insert_many() and __execute().
+
+        Statements are told apart by their text, which holds no values
+        since parameters are always bound.
+
+        Attributes
+        ----------
+            slow_query_ms: float
+                statements slower than this many milliseconds are slow,
+                None to never consider one slow.
+    """
+    def __init__(self, slow_query_ms=None):
+        self.slow_query_ms = slow_query_ms
+        self.__statements = {}
+        self.__lock = threading.Lock()
+
+    def record(self, sql, seconds, rows):
+        """ Adds a run of a statement.
+
+            Returns
+            -------
+                slow: boolean
+                    True if it was slower than slow_query_ms.
+        """
+        with self.__lock:
+            statement = self.__statements.get(sql)
+
+            if statement is None:
+                statement = self.__statements[sql] = StatementStats()
+
+            statement.count += 1
+            statement.seconds += seconds
+            statement.rows += rows
+            statement.latencies.append(seconds)
+
+        return self.slow_query_ms is not None and seconds * 1e3 >= self.slow_query_ms
+
+    def stats(self):
+        """ Returns the counters of each statement by its sql, as
+            dictionaries with count, total_ms, rows, p50_ms and p99_ms.
+        """
+        with self.__lock:
+            return dict((sql, statement.to_dict()) for sql, statement in self.__statements.items())
+
+    def reset(self):
+        with self.__lock:
+            self.__statements = {}
+
+
+def format_stats(stats, limit=None):
+    """ Formats the counters returned by QueryStats.stats() as a table,
+        the statements taking the most time first.
+    """
+    lines = ['{:>8} {:>12} {:>10} {:>10} {:>10}  {}'.format(
+        'count', 'total ms', 'p50 ms', 'p99 ms', 'rows', 'sql')]
+    statements = sorted(stats.items(), key=lambda item: item[1]['total_ms'], reverse=True)
+
+    for sql, statement in statements[:limit]:
+        lines.append('{:>8} {:>12.1f} {:>10.3f} {:>10.3f} {:>10}  {}'.format(
+            statement['count'], statement['total_ms'], statement['p50_ms'],
+            statement['p99_ms'], statement['rows'], sql))
+
+    return '\n'.join(lines)
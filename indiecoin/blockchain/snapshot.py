@@ -0,0 +1,329 @@
+import binascii
+import hashlib
+import sqlite3
+import struct
+
+from ..util.hash import sha256, merkle_root
+from .database import Database, PRUNED_HEIGHT, to_blob
+from .headers import BlockHeader, HEADER, pack_header, unpack_header
+from .addressindex import owner_hash
+from . import block
+
+SNAPSHOT_HEIGHT = 'snapshot_height'
+SNAPSHOT_MAGIC = 'ICSN'
+SNAPSHOT_VERSION = 2
+
+SNAPSHOT_HEADER = struct.Struct('<4sBI')
+HEADER_RECORD = struct.Struct('<32s{}s'.format(HEADER.size))
+OUTPUT_RECORD = struct.Struct('<32sIq')
+LENGTH = struct.Struct('<H')
+CHECKSUM_SIZE = 32
+
+RECORD_HEADER = 'H'
+RECORD_OUTPUT = 'U'
+RECORD_END = 'E'
+
+
+class SnapshotWriter(object):
+    """ Writes a snapshot to a stream record by record.
+
+        A snapshot starts with SNAPSHOT_HEADER, the magic string, the
+        version and the height of the chain. It is followed by a record
+        per header, the hash of the block and its 80 bytes header, see
+        indiecoin.blockchain.headers.pack_header(), from the genesis block
+        to the tip, then a record per unspent output. Each record starts with its type, one character.
+        The end record holds the sha256 of every byte written before it.
+
+        Hashes and keys are written as raw bytes, numbers little endian
+        and strings prefixed by their length.
+
+        Attributes
+        ----------
+            stream: file
+                file-like object open for writing in binary mode.
+            height: int
+                height of the chain in the snapshot.
+    """
+    def __init__(self, stream, height):
+        self.stream = stream
+        self.height = height
+        self.__checksum = hashlib.sha256()
+        self.__write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, height))
+
+    def __write(self, data):
+        self.__checksum.update(data)
+        self.stream.write(data)
+
+    def write_header(self, block_hash, header):
+        """ Writes the header of a block, its hash as 32 raw bytes.
+        """
+        self.__write(RECORD_HEADER + HEADER_RECORD.pack(block_hash, header))
+
+    def write_output(self, hash_transaction, out_index, amount, public_key_owner):
+        """ Writes an unspent output, hash and key as raw bytes.
+        """
+        self.__write(
+            RECORD_OUTPUT + OUTPUT_RECORD.pack(hash_transaction, out_index, amount) +
+            pack_string(public_key_owner))
+
+    def close(self):
+        """ Writes the end record with the checksum of the snapshot.
+        """
+        self.__write(RECORD_END)
+        self.stream.write(self.__checksum.digest())
+
+
+class SnapshotReader(object):
+    """ Reads a snapshot written by SnapshotWriter from a stream, record
+        by record, checking the checksum once the end record is read.
+
+        Attributes
+        ----------
+            stream: file
+                file-like object open for reading in binary mode.
+            height: int
+                height of the chain in the snapshot.
+
+        Raises
+        ------
+            ValueError:
+                if the stream is not a snapshot or is corrupt.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.__checksum = hashlib.sha256()
+        magic, version, self.height = SNAPSHOT_HEADER.unpack(self.__read(SNAPSHOT_HEADER.size))
+
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Not an indiecoin snapshot')
+
+    def __read(self, size):
+        data = self.stream.read(size)
+
+        if len(data) != size:
+            raise ValueError('Snapshot is truncated')
+
+        self.__checksum.update(data)
+        return data
+
+    def __read_string(self):
+        return self.__read(LENGTH.unpack(self.__read(LENGTH.size))[0])
+
+    def records(self):
+        """ Yields each record as a tuple of its type and its fields,
+            hashes and keys as raw bytes.
+
+            Raises
+            ------
+                ValueError:
+                    if the checksum does not match, after the last record.
+        """
+        while True:
+            record_type = self.__read(1)
+
+            if record_type == RECORD_HEADER:
+                yield record_type, HEADER_RECORD.unpack(self.__read(HEADER_RECORD.size))
+
+            elif record_type == RECORD_OUTPUT:
+                output = OUTPUT_RECORD.unpack(self.__read(OUTPUT_RECORD.size))
+                yield record_type, output + (self.__read_string(),)
+
+            elif record_type == RECORD_END:
+                checksum = self.__checksum.digest()
+
+                if self.stream.read(CHECKSUM_SIZE) != checksum:
+                    raise ValueError('Snapshot checksum does not match')
+                return
+
+            else:
+                raise ValueError('Unknown snapshot record {!r}'.format(record_type))
+
+
+def pack_string(value):
+    """ Packs a string, or a number as its string, prefixed by its length.
+    """
+    value = str(value if value is not None else '')
+    return LENGTH.pack(len(value)) + value
+
+
+class Database(Database):
+    """ Database Object to export and import snapshots of the chain.
+
+        A snapshot holds the headers of the best chain and the unspent
+        output set at its tip, which is all a node needs to validate new
+        blocks. Importing one into a new database makes the node start
+        at the tip of the snapshot instead of replaying every block.
+
+        The blocks of an imported snapshot have no body, they are seen
+        as pruned (see indiecoin.blockchain.prune) up to the height of
+        the snapshot, kept as snapshot_height in the chain_state table
+        so their history can be validated later. If the address index
+        is enabled the outputs of the snapshot are indexed at its height,
+        their own height is not part of the snapshot.
+
+        Attributes
+        ----------
+            blocks: indiecoin.blockchain.block.Database
+                database of the blocks of the chain.
+    """
+    def __init__(self, file_name=None, config=None):
+        super(Database, self).__init__(file_name=file_name, config=config)
+        self.blocks = block.Database(file_name=file_name, config=config)
+
+    def export_snapshot(self, stream):
+        """ Writes a snapshot of the chain at its tip to stream.
+
+            The rows are streamed from a read transaction of its own
+            connection, so the snapshot is consistent while new blocks
+            keep being saved, and it never has to fit in memory.
+
+            Returns
+            -------
+                height: int
+                    height of the chain in the snapshot.
+        """
+        connection = sqlite3.connect(self.__get_sqlite_file_name(), isolation_level=None)
+
+        try:
+            connection.execute('PRAGMA query_only = ON')
+            connection.execute('BEGIN')
+            headers = connection.execute(
+                'SELECT hash, previous_block_hash, hash_merkle_root, timestamp, difficulty, nonce FROM block '
+                'WHERE is_orphan = 0 ORDER BY height')
+            height = connection.execute('SELECT MAX(height) FROM block WHERE is_orphan = 0').fetchone()[0]
+            writer = SnapshotWriter(stream, height)
+
+            for block_hash, previous_block_hash, hash_merkle_root, timestamp, difficulty, nonce in headers:
+                if not hash_merkle_root:
+                    hash_merkle_root = self.__merkle_root(connection, block_hash)
+
+                writer.write_header(str(block_hash), pack_header(
+                    binascii.hexlify(previous_block_hash), binascii.hexlify(hash_merkle_root),
+                    timestamp, difficulty, nonce))
+
+            for hash_transaction, out_index, amount, public_key_owner in connection.execute(
+                    'SELECT hash_transaction, out_index, amount, public_key_owner FROM unspent_output '
+                    'ORDER BY hash_transaction, out_index'):
+                writer.write_output(str(hash_transaction), out_index, int(amount), str(public_key_owner))
+
+            writer.close()
+            connection.execute('ROLLBACK')
+            return height
+        finally:
+            connection.close()
+
+    def __merkle_root(self, connection, block_hash):
+        """ Computes the merkle root of a block saved before merkle roots
+            were, such as the genesis block, as raw bytes.
+        """
+        hashes = [binascii.hexlify(row[0]) for row in connection.execute(
+            'SELECT hash FROM ic_transaction WHERE block_hash = ? ORDER BY id', (block_hash,))]
+        return binascii.unhexlify(merkle_root(hashes))
+
+    def import_snapshot(self, stream):
+        """ Replaces the chain of a new database with a snapshot read from
+            stream, in one sqlite transaction.
+
+            The headers must link from the genesis block to the tip, each
+            must hash to the hash of its block, and the checksum must
+            match, otherwise nothing is imported. The genesis block is
+            checked against our own instead.
+
+            Returns
+            -------
+                imported: tuple
+                    (height, number of unspent outputs) of the snapshot.
+
+            Raises
+            ------
+                ValueError:
+                    if the database already has blocks past the genesis
+                    block, or the snapshot is not valid.
+        """
+        with self.__manager.writing():
+            if self.blocks.get_height() != 1:
+                raise ValueError('A snapshot can only be imported into a new database')
+
+            with self.__manager.transaction() as connection:
+                return self.__import_snapshot(connection, SnapshotReader(stream))
+
+    def __import_snapshot(self, connection, reader):
+        """ Runs import_snapshot() inside its transaction.
+        """
+        genesis = self.blocks.get_block_header(self.blocks.get_block_hash(1))
+        headers = []
+        outputs = 0
+        previous = None
+
+        self.__write(connection, 'DELETE FROM transaction_input')
+        self.__write(connection, 'DELETE FROM transaction_output')
+        self.__write(connection, 'DELETE FROM ic_transaction')
+        self.__write(connection, 'DELETE FROM unspent_output')
+        self.__write(connection, 'DELETE FROM block_file')
+        self.__write(connection, 'DELETE FROM address_output')
+
+        for record_type, fields in reader.records():
+            if record_type == RECORD_HEADER:
+                if outputs:
+                    raise ValueError('Snapshot header after its outputs')
+
+                block_hash, header_bytes = fields
+                header_fields = unpack_header(header_bytes)
+                header = BlockHeader(
+                    hash=block_hash.encode('hex'),
+                    previous_block_hash=header_fields['previous_block_hash'],
+                    height=len(headers) + 1,
+                    timestamp=header_fields['timestamp'],
+                    nonce=header_fields['nonce'])
+
+                if previous is None and header.hash != genesis.hash:
+                    raise ValueError('Snapshot does not start at the genesis block')
+
+                if previous is not None and header.previous_block_hash != previous.hash:
+                    raise ValueError('Snapshot header {} does not follow its parent'.format(header.height))
+
+                if previous is not None and sha256(header_bytes) != header.hash:
+                    raise ValueError('Snapshot header {} does not match its hash'.format(header.height))
+
+                if previous is not None:
+                    self.__write(
+                        connection, 'INSERT INTO block (hash, previous_block_hash, hash_merkle_root, height, timestamp, '
+                        'difficulty, nonce, is_orphan) VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                        (sqlite3.Binary(block_hash), to_blob(header.previous_block_hash),
+                         to_blob(header_fields['hash_merkle_root']), header.height,
+                         header_fields['timestamp'], header_fields['difficulty'], header_fields['nonce']))
+
+                headers.append(header)
+                previous = header
+            else:
+                hash_transaction, out_index, amount, public_key_owner = fields
+                self.__write(
+                    connection, 'INSERT INTO unspent_output (hash_transaction, out_index, amount, public_key_owner) '
+                    'VALUES (?, ?, ?, ?)',
+                    (sqlite3.Binary(hash_transaction), out_index, amount, sqlite3.Binary(public_key_owner)))
+                outputs += 1
+
+                if self.__manager.config.address_index:
+                    self.__write(
+                        connection, 'INSERT INTO address_output (owner, hash_transaction, out_index, amount, height, unspent) '
+                        'VALUES (?, ?, ?, ?, ?, 1)',
+                        (to_blob(owner_hash(public_key_owner.encode('hex'))), sqlite3.Binary(hash_transaction),
+                         out_index, amount, reader.height))
+
+        if len(headers) != reader.height:
+            raise ValueError('Snapshot has {} headers for height {}'.format(len(headers), reader.height))
+
+        self.__set_chain_state(PRUNED_HEIGHT, reader.height)
+        self.__set_chain_state(SNAPSHOT_HEIGHT, reader.height)
+        self.__manager.after_commit(lambda: self.__imported(headers))
+        return reader.height, outputs
+
+    def __imported(self, headers):
+        """ Adds the imported headers to the header index once committed.
+        """
+        for header in headers:
+            self.blocks.headers.add(header)
+
+        self.blocks.headers.pruned_height = len(headers)
+        self.blocks.cache.clear()
+        self.blocks.transactions.cache.clear()
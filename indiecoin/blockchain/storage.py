@@ -0,0 +1,544 @@
+import contextlib
+import itertools
+import json
+import os
+import threading
+
+BACKEND_SQLITE = 'sqlite'
+BACKEND_MEMORY = 'memory'
+
+
+class Storage(object):
+    """ Interface every blockchain storage backend implements.
+
+        Block, Transaction and TransactionInput objects receive a storage
+        as their database and only use the methods below, so any backend
+        can be used by them, by BlockChain, the node and the miner.
+
+        Two backends exist, SqliteStorage persisting to a sqlite file and
+        MemoryStorage keeping everything in dictionaries. The one used by
+        default is selected with configure().
+    """
+    def get_block(self, block_hash):
+        """ Returns the block with hash block_hash, None if it does not exist.
+        """
+        raise NotImplementedError()
+
+    def get_block_height(self, height):
+        """ Returns the block at height, None if it does not exist.
+        """
+        raise NotImplementedError()
+
+    def get_block_header(self, block_hash):
+        """ Returns the indiecoin.blockchain.headers.BlockHeader of a block,
+            None if it does not exist.
+        """
+        raise NotImplementedError()
+
+    def get_block_hash(self, height):
+        """ Returns the hash of the block at height, None if there is none.
+        """
+        raise NotImplementedError()
+
+    def iter_blocks(self, start=1, end=None, headers_only=False, batch_size=100):
+        """ Yields the blocks, or their BlockHeader with headers_only, of
+            the best chain from height start to height end included, end
+            defaulting to the tip. Blocks are read batch_size at a time.
+
+            Raises
+            ------
+                ValueError:
+                    if blocks are requested from a pruned height.
+        """
+        raise NotImplementedError()
+
+    def get_block_bytes(self, block_hash):
+        """ Returns the block with hash block_hash serialized as JSON.
+        """
+        raise NotImplementedError()
+
+    def get_block_height_bytes(self, height):
+        """ Returns the block at height serialized as JSON.
+        """
+        raise NotImplementedError()
+
+    def get_height(self):
+        """ Returns the height of the tip of the chain.
+        """
+        raise NotImplementedError()
+
+    def save_block(self, block):
+        """ Saves a block with its transactions and connects it to the
+            unspent output set, atomically.
+
+            Raises
+            ------
+                AssertionError:
+                    if the block spends an output that is not unspent.
+        """
+        raise NotImplementedError()
+
+    def save_blocks(self, blocks):
+        """ Saves many blocks at once, either all of them or none.
+        """
+        raise NotImplementedError()
+
+    def get_transaction(self, transaction_hash):
+        """ Returns the transaction with hash transaction_hash, None if it
+            does not exist.
+        """
+        raise NotImplementedError()
+
+    def get_block_transactions(self, block_hash):
+        """ Returns the list of transactions of a block.
+        """
+        raise NotImplementedError()
+
+    def save_transaction(self, transaction, block_id=None):
+        """ Saves a transaction that is not connected to the chain.
+        """
+        raise NotImplementedError()
+
+    def get_output(self, hash_transaction, out_index):
+        """ Returns the output at out_index of a transaction, flagged as
+            spent or unspent, None if it does not exist.
+        """
+        raise NotImplementedError()
+
+    def is_spent_by(self, hash_transaction, out_index, spending_hash):
+        """ Checks if an output was spent by transaction spending_hash.
+        """
+        raise NotImplementedError()
+
+    def get_balance(self, public_key):
+        """ Returns the sum of the unspent outputs owned by public_key.
+        """
+        raise NotImplementedError()
+
+    def iter_address_history(self, public_key, offset=0, limit=100):
+        """ Yields a page of the outputs owned by public_key, newest first,
+            as dictionaries with hash_transaction, out_index, amount,
+            height and unspent.
+        """
+        raise NotImplementedError()
+
+    def is_pruned(self, block_hash):
+        """ Checks if the body of a block was pruned, only its header is
+            kept. Backends that do not prune always return False.
+        """
+        return False
+
+    def transaction(self):
+        """ Returns a context manager grouping every write made inside it
+            by the calling thread, committed once on exit and rolled back
+            if an exception escapes it.
+        """
+        raise NotImplementedError()
+
+    def cache_stats(self):
+        """ Returns the counters of the caches of the backend by name,
+            empty if it does not cache.
+        """
+        return {}
+
+
+class SqliteStorage(Storage):
+    """ Storage backed by the sqlite database, see
+        indiecoin.blockchain.block.Database and
+        indiecoin.blockchain.transaction.Database.
+
+        Attributes
+        ----------
+            blocks: indiecoin.blockchain.block.Database
+                database object for blocks.
+            transactions: indiecoin.blockchain.transaction.Database
+                database object for transactions.
+            addresses: indiecoin.blockchain.addressindex.Database
+                database object for the address index.
+    """
+    def __init__(self, file_name=None, config=None, blocks=None):
+        """ Opens the sqlite database file_name, or wraps an existing
+            block.Database if one is given.
+        """
+        from . import addressindex, block
+
+        self.blocks = blocks
+
+        if self.blocks is None:
+            self.blocks = block.Database(file_name=file_name, config=config)
+
+        self.transactions = self.blocks.transactions
+        self.addresses = addressindex.Database(file_name=self.blocks.file_name, config=config)
+
+    def is_stale(self):
+        """ Checks if the connections of the file were replaced since the
+            storage was opened, see block.Database.is_current().
+        """
+        return not self.blocks.is_current()
+
+    def get_block(self, block_hash):
+        return self.blocks.get_block(block_hash)
+
+    def get_block_height(self, height):
+        return self.blocks.get_block_height(height)
+
+    def get_block_header(self, block_hash):
+        return self.blocks.get_block_header(block_hash)
+
+    def get_block_hash(self, height):
+        return self.blocks.get_block_hash(height)
+
+    def iter_blocks(self, start=1, end=None, headers_only=False, batch_size=100):
+        return self.blocks.iter_blocks(start, end=end, headers_only=headers_only, batch_size=batch_size)
+
+    def get_block_bytes(self, block_hash):
+        return self.blocks.get_block_bytes(block_hash)
+
+    def get_block_height_bytes(self, height):
+        return self.blocks.get_block_height_bytes(height)
+
+    def get_height(self):
+        return self.blocks.get_height()
+
+    def save_block(self, block):
+        return self.blocks.save_block(block)
+
+    def save_blocks(self, blocks):
+        return self.blocks.save_blocks(blocks)
+
+    def get_transaction(self, transaction_hash):
+        return self.transactions.get_transaction(transaction_hash)
+
+    def get_block_transactions(self, block_hash):
+        return self.transactions.get_block_transactions(block_hash)
+
+    def save_transaction(self, transaction, block_id=None):
+        return self.transactions.save_transaction(transaction, block_id=block_id)
+
+    def get_output(self, hash_transaction, out_index):
+        return self.transactions.get_output(hash_transaction, out_index)
+
+    def is_spent_by(self, hash_transaction, out_index, spending_hash):
+        return self.transactions.is_spent_by(hash_transaction, out_index, spending_hash)
+
+    def get_balance(self, public_key):
+        return self.addresses.get_balance(public_key)
+
+    def iter_address_history(self, public_key, offset=0, limit=100):
+        return self.addresses.iter_history(public_key, offset=offset, limit=limit)
+
+    def is_pruned(self, block_hash):
+        return self.blocks.is_pruned(block_hash)
+
+    def transaction(self):
+        return self.blocks.transaction()
+
+    def cache_stats(self):
+        return self.blocks.cache_stats()
+
+
+class MemoryStorage(Storage):
+    """ Storage keeping the chain in dictionaries, for tests, benchmarks
+        and ephemeral nodes. Nothing is persisted.
+
+        The genesis block is loaded from genesis/genesis.json when the
+        storage is created. Writes are serialized by a lock, a failed
+        save leaves the storage as it was before it. Stored transactions
+        are shared with their blocks and have their outputs marked spent
+        in place, so the outputs marked since a save or a transaction
+        began are kept to be marked unspent again if it fails.
+    """
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__blocks = {}
+        self.__heights = {}
+        self.__transactions = {}
+        self.__unspent = {}
+        self.__spent_by = {}
+        self.__height = None
+        self.__marked_spent = None
+        self.__load_genesis()
+
+    def __load_genesis(self):
+        """ Builds the genesis block from genesis/genesis.json and saves it.
+        """
+        from .block import Block
+        from .transaction import Transaction, TransactionOutput
+
+        path = os.path.dirname(os.path.abspath(__file__))
+
+        with open(os.path.join(path, 'genesis/genesis.json')) as genesis_data_file:
+            genesis_data = json.load(genesis_data_file)
+
+        output_data = dict(genesis_data['transaction_output'])
+        output_data['amount'] = int(output_data['amount'])
+        output_data['unspent'] = int(output_data['unspent'])
+
+        genesis_transaction = Transaction.from_storage(
+            tx_inputs=[],
+            tx_outputs=[TransactionOutput(**output_data)],
+            database=self,
+            **genesis_data['ic_transaction'])
+
+        block_data = dict(genesis_data['block'], height=int(genesis_data['block']['height']))
+        block_data['is_orphan'] = int(block_data['is_orphan'])
+        block_data['num_transactions'] = int(block_data['num_transactions'])
+
+        self.save_block(Block.from_storage(transactions=[genesis_transaction], database=self, **block_data))
+
+    def get_block(self, block_hash):
+        return self.__blocks.get(block_hash)
+
+    def get_block_height(self, height):
+        return self.__blocks.get(self.get_block_hash(height))
+
+    def get_block_header(self, block_hash):
+        from .headers import BlockHeader
+
+        block = self.get_block(block_hash)
+        return BlockHeader.from_block(block) if block else None
+
+    def get_block_hash(self, height):
+        try:
+            return self.__heights.get(int(height))
+        except ValueError:
+            return None
+
+    def iter_blocks(self, start=1, end=None, headers_only=False, batch_size=100):
+        """ Yields the blocks walking the heights, they are all in memory.
+        """
+        end = self.__height if end is None else min(int(end), self.__height)
+
+        for height in xrange(max(int(start), 1), end + 1):
+            block = self.get_block_height(height)
+
+            if block is not None:
+                yield self.get_block_header(block.hash) if headers_only else block
+
+    def get_block_bytes(self, block_hash):
+        block = self.get_block(block_hash)
+        return block.to_json() if block else None
+
+    def get_block_height_bytes(self, height):
+        block = self.get_block_height(height)
+        return block.to_json() if block else None
+
+    def get_height(self):
+        return self.__height
+
+    def save_block(self, block):
+        return self.save_blocks([block])[0]
+
+    def save_blocks(self, blocks):
+        with self.__lock:
+            state = self.__state()
+            spent = []
+
+            try:
+                block_ids = [self.__save_block(block, spent) for block in blocks]
+
+                for hash_transaction, out_index in spent:
+                    self.__mark_spent(hash_transaction, out_index)
+            except BaseException:
+                self.__restore(state)
+                raise
+
+            self.__keep(state)
+            return block_ids
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Holds the lock of the storage and restores it as it was if an
+            exception escapes.
+        """
+        with self.__lock:
+            state = self.__state()
+
+            try:
+                yield self
+            except BaseException:
+                self.__restore(state)
+                raise
+
+            self.__keep(state)
+
+    def __state(self):
+        """ Returns shallow copies of every dictionary, to restore them
+            if a save fails, and starts a new list of the outputs marked
+            spent.
+        """
+        state = [dict(self.__blocks), dict(self.__heights), dict(self.__transactions),
+                 dict(self.__unspent), dict(self.__spent_by), self.__height, self.__marked_spent]
+        self.__marked_spent = []
+        return state
+
+    def __restore(self, state):
+        """ Puts back the dictionaries of state and marks unspent again
+            the outputs marked spent since it was taken.
+        """
+        for spent_transaction, out_index in reversed(self.__marked_spent):
+            spent_transaction.set_output_spent(out_index, spent=False)
+
+        (self.__blocks, self.__heights, self.__transactions,
+         self.__unspent, self.__spent_by, self.__height, self.__marked_spent) = state
+
+    def __keep(self, state):
+        """ Keeps what was done since state was taken. The outputs marked
+            spent are handed to the enclosing state, if any, so they are
+            marked unspent again if it is restored.
+        """
+        marked_spent = state[-1]
+
+        if marked_spent is not None:
+            marked_spent.extend(self.__marked_spent)
+        self.__marked_spent = marked_spent
+
+    def __mark_spent(self, hash_transaction, out_index):
+        spent_transaction = self.__transactions.get(hash_transaction)
+
+        if spent_transaction is not None:
+            spent_transaction.set_output_spent(out_index)
+            self.__marked_spent.append((spent_transaction, out_index))
+
+    def __save_block(self, block, spent):
+        """ Adds a block, its transactions and updates the unspent outputs.
+            Every outpoint spent by the block is appended to spent.
+        """
+        from .transaction import TransactionOutput
+
+        for tx in block.transactions:
+            tx.set_block_hash(block.hash)
+
+            for index, tx_out in enumerate(tx.tx_outputs):
+                self.__unspent[(tx.hash, index)] = TransactionOutput(
+                    amount=tx_out.amount, public_key_owner=tx_out.public_key_owner, unspent=1)
+
+        for tx in block.transactions:
+            for tx_in in tx.tx_inputs:
+                outpoint = (tx_in.hash_transaction, tx_in.prev_out_index)
+
+                if self.__unspent.pop(outpoint, None) is None:
+                    raise AssertionError('Block spends an output that is not unspent')
+
+                self.__spent_by[outpoint] = tx.hash
+                spent.append(outpoint)
+
+            self.__transactions.setdefault(tx.hash, tx)
+
+        self.__blocks[block.hash] = block
+
+        if not block.is_orphan:
+            self.__heights[int(block.height)] = block.hash
+            if self.__height is None or int(block.height) > self.__height:
+                self.__height = int(block.height)
+        return len(self.__blocks)
+
+    def get_transaction(self, transaction_hash):
+        return self.__transactions.get(transaction_hash)
+
+    def get_block_transactions(self, block_hash):
+        block = self.get_block(block_hash)
+        return block.transactions if block else []
+
+    def save_transaction(self, transaction, block_id=None):
+        with self.__lock:
+            if transaction.hash in self.__transactions:
+                return None
+
+            self.__transactions[transaction.hash] = transaction
+            return len(self.__transactions)
+
+    def get_output(self, hash_transaction, out_index):
+        from .transaction import TransactionOutput
+
+        output = self.__unspent.get((hash_transaction, out_index))
+
+        if output is not None:
+            return output
+
+        transaction = self.__transactions.get(hash_transaction)
+
+        if transaction is None or out_index >= len(transaction.tx_outputs):
+            return None
+
+        output = transaction.tx_outputs[out_index]
+        return TransactionOutput(amount=output.amount, public_key_owner=output.public_key_owner, unspent=0)
+
+    def is_spent_by(self, hash_transaction, out_index, spending_hash):
+        return self.__spent_by.get((hash_transaction, out_index)) == spending_hash
+
+    def get_balance(self, public_key):
+        """ Sums the unspent outputs of public_key, scanning the set.
+        """
+        return sum(int(output.amount) for output in self.__unspent.values()
+                   if output.public_key_owner == public_key)
+
+    def iter_address_history(self, public_key, offset=0, limit=100):
+        """ Yields the outputs of public_key walking the chain from the tip.
+        """
+        outputs = self.__iter_outputs(public_key)
+        return itertools.islice(outputs, int(offset), int(offset) + int(limit))
+
+    def __iter_outputs(self, public_key):
+        for height in sorted(self.__heights, reverse=True):
+            block = self.__blocks[self.__heights[height]]
+            owned = []
+
+            for tx in block.transactions:
+                for index, tx_out in enumerate(tx.tx_outputs):
+                    if tx_out.public_key_owner == public_key:
+                        owned.append({
+                            'hash_transaction': tx.hash,
+                            'out_index': index,
+                            'amount': int(tx_out.amount),
+                            'height': height,
+                            'unspent': int((tx.hash, index) in self.__unspent)})
+
+            for output in sorted(owned, key=lambda output: (output['hash_transaction'], output['out_index'])):
+                yield output
+
+
+BACKENDS = {
+    BACKEND_SQLITE: SqliteStorage,
+    BACKEND_MEMORY: MemoryStorage,
+}
+
+_backend = BACKEND_SQLITE
+_memory_storage = None
+_sqlite_storage = None
+_storage_lock = threading.Lock()
+
+
+def configure(backend):
+    """ Selects the backend returned by default_storage(), one of
+        BACKENDS. The node and the miner build their objects with it.
+    """
+    global _backend, _memory_storage, _sqlite_storage
+
+    if backend not in BACKENDS:
+        raise ValueError('Unknown storage backend {}'.format(backend))
+
+    _backend = backend
+    _memory_storage = None
+    _sqlite_storage = None
+
+
+def default_storage():
+    """ Returns the storage of the configured backend, one per process.
+
+        Blocks, transactions and inputs built without a database all ask
+        for it. A MemoryStorage holds the chain itself. A SqliteStorage is
+        opened again only once the connections of its file are replaced,
+        as when the file is removed, see SqliteStorage.is_stale().
+    """
+    global _memory_storage, _sqlite_storage
+
+    with _storage_lock:
+        if _backend == BACKEND_MEMORY:
+            if _memory_storage is None:
+                _memory_storage = MemoryStorage()
+            return _memory_storage
+
+        if _sqlite_storage is None or _sqlite_storage.is_stale():
+            _sqlite_storage = SqliteStorage()
+        return _sqlite_storage
@@ -1,12 +1,20 @@
 import json
+import struct
 
-from ..util.serialization import remove_dict_prefix
+from ..util.serialization import remove_dict_prefix, pack_hex, pack_number, BinaryReader
 from ..util.hash import sha256
 from ..wallet.address import Address
 from .database import Database
+from .cache import LRUCache, transaction_size
+from . import storage
 
 REWARD = 5
 
+FLAG = struct.Struct('<B')
+COUNT = struct.Struct('<I')
+AMOUNT = struct.Struct('<q')
+OUT_INDEX = struct.Struct('<I')
+
 
 class Transaction(object):
     """ Class Representing a Transaction instance.
@@ -19,6 +27,12 @@ class Transaction(object):
         information inside a transaction and can serialize object or
         write to database.
 
+        The binary encoding, the valid hash and the JSON of a transaction
+        are computed once and memoized. Only its block hash and whether
+        its outputs are spent change once it is built, through
+        set_block_hash() and set_output_spent(), which drop the JSON and
+        keep the encoding and the hash, neither covers them.
+
         Attributes
         -----------
             hash : string
@@ -39,8 +53,9 @@ class Transaction(object):
                 list of indiecoin.blockchain.transaction.TransactionOutput objects
             miner_fee: float
                 value indicating difference in inputs vs outputs.
-            __database: indiecoin.blockchain.transaction.database
-                instance of database on which to perform lookups and writeups.
+            __database: indiecoin.blockchain.storage.Storage
+                storage on which to perform lookups and writeups, such as
+                transaction.Database.
 
         Raises
         -------
@@ -52,14 +67,44 @@ class Transaction(object):
         """ Transaction Contructor
 
             Checks if a specific instance of a database was sent through
-            constructor. If not, initialized a new instance. If no hash has
-            been sent it calculates it with all other information.
+            constructor. If not, uses the default storage. If no hash has
+            been sent it calculates it with all other information, a hash
+            that was sent must be that one, see is_valid().
 
             For each tx_input and tx_out recieved, checkes if they are already
             an instance of a TransactionInput or TransactionOutput object. If
             they were just sent a dictionary, a new instance of each object is
             created.
 
+            Raises
+            ------
+                AssertionError:
+                    if transaction is not valid (see is_valid() function)
+        """
+        self.__load(kwargs, trusted=False)
+
+        if len(self.hash) < 64:  # Size of sha256 digest as a string
+            self.hash = self.valid_hash()
+
+        if not self.is_valid():
+            raise AssertionError('Transaction not valid')
+
+    @classmethod
+    def from_storage(cls, **kwargs):
+        """ Builds a transaction read from our own storage.
+
+            Transactions are validated before they are saved, so the
+            checks of is_valid(), signatures included, are not run again.
+            Anything received from peers must go through the constructor.
+        """
+        transaction = cls.__new__(cls)
+        transaction.__load(kwargs, trusted=True)
+        return transaction
+
+    def __load(self, kwargs, trusted):
+        """ Sets the attributes of the transaction from kwargs, see the
+            constructor. If trusted the transaction comes from our own
+            storage, see is_valid().
         """
         self.hash = kwargs['hash']
         self.block_hash = kwargs['block_hash']
@@ -77,13 +122,31 @@ class Transaction(object):
         self.__database = kwargs.get('database')
 
         if self.__database is None:
-            self.__database = Database()
+            self.__database = storage.default_storage()
 
-        if len(self.hash) < 64:  # Size of sha256 digest as a string
-            self.hash = self.valid_hash()
+        self.__trusted = trusted
+        self.__bytes = None
+        self.__valid_hash = None
+        self.__json = None
+        self.__changes = 0
 
-        if not self.is_valid():
-            raise AssertionError('Transaction not valid')
+    @classmethod
+    def from_bytes(cls, data, database=None, block_hash=''):
+        """ Builds a transaction from the bytes of to_bytes(), its hash is
+            computed from them. It goes through the constructor, so it is
+            validated against database.
+
+            Raises
+            ------
+                ValueError:
+                    if data is not a serialized transaction.
+                AssertionError:
+                    if the transaction is not valid.
+        """
+        reader = BinaryReader(data)
+        fields = read_transaction(reader, database)
+        reader.close()
+        return cls(block_hash=block_hash, database=database, **fields)
 
     def set_block_hash(self, block_hash):
         """ Sets a block hash on a transaction. This will be called
@@ -91,22 +154,26 @@ class Transaction(object):
             so each transaction can reference it later.
         """
         self.block_hash = block_hash
+        self.__changes += 1
 
-    def valid_hash(self):
-        """ Calculates the valid hash for this transaction.
+    def set_output_spent(self, out_index, spent=True):
+        """ Marks one of the outputs of the transaction as spent, or as
+            unspent again with spent False.
+        """
+        self.tx_outputs[out_index].unspent = not spent
+        self.__changes += 1
 
-            Takes data from serialize(), removes hash and block
-            hash.
+    def valid_hash(self):
+        """ Calculates the valid hash for this transaction, the sha256 of
+            to_bytes().
 
             Returns
             -------
                 sha256 representation of object
         """
-        data = self.serialize()
-
-        [data.pop(field, None) for field in ['block_hash', 'hash']]
-
-        return sha256(str(data))
+        if self.__valid_hash is None:
+            self.__valid_hash = sha256(self.to_bytes())
+        return self.__valid_hash
 
     def is_valid(self):
         """ Checks that a transaction is valid.
@@ -117,11 +184,16 @@ class Transaction(object):
 
             Performs the following checks:
 
+                - The hash of the transaction is the sha256 of its
+                binary encoding, see valid_hash().
+
                 - The sum of inputs most be less than or equal to
                 the sum of outputs (no overspending)
 
                 - All tx_outputs referenced in each input most not
-                be spent yet.
+                be spent yet, and the transaction must not be stored
+                already. Transactions built with from_storage() spent
+                their outputs themselves, so neither is checked.
 
                 - The signature for each input presented most match
                 the public key stored in the output it represents.
@@ -133,6 +205,12 @@ class Transaction(object):
         input_total = 0
         output_total = 0
 
+        try:
+            if self.hash != self.valid_hash():
+                return False
+        except ValueError:
+            return False
+
         if self.num_inputs != len(self.tx_inputs):
             return False
 
@@ -142,14 +220,17 @@ class Transaction(object):
         if self.num_inputs == 0 and not self.is_coinbase:
             return False
 
-        for tx_input in self.tx_inputs:
-            input_total += tx_input.amount
+        if not self.__trusted and self.exists():
+            return False
 
-            if not tx_input.unspent:
+        for tx_input in self.tx_inputs:
+            if not self.__trusted and not tx_input.unspent:
                 return False
             if not tx_input.validate_signature():
                 return False
 
+            input_total += tx_input.amount
+
         for tx_output in self.tx_outputs:
             output_total += tx_output.amount
 
@@ -198,10 +279,7 @@ class Transaction(object):
         if self.exists():
             raise NotImplemented('No update Implemented')
 
-        tx_data = self.serialize()
-        if block_id:
-            tx_data['block_id'] = block_id
-        return self.__database.save_transaction(tx_data)
+        return self.__database.save_transaction(self, block_id=block_id)
 
     def serialize(self):
         """ Serializes a transaction object into a dictionary representation.
@@ -223,7 +301,7 @@ class Transaction(object):
         data['tx_outputs'] = [tx.serialize() for tx in data['tx_outputs']]
         data['tx_inputs'] = [tx.serialize() for tx in data['tx_inputs']]
 
-        fields = ['__database', 'miner_fee']
+        fields = ['__database', 'miner_fee', '__trusted', '__bytes', '__valid_hash', '__json', '__changes']
 
         [data.pop(field, None) for field in fields]
 
@@ -231,8 +309,36 @@ class Transaction(object):
 
     def to_json(self):
         """ Returns a strins representation in JSON of Transaction object.
+
+            It is memoized along with the number of changes made through
+            the setters when it was dumped, so a transaction relayed by a
+            handler while the chain writer sets its block hash is never
+            left with a stale JSON.
         """
-        return json.dumps(self.serialize())
+        changes = self.__changes
+        memoized = self.__json
+
+        if memoized is None or memoized[0] != changes:
+            memoized = self.__json = (changes, json.dumps(self.serialize()))
+        return memoized[1]
+
+    def to_bytes(self):
+        """ Returns the canonical binary encoding of the transaction, the
+            payload its hash is computed over.
+
+            It holds whether it is a coinbase, its timestamp, then its
+            inputs and its outputs each preceded by their count. Its hash,
+            its block hash and whether it is orphan or spent are not part
+            of it, they are not chosen by whoever created it. Numbers are
+            little endian, hashes, keys and signatures raw bytes prefixed
+            by their length, see indiecoin.util.serialization.
+        """
+        if self.__bytes is None:
+            self.__bytes = (
+                FLAG.pack(int(self.is_coinbase)) + pack_number(self.timestamp) +
+                COUNT.pack(len(self.tx_inputs)) + ''.join(tx_in.to_bytes() for tx_in in self.tx_inputs) +
+                COUNT.pack(len(self.tx_outputs)) + ''.join(tx_out.to_bytes() for tx_out in self.tx_outputs))
+        return self.__bytes
 
     def __str__(self):
         return '{}'.format(self.hash)
@@ -254,16 +360,19 @@ class TransactionInput(object):
             prev_out_index: int
                 Index pointing to which transaction_output of transaction
                 is being referenced in this TransactionInput.
-            __database: indiecoin.blockchain.transaction.database
-                instance of database on which to perform lookups and writeups.
-            __prev_tx: indiecoin.blockchain.transaction.Transaction
-                transaction referenced by hash_transaction
+            __database: indiecoin.blockchain.storage.Storage
+                storage on which to perform lookups, such as
+                transaction.Database.
+            __prev_out: indiecoin.blockchain.transaction.TransactionOutput
+                output referenced by hash_transaction and prev_out_index,
+                None if it does not exist. Looked up the first time it
+                is needed, see prev_out.
     """
     def __init__(self, *args, **kwargs):
         """ Constructor for TransactionInput
 
-            Looks up previous transaction using hash provided in
-            constructor.
+            The output being spent is not looked up here, only when
+            amount, unspent or validate_signature need it.
         """
         self.signature = kwargs['signature']
         self.hash_transaction = kwargs['hash_transaction']
@@ -271,9 +380,26 @@ class TransactionInput(object):
         self.__database = kwargs.get('database')
 
         if self.__database is None:
-            self.__database = Database()
+            self.__database = storage.default_storage()
+
+        self.__prev_out = None
+        self.__prev_out_loaded = False
 
-        self.__prev_tx = self.__database.get_transaction(self.hash_transaction)
+    @property
+    def prev_out(self):
+        """ The output referenced by this input, looked up by hash and
+            index on first access. Only that output is read, never the
+            transaction holding it.
+
+            Returns
+            -------
+                prev_out: indiecoin.blockchain.transaction.TransactionOutput
+                    None if it does not exist.
+        """
+        if not self.__prev_out_loaded:
+            self.__prev_out = self.__database.get_output(self.hash_transaction, self.prev_out_index)
+            self.__prev_out_loaded = True
+        return self.__prev_out
 
     @property
     def unspent(self):
@@ -284,7 +410,8 @@ class TransactionInput(object):
             --------
                 unspent: boolean
         """
-        return self.__prev_tx.tx_outputs[self.prev_out_index].unspent
+        prev_out = self.prev_out
+        return prev_out is not None and prev_out.unspent
 
     @property
     def amount(self):
@@ -296,16 +423,25 @@ class TransactionInput(object):
                     The amount that the output refeenced by this
                     input has registered in the blockchain.
         """
-        return self.__prev_tx.tx_outputs[self.prev_out_index].amount
+        prev_out = self.prev_out
+
+        if prev_out is None:
+            return 0
+        return prev_out.amount
 
     def validate_signature(self):
         """ Validates if the signature provided in a transaction input
             is valid for the public key stored in the transaction output
             being referenced.
         """
-        public_key = self.__prev_tx.tx_outputs[self.prev_out_index].public_key_owner
+        prev_out = self.prev_out
 
-        if Address(public_key).verify_signature(self.signature, self.__prev_tx.hash):
+        if prev_out is None:
+            return False
+
+        public_key = prev_out.public_key_owner
+
+        if Address(public_key).verify_signature(self.signature, self.hash_transaction):
             return True
 
         return False
@@ -323,7 +459,7 @@ class TransactionInput(object):
                     dictionary representing instance.
         """
         data = remove_dict_prefix(self.__dict__, '_TransactionInput')
-        fields = ['__prev_tx', '__database']
+        fields = ['__prev_out', '__prev_out_loaded', '__database']
         [data.pop(field, None) for field in fields]
 
         return data
@@ -334,6 +470,22 @@ class TransactionInput(object):
         """
         return json.dumps(self.serialize())
 
+    def to_bytes(self):
+        """ Returns the canonical binary encoding of the input, the hash
+            of the transaction it spends, the index of the output and the
+            signature.
+        """
+        return pack_hex(self.hash_transaction) + OUT_INDEX.pack(self.prev_out_index) + pack_hex(self.signature)
+
+    @classmethod
+    def from_bytes(cls, data, database=None):
+        """ Builds an input from the bytes of to_bytes().
+        """
+        reader = BinaryReader(data)
+        fields = read_input(reader, database)
+        reader.close()
+        return cls(**fields)
+
     def __str__(self):
         return '{}'.format(self.hash_transaction)
 
@@ -383,19 +535,89 @@ class TransactionOutput(object):
         """
         return json.dumps(self.serialize())
 
+    def to_bytes(self):
+        """ Returns the canonical binary encoding of the output, its amount
+            and its owner. Whether it is spent is not part of it.
+        """
+        return AMOUNT.pack(self.amount) + pack_hex(self.public_key_owner)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Builds an unspent output from the bytes of to_bytes().
+        """
+        reader = BinaryReader(data)
+        fields = read_output(reader)
+        reader.close()
+        return cls(**fields)
+
     def __str__(self):
         return '{}-{}-{}'.format(self.amount, self.public_key_owner, self.unspent)
 
 
+def read_input(reader, database=None):
+    """ Reads an input written by TransactionInput.to_bytes() from an
+        indiecoin.util.serialization.BinaryReader, as constructor data.
+    """
+    hash_transaction = reader.read_hex()
+    prev_out_index, = reader.unpack(OUT_INDEX)
+
+    return {
+        'hash_transaction': hash_transaction,
+        'prev_out_index': prev_out_index,
+        'signature': reader.read_hex(),
+        'database': database,
+    }
+
+
+def read_output(reader):
+    """ Reads an output written by TransactionOutput.to_bytes(), as
+        constructor data of an unspent output.
+    """
+    amount, = reader.unpack(AMOUNT)
+    return {'amount': amount, 'public_key_owner': reader.read_hex(), 'unspent': 1}
+
+
+def read_transaction(reader, database=None):
+    """ Reads a transaction written by Transaction.to_bytes(), as
+        constructor data with its hash and without its block hash.
+    """
+    start = reader.offset
+    is_coinbase, = reader.unpack(FLAG)
+    timestamp = reader.read_number()
+    tx_inputs = [read_input(reader, database) for i in xrange(reader.unpack(COUNT)[0])]
+    tx_outputs = [read_output(reader) for i in xrange(reader.unpack(COUNT)[0])]
+
+    return {
+        'hash': sha256(reader.data[start:reader.offset]),
+        'num_inputs': len(tx_inputs),
+        'num_outputs': len(tx_outputs),
+        'timestamp': timestamp,
+        'is_coinbase': is_coinbase,
+        'is_orphan': 0,
+        'tx_inputs': tx_inputs,
+        'tx_outputs': tx_outputs,
+    }
+
+
 class Database(Database):
     """ Database Object abstraction for Transactions that
         will interact directly with the database.
+
+        Attributes
+        ----------
+            cache: indiecoin.blockchain.cache.LRUCache
+                transactions by hash, shared by every Database of the
+                same file.
     """
-    def __init__(self, file_name=None):
+    def __init__(self, file_name=None, config=None):
         """ Constructor for transaction.Database calls super
             constructor.
         """
-        super(Database, self).__init__(file_name=file_name)
+        super(Database, self).__init__(file_name=file_name, config=config)
+
+        config = self.__manager.config
+        self.cache = self.__shared('transactions', lambda: LRUCache(
+            config.transaction_cache_entries, config.transaction_cache_bytes, transaction_size))
 
     def get_transaction(self, hash_trans):
         """ Retrieves a transaction through a hash identifier.
@@ -404,31 +626,69 @@ class Database(Database):
             Outpus. Turn each dictionary data into an object and
             add them to Transaction instance.
 
+            Transactions retrieved recently are served from the cache.
+
             Returns
             -------
                 transaction: indiecoin.blockchain.transaction.Transaction
                     transaction instance
         """
+        cached = self.cache.get(hash_trans)
+
+        if cached is not None:
+            return cached
+
         transaction = self.__get_transaction(hash_trans)
 
         if len(transaction):
-
             transaction = transaction[0]
-            inputs = self.__get_transaction_inputs(transaction['id'])
-            outputs = self.__get_transaction_outputs(transaction['id'])
+            transaction = self.__assemble(
+                transaction,
+                self.__get_transaction_inputs(transaction['id']),
+                self.__get_transaction_outputs(transaction['id']))
+            self.cache.put(hash_trans, transaction)
+            return transaction
+        return None
+
+    def get_output(self, hash_transaction, out_index):
+        """ Retrieves the output at out_index of a transaction.
+
+            The unspent output set is looked up first, so checking an
+            input costs a single point lookup. Only outputs that are
+            not in the set are read from the transaction_output table,
+            those are returned flagged as spent.
 
-            transaction['tx_inputs'] = inputs
-            transaction['tx_outputs'] = outputs
-            [tx_in.update({'database': self}) for tx_in in transaction['tx_inputs']]
+            Returns
+            -------
+                output: indiecoin.blockchain.transaction.TransactionOutput
+                    referenced output or None if it does not exist.
+        """
+        output = self.__get_unspent_output(hash_transaction, out_index)
+
+        if output:
+            return TransactionOutput(unspent=1, **output[0])
 
-            transaction['database'] = self
+        output = self.__get_output(hash_transaction, out_index)
 
-            return Transaction(**transaction)
+        if output:
+            return TransactionOutput(**dict(output[0], unspent=0))
         return None
 
+    def is_spent_by(self, hash_transaction, out_index, spending_hash):
+        """ Checks if an output was spent by the stored transaction
+            with hash spending_hash.
+        """
+        spending = self.__get_spending_transactions(hash_transaction, out_index)
+        return spending_hash in [row['hash'] for row in spending]
+
     def get_block_transactions(self, block_hash):
         """ Gets all the transactions belonging to a block
 
+            Runs three queries whatever the size of the block, one for
+            the transactions, one for all of their inputs and one for
+            all of their outputs. Inputs and outputs are grouped by
+            transaction in memory.
+
             Returns
             -------
             transactions: list
@@ -437,36 +697,114 @@ class Database(Database):
         """
         transactions = self.__get_transactions_block(block_hash)
 
-        for transaction in transactions:
-            transaction['tx_inputs'] = self.__get_transaction_inputs(transaction['id'])
-            transaction['tx_outputs'] = self.__get_transaction_outputs(transaction['id'])
-            [tx_in.update({'database': self}) for tx_in in transaction['tx_inputs']]
+        if not transactions:
+            return []
 
-        [tx.update({'database': self}) for tx in transactions]
-        return [Transaction(**tx) for tx in transactions]
+        inputs = self.__group_by_transaction(self.__get_block_transaction_inputs(block_hash))
+        outputs = self.__group_by_transaction(self.__get_block_transaction_outputs(block_hash))
 
-    def save_transaction(self, transaction):
+        return [
+            self.__assemble(tx, inputs.get(tx['id'], []), outputs.get(tx['id'], []))
+            for tx in transactions]
+
+    def get_heights_transactions(self, start, end):
+        """ Gets the transactions of the blocks of the best chain with a
+            height between start and end, with the same three queries as
+            get_block_transactions() for the whole range.
+
+            Returns
+            -------
+            transactions: dict
+                lists of indiecoin.blockchain.transaction.Transaction by
+                the hash of their block.
+        """
+        transactions = self.__get_transactions_heights(start, end)
+
+        if not transactions:
+            return {}
+
+        inputs = self.__group_by_transaction(self.__get_transaction_inputs_heights(start, end))
+        outputs = self.__group_by_transaction(self.__get_transaction_outputs_heights(start, end))
+        blocks = {}
+
+        for tx in transactions:
+            blocks.setdefault(tx['block_hash'], []).append(
+                self.__assemble(tx, inputs.get(tx['id'], []), outputs.get(tx['id'], [])))
+
+        return blocks
+
+    def __group_by_transaction(self, rows):
+        """ Groups input or output rows by the id of their transaction,
+            keeping their order.
+        """
+        grouped = {}
+
+        for row in rows:
+            grouped.setdefault(row['id_transaction'], []).append(row)
+
+        return grouped
+
+    def __assemble(self, transaction, tx_inputs, tx_outputs):
+        """ Turns a transaction row and the rows of its inputs and
+            outputs into a Transaction object.
+        """
+        tx_inputs = [TransactionInput(database=self, **tx_in) for tx_in in tx_inputs]
+        tx_outputs = [TransactionOutput(**tx_out) for tx_out in tx_outputs]
+
+        return Transaction.from_storage(tx_inputs=tx_inputs, tx_outputs=tx_outputs, database=self, **transaction)
+
+    def save_transaction(self, transaction, block_id=None):
         """ Saves a transaction object to the database.
 
             After saving transaction object it gets its
             newely created id and uses it to save each
             transaction input and output.
         """
-        if not self.__get_transaction(transaction['hash']):
-            inputs = transaction.pop('tx_inputs')
-            outputs = transaction.pop('tx_outputs')
+        return self.save_transactions([transaction.serialize()], block_id=block_id)[0]
 
-            trans_id = self.__insert('ic_transaction', transaction)
+    def save_transactions(self, transactions, block_id=None):
+        """ Saves a list of serialized transactions with their inputs and
+            outputs in a single sqlite transaction.
 
-            if trans_id is None:
-                return None
+            Each transaction row is inserted to get its id, then all the
+            inputs and all the outputs are written with one executemany
+            each. Transactions already in the database are skipped.
 
-            for tx_in in inputs:
-                tx_in['id_transaction'] = trans_id
-                self.__insert('transaction_input', tx_in)
+            Returns
+            -------
+                ids: list
+                    id of each newly created transaction, None for the
+                    ones that were skipped.
+        """
+        ids = []
+        inputs = []
+        outputs = []
 
-            for tx_out in outputs:
-                tx_out['id_transaction'] = trans_id
-                self.__insert('transaction_output', tx_out)
-            return trans_id
-        return None
+        with self.__transaction():
+            for transaction in transactions:
+                if self.__get_transaction(transaction['hash']):
+                    ids.append(None)
+                    continue
+
+                transaction = dict(transaction)
+                tx_inputs = transaction.pop('tx_inputs')
+                tx_outputs = transaction.pop('tx_outputs')
+
+                if block_id:
+                    transaction['block_id'] = block_id
+
+                trans_id = self.__insert('ic_transaction', transaction)
+                ids.append(trans_id)
+
+                for tx_in in tx_inputs:
+                    tx_in['id_transaction'] = trans_id
+                    inputs.append(tx_in)
+
+                for tx_out in tx_outputs:
+                    tx_out['id_transaction'] = trans_id
+                    outputs.append(tx_out)
+
+            self.__insert_many('transaction_input', inputs)
+            self.__insert_many('transaction_output', outputs)
+
+        return ids
@@ -0,0 +1,261 @@
+import Queue
+import collections
+import sys
+import threading
+import time
+
+from . import storage
+
+GROUP_COMMIT_WINDOW = 0.005
+GROUP_COMMIT_MAX_JOBS = 64
+
+
+class Future(object):
+    """ Result of a job submitted to a ChainWriter, set once the
+        transaction holding the job is committed or rolled back, and its
+        after_commit() callbacks have run.
+    """
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__result = None
+        self.__error = None
+
+    def set_result(self, result):
+        self.__result = result
+        self.__done.set()
+
+    def set_exception(self, error):
+        """ Sets the exception of the job, as returned by sys.exc_info().
+        """
+        self.__error = error
+        self.__done.set()
+
+    def done(self):
+        return self.__done.is_set()
+
+    def result(self, timeout=None):
+        """ Waits for the job and returns what it returned, or raises the
+            exception it raised.
+
+            Raises
+            ------
+                RuntimeError:
+                    if the job is not done after timeout seconds.
+        """
+        if not self.__done.wait(timeout):
+            raise RuntimeError('Chain writer job did not finish in time')
+
+        if self.__error is not None:
+            raise self.__error[0], self.__error[1], self.__error[2]
+        return self.__result
+
+
+class ChainWriter(object):
+    """ Single thread applying every change to the chain state.
+
+        Jobs are functions submitted from any thread, they run one after
+        the other in the writer thread, in the order they were submitted,
+        so two blocks can never be validated and saved at the same time.
+        A job validating a block sees every block saved by the jobs
+        before it, committed or not.
+
+        Jobs submitted within window seconds of each other are committed
+        together in one storage transaction, up to max_jobs at a time. If
+        one of them raises, the whole group is rolled back and its jobs
+        run again each in a transaction of its own, so only the failing
+        job fails. Jobs must therefore be safe to run more than once: they
+        may only change the storage, which is rolled back, or register
+        after_commit() callbacks, which are dropped, and they must build
+        anything they consume from their arguments on every run. That is
+        why generators and other iterators are refused as arguments.
+
+        If the writer thread dies every pending job fails with the error
+        that killed it, and so does every job submitted afterwards.
+
+        Reads do not go through the writer, they keep being served by the
+        read connections of the storage while the writer works.
+
+        Attributes
+        ----------
+            storage: indiecoin.blockchain.storage.Storage
+                storage the jobs write to, the default one if None.
+            window: float
+                seconds to wait for more jobs before committing a group.
+            max_jobs: int
+                maximum number of jobs committed together.
+            commits: int
+                number of transactions committed.
+            jobs: int
+                number of jobs run successfully.
+    """
+    def __init__(self, storage=None, window=GROUP_COMMIT_WINDOW, max_jobs=GROUP_COMMIT_MAX_JOBS):
+        self.storage = storage
+        self.window = window
+        self.max_jobs = max_jobs
+        self.commits = 0
+        self.jobs = 0
+        self.__queue = Queue.Queue()
+        self.__on_commit = []
+        self.__current = None
+        self.__lock = threading.Lock()
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        """ Queues function(*args, **kwargs) to run in the writer thread.
+
+            Returns
+            -------
+                future: indiecoin.blockchain.writer.Future
+                    set once the group holding the job commits, or set
+                    with the error that killed the writer thread.
+
+            Raises
+            ------
+                TypeError:
+                    if an argument is an iterator, which a job run again
+                    would find consumed.
+        """
+        for argument in args + tuple(kwargs.values()):
+            if isinstance(argument, collections.Iterator):
+                raise TypeError('Chain writer jobs can not take iterators, they may run twice')
+
+        future = Future()
+
+        with self.__lock:
+            if self.__error is not None:
+                future.set_exception(self.__error)
+            else:
+                self.__queue.put((function, args, kwargs, future))
+        return future
+
+    def after_commit(self, callback):
+        """ Runs callback once the group of the current job commits,
+            dropped if it rolls back. Only to be called from a job, it
+            keeps in memory state in line with what was committed.
+
+            If callback raises, the future of the job raises its error,
+            even though what the job wrote was committed.
+        """
+        self.__on_commit.append((self.__current, callback))
+
+    def close(self):
+        """ Stops the writer thread once the jobs already submitted are done.
+        """
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        jobs = []
+
+        try:
+            while True:
+                jobs = self.__next_group()
+
+                if jobs is None:
+                    return
+
+                self.__commit(jobs)
+        except BaseException:
+            self.__die(jobs, sys.exc_info())
+            raise
+
+    def __die(self, jobs, error):
+        """ Fails the jobs of the current group that are not done and
+            every job still queued, and makes submit() fail from now on.
+        """
+        with self.__lock:
+            self.__error = error
+
+            while True:
+                try:
+                    job = self.__queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+                if job is not None:
+                    jobs.append(job)
+
+        for function, args, kwargs, future in jobs:
+            if not future.done():
+                future.set_exception(error)
+
+    def __next_group(self):
+        """ Waits for a job and gathers the ones arriving within window.
+            Returns None once closed and there is nothing left to run.
+        """
+        job = self.__queue.get()
+
+        if job is None:
+            return None
+
+        jobs = [job]
+        deadline = time.time() + self.window
+
+        while len(jobs) < self.max_jobs:
+            remaining = deadline - time.time()
+
+            try:
+                if remaining > 0:
+                    job = self.__queue.get(timeout=remaining)
+                else:
+                    job = self.__queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            if job is None:
+                self.__queue.put(None)
+                break
+
+            jobs.append(job)
+
+        return jobs
+
+    def __commit(self, jobs):
+        """ Runs a group of jobs in one transaction and sets their futures.
+        """
+        self.__on_commit = []
+
+        try:
+            chain_storage = self.storage if self.storage is not None else storage.default_storage()
+
+            with chain_storage.transaction():
+                results = [self.__run_job(*job) for job in jobs]
+        except Exception:
+            if len(jobs) == 1:
+                jobs[0][3].set_exception(sys.exc_info())
+                return
+
+            for job in jobs:
+                self.__commit([job])
+            return
+
+        callbacks, self.__on_commit = self.__on_commit, []
+        errors = {}
+
+        for future, callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                errors.setdefault(future, sys.exc_info())
+
+        self.commits += 1
+        self.jobs += len(jobs)
+
+        for job, result in zip(jobs, results):
+            if job[3] in errors:
+                job[3].set_exception(errors[job[3]])
+            else:
+                job[3].set_result(result)
+
+    def __run_job(self, function, args, kwargs, future):
+        """ Runs a job, its after_commit() callbacks are kept with its future.
+        """
+        self.__current = future
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.__current = None
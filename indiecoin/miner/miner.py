@@ -2,11 +2,13 @@ import time
 import threading
 
 from .. import blockchain
+from ..blockchain.headers import NONCE, MAX_NONCE
 from ..wallet.address import Address
-from ..util.hash import sha256d
+from ..util.hash import sha256
 
 REWARD = 5
-DIFFICULTY = 2 ** (256 - 21)
+DIFFICULTY_BITS = 21
+DIFFICULTY = 2 ** (256 - DIFFICULTY_BITS)
 
 class Miner(object):
 
@@ -59,7 +61,7 @@ class Miner(object):
                 transactions.remove(tx)
 
         max_height = blockchain.BlockChain().get_height()
-        prev_block = blockchain.BlockChain().get_block_height(max_height)
+        prev_block_hash = blockchain.BlockChain().get_block_hash(max_height)
         fees = 0
 
         for tx in transactions:
@@ -89,11 +91,12 @@ class Miner(object):
 
         block_data = {
             'hash': '',
-            'timestamp': time.time(),
+            'timestamp': int(time.time()),
             'nonce': '',
+            'difficulty': DIFFICULTY_BITS,
             'num_transactions': len(transactions),
             'is_orphan': 0,
-            'previous_block_hash': prev_block.hash,
+            'previous_block_hash': prev_block_hash,
             'height': int(max_height) + 1,
             'transactions': transactions,
         }
@@ -107,7 +110,12 @@ class Miner(object):
         self.main_thread.start()
 
     def main_loop(self):
-        """
+        """ Searches the nonce of the current block.
+
+            Only the 80 bytes of the header are hashed for each nonce, the
+            part before the nonce is packed once. Once every nonce has
+            been tried the timestamp is moved forward and they are tried
+            again.
         """
         while not self.__shutdown:
             nonce = 0
@@ -117,15 +125,23 @@ class Miner(object):
 
             self.__debug('------- BEGIN MINING BLOCK --------')
             block = self.current_block
+            header = block.header_bytes()[:-NONCE.size]
 
             while(not self.__interrupt and not self.__found):
-                block.nonce = nonce
-                block.hash = block.valid_hash()
+                block_hash = sha256(header + NONCE.pack(nonce))
 
-                if int(block.hash, 16) < DIFFICULTY:
+                if int(block_hash, 16) < DIFFICULTY:
+                    block.set_nonce(nonce)
+                    block.set_hash(block_hash)
                     self.__found = True
                     break
 
+                if nonce == MAX_NONCE:
+                    block.set_timestamp(int(time.time()))
+                    header = block.header_bytes()[:-NONCE.size]
+                    nonce = 0
+                    continue
+
                 nonce += 1
 
             if self.__found and not self.__interrupt:
@@ -1,12 +1,23 @@
 import json
+import sqlite3
 import threading
 
 from .ic_peer import IndieCoinPeer
 from .. import blockchain
+from ..blockchain import database, prune, writer
 
 from protocol.response import Response
 from protocol import protocol
 
+BOOTSTRAP_BATCH_SIZE = 50
+WRITER_TIMEOUT = 60
+BOOTSTRAP_WRITER_TIMEOUT = 600
+
+# Errors a chain writer job may fail with because of the data a peer sent,
+# or because the writer did not answer in time, see writer.Future.result().
+# Malformed fields fail to encode with ValueError or TypeError.
+JOB_ERRORS = (AssertionError, ValueError, TypeError, KeyError, RuntimeError, sqlite3.Error)
+
 
 class IndieCoinNode(IndieCoinPeer):
     """ Indie Coin P2P Node
@@ -40,6 +51,14 @@ class IndieCoinNode(IndieCoinPeer):
             transactions_queue: list
                 list for incoming transactions that will be mined
                 in future blocks to enter the blockchain.
+            pruner: indiecoin.blockchain.prune.Database
+                prunes old blocks in the background when the storage
+                config has a prune target, None otherwise.
+            writer: indiecoin.blockchain.writer.ChainWriter
+                thread applying every change to the chain. Relayed
+                blocks and transactions, mined blocks, bootstrap batches
+                and pruning all go through it, so they are validated and
+                saved one at a time and committed in groups.
 
         Notes
         -----
@@ -51,6 +70,7 @@ class IndieCoinNode(IndieCoinPeer):
 
             Maps requests types from protocol to handler functions.
             Add this requests types to the handlers from BTPeer.
+            Handlers give their read connections back when they return.
 
         """
         IndieCoinPeer.__init__(
@@ -72,9 +92,23 @@ class IndieCoinNode(IndieCoinPeer):
         }
 
         self.transactions_queue = []
+        self.pruner = None
+        self.writer = writer.ChainWriter()
 
         for mt in handlers:
-            self.addhandler(mt, handlers[mt])
+            self.addhandler(mt, self.__releasing(handlers[mt]))
+
+    def __releasing(self, handler):
+        """ Wraps a handler so the read connections of its thread go back
+            to the pool once it is done, each request runs on a new thread.
+        """
+        def handle(peer_connection, data):
+            try:
+                return handler(peer_connection, data)
+            finally:
+                database.release_readers()
+
+        return handle
 
     def __debug(self, msg):
         """ Prints a message to screen.
@@ -87,9 +121,39 @@ class IndieCoinNode(IndieCoinPeer):
     def start(self):
         """ Begins main thread inherite from indiecoin.node.bt_peer.py,
             runs thread that listens for clientes with incoming transactions.
+
+            If the storage config has a prune target, old blocks are
+            pruned every prune.PRUNE_INTERVAL seconds in another thread.
         """
         self.main_thread.start()
 
+        config = database.default_config()
+
+        if config.prune_blocks is not None or config.prune_bytes is not None:
+            self.pruner = prune.Database()
+            self.startstabilizer(self.__prune, prune.PRUNE_INTERVAL)
+
+    def __prune(self):
+        """ Prunes the blocks that went past the prune target since the
+            last run, a batch at a time so blocks keep being saved.
+
+            A step that fails or times out is logged and left for the next
+            run, the stabilizer thread must not die with it.
+        """
+        pruned = 0
+
+        try:
+            step = self.writer.submit(self.pruner.prune_step).result(WRITER_TIMEOUT)
+
+            while step:
+                pruned += step
+                step = self.writer.submit(self.pruner.prune_step).result(WRITER_TIMEOUT)
+        except Exception as e:
+            self.__debug('Pruning failed: {}'.format(e))
+
+        if pruned:
+            self.__debug('Pruned {} blocks'.format(pruned))
+
     def connect_and_send(self, peer, msg_type, msg_data='', pid=None, waitreply=True):
         """ Wrapper over BTPeer.connectandsend() function. Send data to a peer for a
             specific purpose.
@@ -133,18 +197,23 @@ class IndieCoinNode(IndieCoinPeer):
             its asking for a height.
 
             Answers with the specific block queried or protocol.Error block not
-            found.
+            found. The block is sent as stored, without being rebuilt when
+            block files are enabled.
+
+            If the block is known but its body was pruned the answer is
+            protocol.BLOCK_PRUNED, so the peer asks someone else.
 
         """
-        if len(block_id) == 64:
-            block = blockchain.BlockChain().get_block(block_id)
+        chain = blockchain.BlockChain()
+        block_hash = block_id if len(block_id) == 64 else chain.get_block_hash(block_id)
+        block = chain.get_block_bytes(block_hash) if block_hash else None
+
+        if block:
+            peer_connection.send_data(protocol.REPLY, str(block))
+        elif block_hash and chain.is_pruned(block_hash):
+            peer_connection.send_data(protocol.BLOCK_PRUNED, 'Block pruned')
         else:
-            block = blockchain.BlockChain().get_block_height(block_id)
-
-        if not block:
             peer_connection.send_data(protocol.ERROR, 'Block not found')
-        else:
-            peer_connection.send_data(protocol.REPLY, block.to_json())
 
     def __handle_relay_transaction(self, peer_connection, data):
         """ handles relay transaction. Recieves an incomming transaction
@@ -155,31 +224,81 @@ class IndieCoinNode(IndieCoinPeer):
 
             If we don't, we add it to our queue and we broadcast it to
             all of our peers, (except the one who sent it to us.)
-        """
-        data = json.loads(data)
 
+            The transaction is checked by the chain writer, so it is never
+            checked against a block that is half saved. If it is not valid,
+            or its fields can not be encoded, the answer is protocol.ERROR.
+        """
         try:
-            transaction = blockchain.transaction.Transaction(**data)
-        except AssertionError as e:
-            self.__debug(e[0])
-            return
-
-        if transaction in self.transactions_queue or \
-                transaction.exists() or transaction.is_coinbase:
+            transaction = self.writer.submit(self.__accept_transaction, json.loads(data)).result(WRITER_TIMEOUT)
+        except JOB_ERRORS as e:
+            self.__debug(e)
+            peer_connection.send_data(protocol.ERROR, 'Transaction not valid')
             return
 
-        if transaction.is_valid():
-            self.transactions_queue.append(transaction)
+        if transaction is not None:
+            transaction_json = transaction.to_json()
 
             for peer in self.get_peer_ids():
                 if peer != peer_connection.id:
                     self.connect_and_send(
                         peer,
                         protocol.RELAY_TRANSACTION,
-                        transaction.to_json(),
+                        transaction_json,
                         None,
                         False)
 
+    def __accept_transaction(self, data):
+        """ Chain writer job validating a relayed transaction and adding
+            it to the queue once the job commits.
+
+            Returns
+            -------
+                transaction: indiecoin.blockchain.transaction.Transaction
+                    the transaction, None if it was already known, is a
+                    coinbase or is not valid.
+        """
+        transaction = blockchain.transaction.Transaction(**data)
+
+        if self.__is_queued(transaction) or transaction.exists() or transaction.is_coinbase:
+            return None
+
+        if not transaction.is_valid():
+            return None
+
+        self.writer.after_commit(lambda: self.__queue_transaction(transaction))
+        return transaction
+
+    def __is_queued(self, transaction):
+        return any(queued.hash == transaction.hash for queued in self.transactions_queue)
+
+    def __queue_transaction(self, transaction):
+        if not self.__is_queued(transaction):
+            self.transactions_queue.append(transaction)
+
+    def __accept_block(self, data):
+        """ Chain writer job validating and saving a relayed block. The
+            transactions it holds leave the queue once the job commits.
+
+            Returns
+            -------
+                block: indiecoin.blockchain.block.Block
+                    the block, None if it was already saved.
+        """
+        block = blockchain.block.Block(**data)
+
+        if block.exists():
+            return None
+
+        block.save()
+        self.writer.after_commit(lambda: self.__unqueue_transactions(block.transactions))
+        return block
+
+    def __unqueue_transactions(self, transactions):
+        hashes = set(transaction.hash for transaction in transactions)
+        self.transactions_queue[:] = [
+            queued for queued in self.transactions_queue if queued.hash not in hashes]
+
     def __handle_relay_block(self, peer_connection, data):
         """ handles relay transaction. Recieves an incomming block
             from a peer. Validates block. If we do not have this block
@@ -197,30 +316,28 @@ class IndieCoinNode(IndieCoinPeer):
                 implemented all the logic that arises from the complexity
                 of actually trusting the proof of work.
 
+            The block is validated and saved by the chain writer, so
+            competing blocks relayed at the same time are saved one after
+            the other. If it is not valid, or its fields can not be
+            encoded, the answer is protocol.ERROR.
         """
-        data = json.loads(data)
-
         try:
-            block = blockchain.block.Block(**data)
-        except AssertionError as e:
-            self.__debug(e[0])
+            block = self.writer.submit(self.__accept_block, json.loads(data)).result(WRITER_TIMEOUT)
+        except JOB_ERRORS as e:
+            self.__debug(e)
+            peer_connection.send_data(protocol.ERROR, 'Block not valid')
             return
 
-        if not block.exists():
+        if block is not None:
 
             if self.miner:
                 self.miner.interrupt()
 
-            block.save()
-
-            for transaction in block.transactions:
-                for queue_transaction in self.transactions_queue:
-                    if queue_transaction.hash == transaction.hash:
-                        self.transactions_queue.remove(queue_transaction)
+            block_json = block.to_json()
 
             for peer in self.get_peer_ids():
                 if peer != peer_connection.id:
-                    self.connect_and_send(peer, protocol.RELAY_BLOCK, block.to_json(), None, False)
+                    self.connect_and_send(peer, protocol.RELAY_BLOCK, block_json, None, False)
 
             if self.miner:
                 self.miner.create_current_block(self.transactions_queue)
@@ -233,61 +350,137 @@ class IndieCoinNode(IndieCoinPeer):
         if self.miner:
             if self.miner.found:  # We found block!
                 block_data = self.miner.get_current_block()
-                new_block = blockchain.block.Block(**block_data)
-                new_block.save()
 
-                for peer in self.get_peer_ids():
-                    self.connect_and_send(
-                        peer,
-                        protocol.RELAY_BLOCK,
-                        new_block.to_json(),
-                        None,
-                        False)
+                try:
+                    new_block = self.writer.submit(self.__accept_block, block_data).result(WRITER_TIMEOUT)
+                except JOB_ERRORS as e:
+                    self.__debug(e)
+                    new_block = None
+
+                if new_block is not None:
+                    block_json = new_block.to_json()
+
+                    for peer in self.get_peer_ids():
+                        self.connect_and_send(
+                            peer,
+                            protocol.RELAY_BLOCK,
+                            block_json,
+                            None,
+                            False)
 
-                self.__debug('BROADCASTED')
+                    self.__debug('BROADCASTED')
 
                 self.miner.begin_mining()
                 self.miner.create_current_block(self.transactions_queue)
 
+    def __save_blocks(self, blocks_data):
+        """ Chain writer job saving a batch of downloaded blocks.
+
+            The blocks are built while they are saved, from the data on
+            each run, so the job can run again if its group rolls back.
+        """
+        return blockchain.BlockChain().save_blocks(self.__build_blocks(blocks_data))
+
+    def __build_blocks(self, blocks_data):
+        """ Generator turning downloaded block data into Block objects.
+
+            It is consumed inside BlockChain.save_blocks() so every block
+            is validated against the ones saved before it in the same
+            commit. Stops at the first invalid block, since the blocks
+            after it can't be valid either.
+        """
+        for block_data in blocks_data:
+            try:
+                yield blockchain.block.Block(**block_data)
+            except AssertionError as e:
+                self.__debug(e[0])
+                return
+
+    def __save_batch(self, batch):
+        """ Saves a batch of downloaded blocks through the chain writer.
+
+            If the batch fails, because a block double spends or can not
+            be encoded or the writer does not answer in time, its blocks
+            are saved again one by one, so a bad block only costs itself.
+        """
+        try:
+            self.writer.submit(self.__save_blocks, batch).result(BOOTSTRAP_WRITER_TIMEOUT)
+            return
+        except JOB_ERRORS as e:
+            self.__debug(e)
+
+        for block_data in batch:
+            try:
+                self.writer.submit(self.__save_blocks, [block_data]).result(WRITER_TIMEOUT)
+            except JOB_ERRORS as e:
+                self.__debug(e)
+
+    def __download_block(self, height, peers):
+        """ Asks peers in order for the block at height until one sends
+            it. Peers that pruned it or fail are skipped.
+
+            Returns
+            -------
+                block_data: dictionary
+                    data of the block, None if no peer sent it.
+        """
+        for peer in peers:
+            response = self.connect_and_send(peer, protocol.BLOCK_GET, str(height))
+
+            if response.is_successful():
+                return response.data
+
+            if response.is_pruned():
+                self.__debug('{} pruned block {}'.format(peer, height))
+
+        return None
+
     def bootstrap(self):
         """ Bootstraps a node that just went online. After building a list
             of peers, it asks its peers for their blockchain height. It checks
             if the max height is bigger than its own height and if it is, it
             asks for all the blocks its missing.
 
+            Missing blocks are downloaded in batches of BOOTSTRAP_BATCH_SIZE
+            and each batch is saved with a single commit, see __save_batch().
+            Each block is asked to the peers with the highest chain first,
+            moving on to the next one when a peer pruned it or fails to
+            answer.
+
             Catches up on the network.
         """
         self.__debug('------ BOOTSTRAPPING IN PROGRESS -----')
         current_height = int(blockchain.BlockChain().get_height())
         max_height = 0
-        peer_max_height = None
+        peer_heights = {}
 
         for peer in self.get_peer_ids():
             response = self.connect_and_send(peer, protocol.MAX_BLOCK_HEIGHT)
 
             if response.is_successful():
-                peer_height = int(response.data)
-                if peer_height > max_height:
-                    max_height = peer_height
-                    peer_max_height = peer
+                peer_heights[peer] = int(response.data)
+                max_height = max(max_height, peer_heights[peer])
+
+        peers = sorted(peer_heights, key=peer_heights.get, reverse=True)
 
         if current_height < max_height:
             self.__debug('------ UPDATING BLOCKHAIN -------')
-            for i in range(current_height+1, int(max_height)+1):
-                    response = self.connect_and_send(
-                        peer_max_height,
-                        protocol.BLOCK_GET,
-                        str(i))
-                    """
-                        @ TODO:
-                            What happens when it fails?
-                    """
-                    block_data = response.data
-                    try:
-                        block = blockchain.block.Block(**block_data)
-                        block.save()
-                    except AssertionError as e:
-                        self.__debug(e[0])
+            for start in range(current_height+1, int(max_height)+1, BOOTSTRAP_BATCH_SIZE):
+                end = min(start + BOOTSTRAP_BATCH_SIZE, int(max_height) + 1)
+                batch = []
+
+                for i in range(start, end):
+                    block_data = self.__download_block(i, [peer for peer in peers if peer_heights[peer] >= i])
+
+                    if block_data is None:
+                        break
+                    batch.append(block_data)
+
+                self.__save_batch(batch)
+
+                if len(batch) < end - start:
+                    self.__debug('No peer could send block {}'.format(start + len(batch)))
+                    break
 
             self.__debug('------ FINISH UPDATING BLOCKHAIN -------')
         self.__debug('----- BOOTSTRAP DONE --------')
@@ -6,6 +6,7 @@ INSERTPEER = 'JOIN'
 PEERQUIT = 'QUIT'
 REPLY = "REPL"
 ERROR = "ERRO"
+BLOCK_PRUNED = "PRUN"  # the block is known but its body was pruned
 
 BLOCK_GET = 'BGET'
 MAX_BLOCK_HEIGHT = 'BHGT'
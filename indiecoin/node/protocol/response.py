@@ -58,12 +58,18 @@ class Response(object):
 
             Returns
             -------
-                False if response type is protocol.Error,
-                Truth otherwise.
+                False if response type is protocol.Error or
+                protocol.BLOCK_PRUNED, Truth otherwise.
         """
-        if self.__response_type == protocol.ERROR:
+        if self.__response_type in [protocol.ERROR, protocol.BLOCK_PRUNED]:
             return False
         return True
 
+    def is_pruned(self):
+        """ Allows to verify if the peer knows the block asked for
+            but pruned its body, another peer must be asked.
+        """
+        return self.__response_type == protocol.BLOCK_PRUNED
+
     def __str__(self):
         return 'response: {}'.format(self.code)
@@ -1,6 +1,7 @@
+import binascii
 import hashlib
 
-__all__ = ['sha256', 'sha256d']
+__all__ = ['sha256', 'sha256d', 'merkle_root']
 
 
 def sha256(data):
@@ -9,3 +10,24 @@ def sha256(data):
 
 def sha256d(data):
     return sha256(sha256(data))
+
+
+def merkle_root(hashes):
+    """ Computes the merkle root of a list of hex sha256 digests.
+
+        Each level hashes pairs of digests over their raw bytes, the last
+        digest of a level with an odd count is paired with itself. The
+        root of a single digest is the digest, the root of none is zeros.
+    """
+    if not hashes:
+        return '0' * 64
+
+    level = [binascii.unhexlify(value) for value in hashes]
+
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in xrange(0, len(level), 2)]
+
+    return binascii.hexlify(level[0])
@@ -1,3 +1,5 @@
+import binascii
+import struct
 
 
 def remove_dict_prefix(dictionary, prefix):
@@ -10,3 +12,92 @@ def remove_dict_prefix(dictionary, prefix):
         data[key.replace(prefix, '')] = val
 
     return data
+
+
+LENGTH = struct.Struct('<I')
+
+
+def pack_bytes(value):
+    """ Packs a byte string prefixed by its length.
+    """
+    return LENGTH.pack(len(value)) + value
+
+
+def pack_hex(value):
+    """ Packs a hex string, such as a hash or a key, as its raw bytes
+        prefixed by their length.
+
+        Raises
+        ------
+            ValueError:
+                if value is not hex.
+    """
+    try:
+        return pack_bytes(binascii.unhexlify(value))
+    except (TypeError, binascii.Error):
+        raise ValueError('Not a hex string: {!r}'.format(value))
+
+
+def pack_number(value):
+    """ Packs a timestamp or a nonce, which may be fractional or empty, as
+        its canonical decimal text prefixed by its length. 1, 1.0 and '1'
+        are packed the same.
+    """
+    if value is None or value == '':
+        return pack_bytes('')
+
+    number = float(value)
+
+    if number.is_integer():
+        return pack_bytes(str(int(number)))
+    return pack_bytes(repr(number))
+
+
+class BinaryReader(object):
+    """ Reads back, in order, the values packed by the functions above.
+
+        Raises
+        ------
+            ValueError:
+                if data ends before a value does.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError('Serialized data is truncated')
+
+        value = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return value
+
+    def unpack(self, structure):
+        return structure.unpack(self.read(structure.size))
+
+    def read_bytes(self):
+        return self.read(self.unpack(LENGTH)[0])
+
+    def read_hex(self):
+        return binascii.hexlify(self.read_bytes())
+
+    def read_number(self):
+        """ Reads a value packed by pack_number(), as an int when it has no
+            fraction, '' when it was empty.
+        """
+        text = self.read_bytes()
+
+        if text == '':
+            return ''
+
+        try:
+            return int(text)
+        except ValueError:
+            return float(text)
+
+    def close(self):
+        """ Checks that every byte of data was read.
+        """
+        if self.offset != len(self.data):
+            raise ValueError('Serialized data has {} trailing bytes'.format(len(self.data) - self.offset))
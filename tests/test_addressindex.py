@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+
+from context import indiecoin
+from context import GENESIS_BLOCK_HASH, PUBLIC_KEY_GENESIS, PRIVATE_KEY_GENESIS
+from indiecoin.blockchain import addressindex, block
+from indiecoin.util import default_data_directory
+
+
+class AddressIndexTestCase(unittest.TestCase):
+    """ Test the index of outputs by owner.
+    """
+    def setUp(self):
+        """ Create database object with different file_name. Creates the data
+            of a block spending the genesis output.
+        """
+        self.file_name = 'test_database'
+        self.path = os.path.join(default_data_directory(), self.file_name)
+        self.database = block.Database(file_name=self.file_name)
+        self.transaction = self.database.get_block(GENESIS_BLOCK_HASH).transactions[0]
+        address = indiecoin.wallet.address.Address(private_key=PRIVATE_KEY_GENESIS)
+
+        transaction_data = {
+            'hash': '',
+            'block_hash': '',
+            'num_inputs': 1,
+            'num_outputs': 2,
+            'timestamp': '1490477410',
+            'is_coinbase': 0,
+            'is_orphan': 0,
+            'tx_inputs': [{
+                'signature': address.sign(self.transaction.hash),
+                'hash_transaction': self.transaction.hash,
+                'prev_out_index': 0,
+                'database': self.database.transactions,
+            }],
+            'tx_outputs': [
+                {'amount': 25, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1},
+                {'amount': 25, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1},
+            ],
+            'database': self.database.transactions,
+        }
+
+        coin_base_transaction_data = {
+            'hash': '',
+            'block_hash': '',
+            'num_inputs': 0,
+            'num_outputs': 1,
+            'timestamp': '1490477419',
+            'is_coinbase': 1,
+            'is_orphan': 0,
+            'tx_inputs': [],
+            'tx_outputs': [{'amount': 5, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1}],
+            'database': self.database.transactions,
+        }
+
+        self.block_data = {
+            'hash': '',
+            'timestamp': '',
+            'nonce': '',
+            'num_transactions': 2,
+            'is_orphan': 0,
+            'previous_block_hash': GENESIS_BLOCK_HASH,
+            'height': 2,
+            'transactions': [transaction_data, coin_base_transaction_data],
+            'database': self.database,
+        }
+
+    def tearDown(self):
+        """ Destroy database.
+        """
+        os.system('rm {}'.format(self.path))
+
+    def test_address_index(self):
+        """ Test that the address index follows connected blocks and that
+            a parallel rebuild gives the same index.
+        """
+        with self.assertRaises(ValueError):
+            indiecoin.blockchain.BlockChain(database=self.database).get_balance(PUBLIC_KEY_GENESIS)
+
+        with self.assertRaises(ValueError):
+            indiecoin.blockchain.BlockChain(database=self.database).iter_address_history(PUBLIC_KEY_GENESIS)
+
+        indiecoin.blockchain.database._managers.clear()
+        config = indiecoin.blockchain.database.StorageConfig(address_index=True)
+        self.block_data['database'] = block.Database(file_name=self.file_name, config=config)
+        blockchain = indiecoin.blockchain.BlockChain(database=self.block_data['database'])
+
+        self.assertEqual(blockchain.get_balance(PUBLIC_KEY_GENESIS), 50)
+
+        block.Block(**self.block_data).save()
+
+        self.assertEqual(blockchain.get_balance(PUBLIC_KEY_GENESIS), 55)
+        history = list(blockchain.iter_address_history(PUBLIC_KEY_GENESIS))
+        self.assertEqual([output['height'] for output in history], [2, 2, 2, 1])
+        self.assertEqual(history[-1]['unspent'], 0)
+        self.assertEqual(
+            list(blockchain.iter_address_history(PUBLIC_KEY_GENESIS, offset=2, limit=1)), [history[2]])
+
+        chunk_size = addressindex.REBUILD_CHUNK_SIZE
+        addressindex.REBUILD_CHUNK_SIZE = 1
+        try:
+            addresses = addressindex.Database(file_name=self.file_name)
+            self.assertEqual(addresses.rebuild(processes=2), 4)
+        finally:
+            addressindex.REBUILD_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(list(blockchain.iter_address_history(PUBLIC_KEY_GENESIS)), history)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import unittest
+import json
 import os
+import sqlite3
+import time
 
 from context import indiecoin
 from context import GENESIS_BLOCK_HASH, PUBLIC_KEY_GENESIS, PRIVATE_KEY_GENESIS
@@ -153,6 +156,33 @@ class BlockTestCase(unittest.TestCase):
         except AssertionError as e:
             self.assertEqual(e[0], 'Block is not valid')
 
+    def test_from_storage_not_validated(self):
+        """ Test that a block built from storage skips validation, and that
+            only such blocks can leave their transactions out.
+        """
+        self.block_data['height'] += 10
+        self.block_data['hash'] = 'a' * 64
+        new_block = block.Block.from_storage(**self.block_data)
+
+        self.assertFalse(new_block.is_valid())
+
+        self.block_data.pop('transactions')
+        self.assertTrue(block.Block.from_storage(**self.block_data).header_only)
+
+        with self.assertRaises(AssertionError):
+            block.Block(**self.block_data)
+
+    def test_hash_must_match_header(self):
+        """ Test that a block given a hash other than the one of its header
+            is not valid.
+        """
+        new_block = block.Block(**self.block_data)
+
+        with self.assertRaises(AssertionError):
+            block.Block(**dict(self.block_data, hash='a' * 64))
+
+        self.assertTrue(block.Block(**dict(self.block_data, hash=new_block.hash)).is_valid())
+
     def test_save_to_database(self):
         """ Test saving a block to database.
         """
@@ -165,6 +195,383 @@ class BlockTestCase(unittest.TestCase):
         self.assertEqual(new_block.hash, saved_block.hash)
         self.assertEqual(len(new_block.transactions), len(saved_block.transactions))
 
+    def test_header_only_block(self):
+        """ Test that a loaded block reads its transactions on first access.
+        """
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+
+        saved_block = self.database.get_block(new_block.hash)
+        self.assertTrue(saved_block.header_only)
+        self.assertEqual(
+            [tx.hash for tx in saved_block.transactions],
+            [tx.hash for tx in new_block.transactions])
+        self.assertFalse(saved_block.header_only)
+
+    def test_get_block_header(self):
+        """ Test getting the header of a block without its transactions.
+        """
+        new_block = block.Block(**self.block_data)
+        self.assertIsNone(self.database.get_block_header(new_block.hash))
+
+        new_block.save()
+
+        header = indiecoin.blockchain.BlockChain(database=self.database).get_block_header(
+            new_block.hash)
+        self.assertEqual(header.height, 2)
+        self.assertEqual(header.previous_block_hash, GENESIS_BLOCK_HASH)
+
+    def test_cache_invalidated_on_connect(self):
+        """ Test that lookups through BlockChain are cached and that
+            connecting a block drops the transactions it spends.
+        """
+        blockchain = indiecoin.blockchain.BlockChain(database=self.database)
+        blockchain.get_block(GENESIS_BLOCK_HASH)
+        genesis = blockchain.get_block_height(1)
+        blockchain.get_transaction(self.transaction.hash)
+
+        self.assertIs(genesis, blockchain.get_block(GENESIS_BLOCK_HASH))
+        self.assertTrue(blockchain.get_transaction(self.transaction.hash).tx_outputs[0].unspent)
+
+        block.Block(**self.block_data).save()
+
+        stats = blockchain.cache_stats()
+        self.assertEqual(stats['blocks']['entries'], 0)
+        self.assertEqual(stats['transactions']['hits'], 1)
+        self.assertIsNot(genesis, blockchain.get_block(GENESIS_BLOCK_HASH))
+        self.assertFalse(blockchain.get_transaction(self.transaction.hash).tx_outputs[0].unspent)
+
+    def test_cache_invalidated_in_chunks(self):
+        """ Test that the blocks holding the transactions spent by a block
+            are found with one query per MAX_QUERY_PARAMETERS transactions.
+        """
+        first_block = block.Block(**self.block_data)
+        first_block.save()
+        blockchain = indiecoin.blockchain.BlockChain(database=self.database)
+        cached = blockchain.get_block(first_block.hash)
+
+        spent = [first_block.transactions[0], first_block.transactions[1]]
+        spending = dict(
+            self.transaction_data, num_inputs=2, num_outputs=1, timestamp='1490477420',
+            tx_outputs=[{'amount': 30, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1}],
+            tx_inputs=[{
+                'signature': self.address.sign(tx.hash),
+                'hash_transaction': tx.hash,
+                'prev_out_index': 0,
+                'database': self.transaction_database} for tx in spent])
+        coinbase = dict(self.coin_base_transaction_data, timestamp='1490477421')
+        second_block = block.Block(**dict(
+            self.block_data, height=3, previous_block_hash=first_block.hash, transactions=[spending, coinbase]))
+
+        max_query_parameters = indiecoin.blockchain.database.MAX_QUERY_PARAMETERS
+        indiecoin.blockchain.database.MAX_QUERY_PARAMETERS = 1
+        try:
+            second_block.save()
+        finally:
+            indiecoin.blockchain.database.MAX_QUERY_PARAMETERS = max_query_parameters
+
+        self.assertIsNot(cached, blockchain.get_block(first_block.hash))
+        self.assertEqual(blockchain.get_height(), 3)
+
+    def test_bytes_round_trip(self):
+        """ Test that a block decoded from its binary encoding is validated
+            and has the same hashes as the block encoded.
+        """
+        new_block = block.Block(**self.block_data)
+        sqlite_storage = indiecoin.blockchain.storage.SqliteStorage(blocks=self.database)
+        decoded = block.Block.from_bytes(new_block.to_bytes(), database=sqlite_storage)
+
+        self.assertEqual(decoded.hash, new_block.hash)
+        self.assertEqual(decoded.height, 2)
+        self.assertEqual([tx.hash for tx in decoded.transactions], [tx.hash for tx in new_block.transactions])
+        self.assertEqual(decoded.transactions[0].block_hash, new_block.hash)
+
+        data = new_block.to_bytes()
+        tampered = data[:40] + chr(ord(data[40]) ^ 1) + data[41:]
+
+        with self.assertRaises(AssertionError):
+            block.Block.from_bytes(tampered, database=sqlite_storage)
+
+    def test_header(self):
+        """ Test that the hash of a block covers its 80 bytes header, which
+            commits to the transactions through their merkle root.
+        """
+        new_block = block.Block(**self.block_data)
+        header = new_block.header_bytes()
+
+        self.assertEqual(len(header), 80)
+        self.assertEqual(new_block.hash, indiecoin.util.hash.sha256(header))
+        self.assertEqual(new_block.hash_merkle_root, indiecoin.util.hash.merkle_root(
+            [tx.hash for tx in new_block.transactions]))
+
+        new_block.set_nonce(7)
+        self.assertNotEqual(new_block.valid_hash(), new_block.hash)
+        self.assertEqual(new_block.header_bytes()[:76], header[:76])
+
+        new_block.transactions.reverse()
+        self.assertFalse(new_block.is_valid())
+
+        for timestamp in ['100.5', 100.9, 2 ** 32, 'now']:
+            with self.assertRaises(AssertionError):
+                block.Block(**dict(self.block_data, hash='a' * 64, timestamp=timestamp))
+
+        self.assertEqual(block.Block(**dict(self.block_data, timestamp=100.0)).timestamp, 100.0)
+
+    def test_memoized(self):
+        """ Test that the setters of a block drop only what they changed
+            and that its JSON follows the block hash of its transactions.
+        """
+        new_block = block.Block(**self.block_data)
+        data = new_block.to_bytes()
+        header = new_block.header_bytes()
+
+        self.assertEqual(json.loads(new_block.to_json()), json.loads(json.dumps(new_block.serialize())))
+
+        new_block.set_nonce(7)
+        self.assertEqual(new_block.to_bytes()[80:], data[80:])
+        self.assertEqual(new_block.header_bytes()[:76], header[:76])
+        self.assertEqual(json.loads(new_block.to_json())['nonce'], 7)
+        self.assertNotEqual(new_block.valid_hash(), new_block.hash)
+
+        new_block.set_hash(new_block.valid_hash())
+        new_block.transactions[0].set_block_hash(new_block.hash)
+        self.assertEqual(json.loads(new_block.to_json())['transactions'][0]['block_hash'], new_block.hash)
+
+        new_block.set_timestamp(1490477410)
+        self.assertNotEqual(new_block.header_bytes()[:76], header[:76])
+        self.assertNotEqual(new_block.valid_hash(), new_block.hash)
+
+        stored = block.Block.from_storage(**dict(
+            new_block.serialize(transactions=False), hash_merkle_root='',
+            transactions=new_block.transactions, database=self.database))
+        self.assertEqual(json.loads(stored.to_json())['hash_merkle_root'], '')
+
+        stored.header_bytes()
+        self.assertEqual(json.loads(stored.to_json())['hash_merkle_root'], new_block.hash_merkle_root)
+
+    def test_iter_blocks(self):
+        """ Test that iterating over the chain yields every block in order,
+            whole or as headers, and stops early without hanging.
+        """
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+        blockchain = indiecoin.blockchain.BlockChain(database=self.database)
+
+        blocks = list(blockchain.iter_blocks(batch_size=1))
+        self.assertEqual([b.hash for b in blocks], [GENESIS_BLOCK_HASH, new_block.hash])
+        self.assertFalse(blocks[1].header_only)
+        self.assertEqual([tx.hash for tx in blocks[1].transactions],
+                         [tx.hash for tx in new_block.transactions])
+        self.assertEqual(blocks[1].transactions[0].tx_inputs[0].hash_transaction, self.transaction.hash)
+        self.assertEqual(blocks[1].to_json(), blockchain.get_block(new_block.hash).to_json())
+
+        headers = list(blockchain.iter_blocks(start=2, headers_only=True))
+        self.assertEqual([header.height for header in headers], [2])
+
+        self.assertEqual(list(blockchain.iter_blocks(start=3)), [])
+        self.assertEqual(next(iter(blockchain.iter_blocks(batch_size=1))).hash, GENESIS_BLOCK_HASH)
+
+    def test_iter_blocks_releases_readers(self):
+        """ Test that the thread reading blocks ahead gives its read
+            connection back to the pool once done.
+        """
+        manager = indiecoin.blockchain.database.get_connection_manager(self.path)
+        blockchain = indiecoin.blockchain.BlockChain(database=self.database)
+
+        list(blockchain.iter_blocks(batch_size=1))
+        indiecoin.blockchain.database.release_readers()
+        deadline = time.time() + 1
+
+        while manager.pool_stats()['owned'] and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(manager.pool_stats()['owned'], 0)
+
+    def test_load_block_transactions(self):
+        """ Test that inputs and outputs loaded for a whole block are given
+            back to their own transaction, in order.
+        """
+        self.transaction_outputs[0]['amount'] = 20
+        self.transaction_outputs[1]['amount'] = 30
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+
+        saved_block = self.database.get_block(new_block.hash)
+        transactions = dict((tx.hash, tx) for tx in saved_block.transactions)
+
+        for tx in new_block.transactions:
+            saved_tx = transactions[tx.hash]
+            self.assertEqual(
+                [tx_in.signature for tx_in in saved_tx.tx_inputs],
+                [tx_in.signature for tx_in in tx.tx_inputs])
+            self.assertEqual(
+                [tx_out.amount for tx_out in saved_tx.tx_outputs],
+                [tx_out.amount for tx_out in tx.tx_outputs])
+
+    def test_save_spends_outputs(self):
+        """ Test that saving a block removes the outputs it spends from the
+            unspent set, so they can not be spent again.
+        """
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+
+        tx_input = indiecoin.blockchain.transaction.TransactionInput(**self.tx_input_data)
+        self.assertFalse(tx_input.unspent)
+        self.assertEqual(tx_input.amount, 50)
+
+        spending = new_block.transactions[0]
+        tx_output = self.transaction_database.get_output(spending.hash, 1)
+        self.assertTrue(tx_output.unspent)
+        self.assertEqual(tx_output.amount, 25)
+
+        self.transaction_data['timestamp'] = '1490477411'
+        with self.assertRaises(AssertionError):
+            indiecoin.blockchain.transaction.Transaction(**self.transaction_data)
+
+    def test_block_mined_transaction(self):
+        """ Test that a block holding a transaction already in the chain is
+            not valid, while the stored transaction still is.
+        """
+        first_block = block.Block(**self.block_data)
+        first_block.save()
+        mined = first_block.transactions[0].serialize()
+
+        with self.assertRaises(AssertionError):
+            block.Block(**dict(
+                self.block_data, height=3, previous_block_hash=first_block.hash,
+                transactions=[dict(mined, database=self.transaction_database),
+                              dict(self.coin_base_transaction_data, timestamp='1490477420')]))
+
+        self.assertTrue(self.transaction_database.get_transaction(mined['hash']).is_valid())
+
+    def test_block_double_spend(self):
+        """ Test that a block spending the same output twice is not valid.
+        """
+        double_spend = dict(self.transaction_data, timestamp='1490477411')
+        self.block_data['transactions'].insert(1, double_spend)
+        self.block_data['num_transactions'] += 1
+
+        with self.assertRaises(AssertionError):
+            block.Block(**self.block_data)
+
+    def test_save_is_atomic(self):
+        """ Test that a block is not saved at all if saving a transaction fails.
+        """
+        new_block = block.Block(**self.block_data)
+        new_block.transactions[1].tx_outputs = None
+
+        with self.assertRaises(TypeError):
+            new_block.save()
+
+        self.assertFalse(new_block.exists())
+        self.assertEqual(self.transaction_database.get_transaction(new_block.transactions[0].hash), None)
+
+    def test_save_blocks(self):
+        """ Test saving many blocks with a single commit, each block
+            being validated against the one saved before it.
+        """
+        coinbase = dict(self.coin_base_transaction_data, timestamp='1490477420')
+        coinbase_block_data = {
+            'hash': '',
+            'timestamp': '',
+            'nonce': '',
+            'num_transactions': 1,
+            'is_orphan': 0,
+            'height': 3,
+            'transactions': [coinbase],
+            'database': self.database,
+        }
+        first_block = block.Block(**self.block_data)
+
+        def blocks():
+            yield first_block
+            coinbase_block_data['previous_block_hash'] = first_block.hash
+            yield block.Block(**coinbase_block_data)
+
+        blockchain = indiecoin.blockchain.BlockChain(database=self.database)
+        block_ids = blockchain.save_blocks(blocks())
+
+        self.assertEqual(len(block_ids), 2)
+        self.assertEqual(blockchain.get_height(), 3)
+
+    def test_header_index_updated(self):
+        """ Test that a saved block reaches the header index once committed,
+            and that a fresh index loaded from the file agrees with it.
+        """
+        new_block = block.Block(**self.block_data)
+        self.assertEqual(self.database.get_height(), 1)
+
+        new_block.save()
+
+        self.assertEqual(self.database.get_height(), 2)
+        self.assertEqual(self.database.get_block_hash(2), new_block.hash)
+        self.assertEqual(self.database.get_block_hash('2'), new_block.hash)
+        self.assertEqual(
+            [header.hash for header in self.database.headers.ancestors(new_block.hash)],
+            [new_block.hash, GENESIS_BLOCK_HASH])
+
+        indiecoin.blockchain.database._managers.clear()
+        reloaded = block.Database(file_name=self.file_name)
+        self.assertIsNot(reloaded.headers, self.database.headers)
+        self.assertEqual(reloaded.get_height(), 2)
+        self.assertEqual(reloaded.get_block_hash(2), new_block.hash)
+
+    def test_header_index_reloaded(self):
+        """ Test that a block saved through another connection to the file,
+            as by another process, reaches the header index already loaded.
+        """
+        self.assertEqual(self.database.get_height(), 1)
+
+        indiecoin.blockchain.database._managers.clear()
+        other = block.Database(file_name=self.file_name)
+        self.block_data['database'] = other
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+
+        time.sleep(indiecoin.blockchain.database.DATA_VERSION_INTERVAL)
+        self.assertEqual(self.database.get_height(), 2)
+        self.assertEqual(self.database.get_block_hash(2), new_block.hash)
+        self.assertEqual(self.database.get_block(new_block.hash).hash, new_block.hash)
+
+    def test_header_index_kept_on_own_commits(self):
+        """ Test that blocks saved by this process do not make the header
+            index reload or the caches drop.
+        """
+        manager = indiecoin.blockchain.database.get_connection_manager(self.path)
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+        cached = self.database.get_block(new_block.hash)
+
+        time.sleep(indiecoin.blockchain.database.DATA_VERSION_INTERVAL)
+        self.assertFalse(manager.data_changed())
+        self.assertEqual(self.database.get_height(), 2)
+        self.assertIs(self.database.get_block(new_block.hash), cached)
+
+        other = sqlite3.connect(self.path)
+        other.execute("INSERT OR REPLACE INTO chain_state (name, value) VALUES ('test', 1)")
+        other.commit()
+        other.close()
+
+        time.sleep(indiecoin.blockchain.database.DATA_VERSION_INTERVAL)
+        self.assertTrue(manager.data_changed())
+        self.assertFalse(manager.data_changed())
+
+    def test_save_blocks_rolled_back(self):
+        """ Test that no block is saved if one of the batch fails.
+        """
+        first_block = block.Block(**self.block_data)
+
+        def blocks():
+            yield first_block
+            raise AssertionError('Block is not valid')
+
+        with self.assertRaises(AssertionError):
+            self.database.save_blocks(blocks())
+
+        self.assertFalse(first_block.exists())
+        self.assertEqual(self.database.get_height(), 1)
+        self.assertIsNone(self.database.get_block_hash(2))
+
 
 if __name__ == '__main__':
     unittest.main()
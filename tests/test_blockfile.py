@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import unittest
+import shutil
+import json
+import os
+
+from context import indiecoin
+from context import GENESIS_BLOCK_HASH, PUBLIC_KEY_GENESIS
+from indiecoin.blockchain import blockfile, database
+from indiecoin.util import default_data_directory
+
+
+class BlockFileStoreTestCase(unittest.TestCase):
+    """ Test appending and reading serialized blocks in blk*.dat files.
+    """
+    def setUp(self):
+        """ Create a store in a test directory.
+        """
+        self.directory = os.path.join(default_data_directory(), 'test_blocks')
+        self.store = blockfile.BlockFileStore(self.directory, max_file_size=64)
+
+    def tearDown(self):
+        """ Destroy block files.
+        """
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_append_and_read(self):
+        """ Test that appended data is read back from its location.
+        """
+        first = self.store.append('{"hash": "first"}')
+        second = self.store.append('{"hash": "second"}')
+
+        self.assertEqual(str(self.store.read(*first)), '{"hash": "first"}')
+        self.assertEqual(str(self.store.read(*second)), '{"hash": "second"}')
+
+    def test_rotate_files(self):
+        """ Test that a new file is started when the current one is full.
+        """
+        locations = [self.store.append('x' * 40) for i in range(3)]
+
+        self.assertEqual([location[0] for location in locations], [0, 1, 2])
+        self.assertEqual(blockfile.BlockFileStore(self.directory).append('y')[0], 2)
+
+    def test_remove_file(self):
+        """ Test that old files are removed but not the one being appended to.
+        """
+        locations = [self.store.append('x' * 40) for i in range(2)]
+        self.store.read(*locations[0])
+
+        self.assertTrue(self.store.remove(0))
+        self.assertFalse(self.store.remove(1))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['blk00001.dat'])
+
+    def test_truncate(self):
+        """ Test that truncating drops a record, the ones after it and the
+            files started after it.
+        """
+        first = self.store.append('x' * 20)
+        second = self.store.append('y' * 20)
+        self.store.append('z' * 40)
+        self.store.read(*second)
+
+        self.store.truncate(*second[:2])
+        self.store.sync()
+
+        self.assertEqual(sorted(os.listdir(self.directory)), ['blk00000.dat'])
+        self.assertEqual(self.store.append('w')[:2], second[:2])
+        self.assertEqual(str(self.store.read(*first)), 'x' * 20)
+
+
+class BlockFilesDatabaseTestCase(unittest.TestCase):
+    """ Test saving and serving blocks with block files enabled.
+    """
+    def setUp(self):
+        """ Create a database with block files enabled.
+        """
+        self.file_name = 'test_database_block_files'
+        self.path = os.path.join(default_data_directory(), self.file_name)
+        config = database.StorageConfig(block_files=True)
+        self.database = indiecoin.blockchain.block.Database(file_name=self.file_name, config=config)
+
+        coinbase = {
+            'hash': '',
+            'block_hash': '',
+            'num_inputs': 0,
+            'num_outputs': 1,
+            'timestamp': '1490477419',
+            'is_coinbase': 1,
+            'is_orphan': 0,
+            'tx_inputs': [],
+            'tx_outputs': [{'amount': 5, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1}],
+            'database': self.database.transactions
+        }
+
+        self.block_data = {
+            'hash': '',
+            'timestamp': '',
+            'nonce': '',
+            'num_transactions': 1,
+            'is_orphan': 0,
+            'previous_block_hash': GENESIS_BLOCK_HASH,
+            'height': 2,
+            'transactions': [coinbase],
+            'database': self.database,
+        }
+
+    def tearDown(self):
+        """ Destroy database and block files.
+        """
+        database.get_connection_manager(self.path).close()
+        database._managers.clear()
+        os.remove(self.path)
+
+        blockfile.get_block_file_store('{}-blocks'.format(self.path)).close()
+        blockfile._stores.clear()
+        shutil.rmtree('{}-blocks'.format(self.path))
+
+    def test_serve_stored_bytes(self):
+        """ Test that a saved block is served from the block files as written.
+        """
+        new_block = indiecoin.blockchain.block.Block(**self.block_data)
+        new_block.save()
+
+        data = self.database.get_block_bytes(new_block.hash)
+        self.assertEqual(type(data), buffer)
+        self.assertEqual(str(data), new_block.to_json())
+        self.assertEqual(str(self.database.get_block_height_bytes(2)), new_block.to_json())
+
+    def test_rollback_truncates(self):
+        """ Test that the bytes of blocks whose transaction rolls back are
+            dropped from the block files.
+        """
+        def blocks():
+            yield indiecoin.blockchain.block.Block(**self.block_data)
+            raise AssertionError('Block is not valid')
+
+        block_file = os.path.join('{}-blocks'.format(self.path), blockfile.BLOCK_FILE_NAME.format(0))
+
+        with self.assertRaises(AssertionError):
+            self.database.save_blocks(blocks())
+
+        self.assertEqual(os.path.getsize(block_file), 0)
+        self.assertEqual(self.database.get_height(), 1)
+
+        new_block = indiecoin.blockchain.block.Block(**self.block_data)
+        new_block.save()
+        self.assertEqual(str(self.database.get_block_bytes(new_block.hash)), new_block.to_json())
+
+    def test_rollback_failure_raised(self):
+        """ Test that a block file that can not be truncated on rollback
+            is reported, chained onto the error that rolled it back.
+        """
+        def blocks():
+            yield indiecoin.blockchain.block.Block(**self.block_data)
+            raise AssertionError('Block is not valid')
+
+        def truncate(store, file_number, offset):
+            raise IOError('Disk unreachable')
+
+        original = blockfile.BlockFileStore.truncate
+        blockfile.BlockFileStore.truncate = truncate
+
+        try:
+            with self.assertRaises(RuntimeError) as raised:
+                self.database.save_blocks(blocks())
+        finally:
+            blockfile.BlockFileStore.truncate = original
+
+        self.assertIsInstance(raised.exception.__cause__, AssertionError)
+        self.assertIn('Disk unreachable', str(raised.exception))
+        self.assertEqual(self.database.get_height(), 1)
+
+    def test_serve_block_not_in_files(self):
+        """ Test that blocks saved before block files were enabled are serialized.
+        """
+        data = self.database.get_block_bytes(GENESIS_BLOCK_HASH)
+        self.assertEqual(json.loads(data)['hash'], GENESIS_BLOCK_HASH)
+        self.assertEqual(self.database.get_block_bytes('0' * 64), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
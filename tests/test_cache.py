@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import context  # noqa: F401, puts the package on sys.path
+from indiecoin.blockchain.cache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """ Test the least recently used cache.
+    """
+    def test_evict_entries(self):
+        """ Test that the least recently used entry is evicted first.
+        """
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_evict_bytes(self):
+        """ Test that the byte budget is kept, and that values larger than
+            it are not cached.
+        """
+        cache = LRUCache(max_bytes=10, sizeof=len)
+        cache.put('a', 'x' * 6)
+        cache.put('b', 'x' * 6)
+
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 6)
+
+        cache.put('c', 'x' * 11)
+        self.assertNotIn('c', cache)
+        self.assertIn('b', cache)
+
+    def test_counters(self):
+        """ Test hit and miss counters and invalidation.
+        """
+        cache = LRUCache()
+        cache.put('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 0, 'bytes': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
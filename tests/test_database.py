@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 import unittest
+import logging
 import sqlite3
+import threading
+import time
 import os
 
 from context import indiecoin, GENESIS_BLOCK_HASH
+from indiecoin.blockchain import database, querystats
 # from indiecoin.blockchain.database import Database
 from indiecoin.util import default_data_directory
 
@@ -34,12 +38,302 @@ class DatabaseTestCase(unittest.TestCase):
     def test_tables_generated(self):
         """ Test that tables are dynamically generated the first time the program runs.
         """
-        sql = 'SELECT * FROM block WHERE hash = "{}";'.format(self.genesis_block)
+        sql = 'SELECT * FROM block WHERE hash = ?;'
         cursor = self.connection.cursor()
-        cursor.execute(sql)
+        cursor.execute(sql, (database.to_blob(self.genesis_block),))
         data = cursor.fetchall()
         self.assertEqual(len(data), 1)
 
+    def test_hashes_stored_as_bytes(self):
+        """ Test that hashes and keys are stored as raw bytes and read back as hex.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT typeof(hash), length(hash) FROM block')
+        self.assertEqual(cursor.fetchall(), [('blob', 32)])
+        cursor.execute('PRAGMA user_version')
+        self.assertEqual(cursor.fetchone()[0], database.SCHEMA_VERSION)
+
+        transactions = indiecoin.blockchain.transaction.Database(file_name=self.file_name)
+        genesis_transaction = transactions.get_block_transactions(self.genesis_block)[0]
+        self.assertEqual(genesis_transaction.block_hash, self.genesis_block)
+        self.assertEqual(len(genesis_transaction.tx_outputs[0].public_key_owner), 264)
+
+        with self.assertRaises(ValueError):
+            database.to_blob('not hex')
+
+    def test_schema_migrated(self):
+        """ Test that a database storing hashes as hex text is converted on start up.
+        """
+        database.get_connection_manager(self.path).close()
+        database._managers.clear()
+        self.connection.close()
+        os.remove(self.path)
+
+        self.connection = sqlite3.connect(self.path)
+        cursor = self.connection.cursor()
+
+        for table in database.DATABASE_DEFINITION:
+            fields = ', '.join(
+                '{} {}'.format(field['name'], 'TEXT' if field['type'] == database.HEX_TYPE else field['type'])
+                for field in table['fields'])
+            cursor.execute('CREATE TABLE {} ({})'.format(table['table_name'], fields))
+
+        cursor.execute(
+            'INSERT INTO block (hash, previous_block_hash, height, is_orphan, num_transactions) '
+            'VALUES (?, ?, 1, 0, 1)', (self.genesis_block, '0' * 64))
+        cursor.execute(
+            'INSERT INTO ic_transaction (id, hash, block_hash, num_inputs, num_outputs, is_coinbase, is_orphan) '
+            'VALUES (1, ?, ?, 0, 1, 1, 0)', ('ab' * 32, self.genesis_block))
+        cursor.execute(
+            'INSERT INTO transaction_output (id_transaction, public_key_owner, unspent, amount) '
+            'VALUES (1, ?, 1, 50.0)', ('cd' * 132,))
+        self.connection.commit()
+
+        size, migrated_size = database.migrate(file_name=self.file_name)
+        self.assertGreater(migrated_size, 0)
+
+        cursor.execute('SELECT typeof(hash), typeof(block_hash) FROM ic_transaction')
+        self.assertEqual(cursor.fetchall(), [('blob', 'blob')])
+        cursor.execute('SELECT typeof(amount) FROM transaction_output')
+        self.assertEqual(cursor.fetchall(), [('integer',)])
+        cursor.execute('SELECT name FROM sqlite_master WHERE type = "table" AND name LIKE "%_v1"')
+        self.assertEqual(cursor.fetchall(), [])
+
+        blocks = indiecoin.blockchain.block.Database(file_name=self.file_name)
+        self.assertEqual(blocks.get_block(self.genesis_block).transactions[0].hash, 'ab' * 32)
+        self.assertEqual(blocks.get_height(), 1)
+
+    def test_indexes_generated(self):
+        """ Test that lookups on block and transaction hashes use an index.
+        """
+        cursor = self.connection.cursor()
+
+        for table in ['block', 'ic_transaction']:
+            cursor.execute('EXPLAIN QUERY PLAN SELECT * FROM {} WHERE hash = ?'.format(table), ('',))
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIn('idx_{}_hash'.format(table), plan)
+
+    def test_indexes_migrated(self):
+        """ Test that a database created without indexes gets them on start up.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('DROP INDEX idx_block_height')
+        self.connection.commit()
+
+        database.get_connection_manager(self.path).close()
+        database._managers.clear()
+        indiecoin.blockchain.database.Database(file_name=self.file_name)
+
+        cursor.execute('SELECT name FROM sqlite_master WHERE type = "index" AND name = "idx_block_height"')
+        self.assertEqual(len(cursor.fetchall()), 1)
+
+    def test_unspent_outputs_rebuilt(self):
+        """ Test that an empty unspent output set is rebuilt on start up.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('DELETE FROM unspent_output')
+        self.connection.commit()
+
+        database.get_connection_manager(self.path).close()
+        database._managers.clear()
+        transactions = indiecoin.blockchain.transaction.Database(file_name=self.file_name)
+
+        genesis_transaction = transactions.get_block_transactions(self.genesis_block)[0]
+        output = transactions.get_output(genesis_transaction.hash, 0)
+        self.assertTrue(output.unspent)
+        self.assertEqual(output.amount, 50)
+
+    def test_query_parameters_not_injected(self):
+        """ Test that peer supplied values are bound, not formatted into sql.
+        """
+        blocks = indiecoin.blockchain.block.Database(file_name=self.file_name)
+
+        self.assertEqual(blocks.get_block('" OR hash != "'), None)
+        self.assertEqual(blocks.get_block(self.genesis_block).hash, self.genesis_block)
+
+    def test_storage_config_applied(self):
+        """ Test that the storage config pragmas are set on the connections.
+        """
+        manager = database.get_connection_manager(self.path)
+
+        with manager.reading() as connection:
+            self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 1)
+            self.assertEqual(connection.execute('PRAGMA query_only').fetchone()[0], 1)
+
+            with self.assertRaises(sqlite3.OperationalError):
+                connection.execute('DELETE FROM block')
+
+    def test_read_while_writing(self):
+        """ Test that a reader is not blocked by an open write transaction
+            and only sees committed data.
+        """
+        manager = database.get_connection_manager(self.path)
+        rows = []
+
+        def read():
+            with manager.reading() as connection:
+                rows.extend(connection.execute('SELECT * FROM block').fetchall())
+
+        with manager.transaction() as connection:
+            connection.execute('INSERT INTO block (hash, height, is_orphan) VALUES ("new", 2, 0)')
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+
+        self.assertEqual(len(rows), 1)
+
+    def test_read_only_config(self):
+        """ Test that a database opened read only can query but not write.
+        """
+        database.get_connection_manager(self.path).close()
+        database._managers.clear()
+
+        config = database.StorageConfig(read_only=True)
+        read_only = indiecoin.blockchain.block.Database(file_name=self.file_name, config=config)
+
+        try:
+            self.assertEqual(read_only.get_height(), 1)
+
+            with self.assertRaises(sqlite3.OperationalError):
+                with database.get_connection_manager(self.path).writing() as connection:
+                    connection.execute('DELETE FROM block')
+        finally:
+            database.get_connection_manager(self.path).close()
+            database._managers.clear()
+
+    def test_shared_connection_manager(self):
+        """ Test that database objects on the same file share one connection manager.
+        """
+        manager = database.get_connection_manager(self.path)
+        indiecoin.blockchain.block.Database(file_name=self.file_name)
+        indiecoin.blockchain.transaction.Database(file_name=self.file_name)
+
+        self.assertIs(database.get_connection_manager(self.path), manager)
+        self.assertTrue(manager.initialized)
+
+    def test_manager_reopened_after_file_removed(self):
+        """ Test that removing the database file gives a new, initialized manager.
+        """
+        manager = database.get_connection_manager(self.path)
+        os.remove(self.path)
+
+        indiecoin.blockchain.database.Database(file_name=self.file_name)
+        new_manager = database.get_connection_manager(self.path)
+
+        self.assertIsNot(new_manager, manager)
+        self.assertTrue(new_manager.initialized)
+
+    def test_read_connection_per_thread(self):
+        """ Test that each thread reads through its own connection.
+        """
+        manager = database.get_connection_manager(self.path)
+        connections = []
+        done = threading.Event()
+
+        def read():
+            with manager.reading() as connection:
+                connections.append(connection)
+            done.wait()
+
+        threads = [threading.Thread(target=read) for i in range(3)]
+        [thread.start() for thread in threads]
+
+        while len(connections) < 3:
+            time.sleep(0.01)
+
+        done.set()
+        [thread.join() for thread in threads]
+
+        self.assertEqual(len(set(id(connection) for connection in connections)), 3)
+        self.assertNotIn(manager.writer, connections)
+
+    def test_read_pool_stress(self):
+        """ Test that many short lived threads reading at once, while a
+            write transaction is open, share a bounded pool of connections.
+        """
+        manager = database.ConnectionManager(self.path, max_readers=4)
+        heights = []
+        errors = []
+        start = threading.Event()
+
+        def read():
+            start.wait()
+
+            try:
+                for i in range(20):
+                    with manager.reading() as connection:
+                        heights.append(connection.execute('SELECT MAX(height) FROM block').fetchone()[0])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                manager.release()
+
+        try:
+            with database.get_connection_manager(self.path).transaction() as connection:
+                connection.execute('INSERT INTO block (hash, height, is_orphan) VALUES ("new", 2, 0)')
+
+                for batch in range(4):
+                    threads = [threading.Thread(target=read) for i in range(8)]
+                    [thread.start() for thread in threads]
+                    start.set()
+                    [thread.join(10) for thread in threads]
+                    start.clear()
+                    self.assertFalse(any(thread.is_alive() for thread in threads))
+
+            stats = manager.pool_stats()
+        finally:
+            manager.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(heights, [1] * 4 * 8 * 20)
+        self.assertLessEqual(stats['opened'], 4)
+        self.assertEqual(stats['owned'] + stats['idle'], stats['opened'])
+
+    def test_query_stats(self):
+        """ Test that the statements run are counted with their latency and
+            that the plan of a statement can be explained.
+        """
+        blocks = indiecoin.blockchain.block.Database(file_name=self.file_name)
+        database.get_connection_manager(self.path).query_stats.reset()
+
+        for i in range(3):
+            blocks.transactions.get_block_transactions(self.genesis_block)
+
+        stats = blocks.query_stats()
+        sql = 'SELECT * FROM ic_transaction WHERE block_hash = ? ORDER BY id'
+
+        self.assertEqual(stats[sql]['count'], 3)
+        self.assertEqual(stats[sql]['rows'], 3)
+        self.assertGreaterEqual(stats[sql]['p99_ms'], stats[sql]['p50_ms'])
+        self.assertIn(sql, querystats.format_stats(stats))
+
+        plan = database.explain_query_plan(self.path, sql, (database.to_blob(self.genesis_block),))
+        self.assertIn('idx_ic_transaction_block_hash', ' '.join(plan))
+
+    def test_slow_query_logged(self):
+        """ Test that a statement slower than slow_query_ms is logged with
+            its plan.
+        """
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        database.logger.addHandler(handler)
+
+        database._managers.clear()
+        config = database.StorageConfig(slow_query_ms=0)
+
+        try:
+            blocks = indiecoin.blockchain.block.Database(file_name=self.file_name, config=config)
+            blocks.transactions.get_block_transactions(self.genesis_block)
+        finally:
+            database.logger.removeHandler(handler)
+            database._managers.clear()
+
+        messages = [record.getMessage() for record in records]
+        self.assertTrue(any('idx_ic_transaction_block_hash' in message for message in messages))
+
 
 if __name__ == '__main__':
     unittest.main()
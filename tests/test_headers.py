@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from context import indiecoin
+from indiecoin.blockchain.headers import BlockHeader, HeaderIndex, pack_header, unpack_header
+
+
+class HeaderIndexTestCase(unittest.TestCase):
+    """ Test the in memory index of block headers.
+    """
+    def setUp(self):
+        """ Builds a chain of three headers.
+        """
+        self.headers = [
+            BlockHeader(
+                hash=str(height) * 64,
+                previous_block_hash=str(height - 1) * 64,
+                height=str(height),
+                timestamp='',
+                nonce='')
+            for height in range(1, 4)]
+
+    def test_tip(self):
+        """ Test that the tip follows the highest header added.
+        """
+        index = HeaderIndex()
+        self.assertIsNone(index.height)
+
+        for header in reversed(self.headers):
+            index.add(header)
+
+        self.assertEqual(index.height, 3)
+        self.assertEqual(index.tip.hash, '3' * 64)
+        self.assertEqual(index.get_hash(2), '2' * 64)
+        self.assertEqual(len(index), 3)
+
+    def test_ancestors(self):
+        """ Test walking from a header back to the first one.
+        """
+        index = HeaderIndex(self.headers)
+
+        self.assertEqual(
+            [header.height for header in index.ancestors('3' * 64)], [3, 2, 1])
+        self.assertEqual(list(index.ancestors('unknown')), [])
+
+
+class HeaderLayoutTestCase(unittest.TestCase):
+    """ Test the fixed layout of block headers.
+    """
+    def test_pack_header(self):
+        """ Test that headers are 80 bytes read back as they were packed.
+        """
+        header = pack_header('1' * 64, '2' * 64, '1490477410.5', 21, 7)
+
+        self.assertEqual(len(header), 80)
+        self.assertEqual(unpack_header(header), {
+            'previous_block_hash': '1' * 64,
+            'hash_merkle_root': '2' * 64,
+            'timestamp': 1490477410,
+            'difficulty': 21,
+            'nonce': 7,
+        })
+        self.assertEqual(pack_header('1' * 64, '2' * 64, '', '', ''), pack_header('1' * 64, '2' * 64, 0, 0, 0))
+
+        with self.assertRaises(ValueError):
+            pack_header('1' * 62, '2' * 64, '', '', '')
+
+        with self.assertRaises(ValueError):
+            pack_header('1' * 64, '2' * 64, '', '', 2 ** 32)
+
+        with self.assertRaises(ValueError):
+            unpack_header(header[:-1])
+
+    def test_merkle_root(self):
+        """ Test the merkle root of odd and even numbers of hashes.
+        """
+        merkle_root = indiecoin.util.hash.merkle_root
+        hashes = [str(i) * 64 for i in range(3)]
+
+        self.assertEqual(merkle_root(hashes[:1]), hashes[0])
+        self.assertEqual(merkle_root(hashes), merkle_root(hashes + hashes[2:]))
+        self.assertNotEqual(merkle_root(hashes), merkle_root(list(reversed(hashes))))
+        self.assertEqual(merkle_root([]), '0' * 64)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+
+from context import indiecoin
+from context import GENESIS_BLOCK_HASH, PUBLIC_KEY_GENESIS, PRIVATE_KEY_GENESIS
+from indiecoin.blockchain import addressindex, block, prune
+from indiecoin.util import default_data_directory
+
+
+class PruneTestCase(unittest.TestCase):
+    """ Test pruning the bodies of old blocks.
+    """
+    def setUp(self):
+        """ Create database object with different file_name. Creates the data
+            of a block spending the genesis output.
+        """
+        self.file_name = 'test_database'
+        self.path = os.path.join(default_data_directory(), self.file_name)
+        self.database = block.Database(file_name=self.file_name)
+        self.transaction = self.database.get_block(GENESIS_BLOCK_HASH).transactions[0]
+        address = indiecoin.wallet.address.Address(private_key=PRIVATE_KEY_GENESIS)
+
+        transaction_data = {
+            'hash': '',
+            'block_hash': '',
+            'num_inputs': 1,
+            'num_outputs': 2,
+            'timestamp': '1490477410',
+            'is_coinbase': 0,
+            'is_orphan': 0,
+            'tx_inputs': [{
+                'signature': address.sign(self.transaction.hash),
+                'hash_transaction': self.transaction.hash,
+                'prev_out_index': 0,
+                'database': self.database.transactions,
+            }],
+            'tx_outputs': [
+                {'amount': 25, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1},
+                {'amount': 25, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1},
+            ],
+            'database': self.database.transactions,
+        }
+
+        coin_base_transaction_data = {
+            'hash': '',
+            'block_hash': '',
+            'num_inputs': 0,
+            'num_outputs': 1,
+            'timestamp': '1490477419',
+            'is_coinbase': 1,
+            'is_orphan': 0,
+            'tx_inputs': [],
+            'tx_outputs': [{'amount': 5, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1}],
+            'database': self.database.transactions,
+        }
+
+        self.block_data = {
+            'hash': '',
+            'timestamp': '',
+            'nonce': '',
+            'num_transactions': 2,
+            'is_orphan': 0,
+            'previous_block_hash': GENESIS_BLOCK_HASH,
+            'height': 2,
+            'transactions': [transaction_data, coin_base_transaction_data],
+            'database': self.database,
+        }
+
+    def tearDown(self):
+        """ Destroy database.
+        """
+        os.system('rm {}'.format(self.path))
+
+    def test_prune(self):
+        """ Test that pruning drops the spent history of old blocks and keeps
+            their headers and the unspent outputs.
+        """
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+        spending = new_block.transactions[0]
+
+        indiecoin.blockchain.database._managers.clear()
+        config = indiecoin.blockchain.database.StorageConfig(prune_blocks=1)
+        pruner = prune.Database(file_name=self.file_name, config=config)
+        blockchain = indiecoin.blockchain.BlockChain(database=pruner.blocks)
+
+        self.assertEqual(pruner.prune(), 0)
+
+        min_prune_depth = prune.MIN_PRUNE_DEPTH
+        prune.MIN_PRUNE_DEPTH = 1
+        try:
+            self.assertEqual(pruner.prune(), 1)
+            self.assertEqual(pruner.prune(), 0)
+        finally:
+            prune.MIN_PRUNE_DEPTH = min_prune_depth
+
+        self.assertTrue(blockchain.is_pruned(GENESIS_BLOCK_HASH))
+        self.assertFalse(blockchain.is_pruned(new_block.hash))
+        self.assertIsNone(blockchain.get_block(GENESIS_BLOCK_HASH))
+        self.assertIsNone(blockchain.get_block_bytes(GENESIS_BLOCK_HASH))
+        self.assertIsNone(blockchain.get_transaction(self.transaction.hash))
+        self.assertEqual(blockchain.get_block_header(GENESIS_BLOCK_HASH).height, 1)
+        self.assertEqual(blockchain.get_height(), 2)
+
+        self.assertEqual(len(blockchain.get_block(new_block.hash).transactions), 2)
+        self.assertEqual(pruner.blocks.transactions.get_output(spending.hash, 1).amount, 25)
+
+        indiecoin.blockchain.database._managers.clear()
+        reloaded = block.Database(file_name=self.file_name)
+        self.assertEqual(reloaded.headers.pruned_height, 1)
+        self.assertTrue(reloaded.is_pruned(GENESIS_BLOCK_HASH))
+
+        with self.assertRaises(ValueError):
+            addressindex.Database(file_name=self.file_name).rebuild()
+
+        indiecoin.blockchain.database._managers.clear()
+        config = indiecoin.blockchain.database.StorageConfig(address_index=True)
+        addresses = addressindex.Database(file_name=self.file_name, config=config)
+
+        with self.assertRaises(ValueError):
+            addresses.get_balance(PUBLIC_KEY_GENESIS)
+
+    def test_writes_recorded(self):
+        """ Test that the statements spending outputs and pruning blocks
+            are counted in the query stats.
+        """
+        indiecoin.blockchain.database.get_connection_manager(self.path).query_stats.reset()
+        block.Block(**self.block_data).save()
+
+        stats = self.database.query_stats()
+        self.assertEqual(stats['DELETE FROM unspent_output WHERE hash_transaction = ? AND out_index = ?']['rows'], 1)
+
+        indiecoin.blockchain.database._managers.clear()
+        config = indiecoin.blockchain.database.StorageConfig(prune_blocks=1)
+        pruner = prune.Database(file_name=self.file_name, config=config)
+
+        min_prune_depth = prune.MIN_PRUNE_DEPTH
+        prune.MIN_PRUNE_DEPTH = 1
+        try:
+            self.assertEqual(pruner.prune(), 1)
+        finally:
+            prune.MIN_PRUNE_DEPTH = min_prune_depth
+
+        stats = pruner.query_stats()
+        self.assertEqual(stats['DELETE FROM ic_transaction WHERE id = ?']['rows'], 1)
+        self.assertEqual(stats['INSERT OR REPLACE INTO chain_state (name, value) VALUES (?, ?)']['count'], 1)
+
+    def test_parse_target(self):
+        """ Test parsing the value of --prune, blocks or megabytes.
+        """
+        self.assertEqual(prune.parse_target('1000'), (1000, None))
+        self.assertEqual(prune.parse_target('2MB'), (None, 2 * 1024 * 1024))
+
+        with self.assertRaises(ValueError):
+            prune.parse_target('2GB')
+
+        with self.assertRaises(ValueError):
+            prune.parse_target(str(prune.MIN_PRUNE_DEPTH - 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
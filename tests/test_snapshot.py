@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import unittest
+import io
+import os
+
+from context import indiecoin
+from context import GENESIS_BLOCK_HASH, PUBLIC_KEY_GENESIS, PRIVATE_KEY_GENESIS
+from indiecoin.blockchain import block, snapshot
+from indiecoin.util import default_data_directory
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """ Test exporting and importing snapshots of the chain.
+    """
+    def setUp(self):
+        """ Create database object with different file_name. Creates the data
+            of a block spending the genesis output.
+        """
+        self.file_name = 'test_database'
+        self.path = os.path.join(default_data_directory(), self.file_name)
+        self.database = block.Database(file_name=self.file_name)
+        self.transaction = self.database.get_block(GENESIS_BLOCK_HASH).transactions[0]
+        address = indiecoin.wallet.address.Address(private_key=PRIVATE_KEY_GENESIS)
+
+        transaction_data = {
+            'hash': '',
+            'block_hash': '',
+            'num_inputs': 1,
+            'num_outputs': 2,
+            'timestamp': '1490477410',
+            'is_coinbase': 0,
+            'is_orphan': 0,
+            'tx_inputs': [{
+                'signature': address.sign(self.transaction.hash),
+                'hash_transaction': self.transaction.hash,
+                'prev_out_index': 0,
+                'database': self.database.transactions,
+            }],
+            'tx_outputs': [
+                {'amount': 25, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1},
+                {'amount': 25, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1},
+            ],
+            'database': self.database.transactions,
+        }
+
+        coin_base_transaction_data = {
+            'hash': '',
+            'block_hash': '',
+            'num_inputs': 0,
+            'num_outputs': 1,
+            'timestamp': '1490477419',
+            'is_coinbase': 1,
+            'is_orphan': 0,
+            'tx_inputs': [],
+            'tx_outputs': [{'amount': 5, 'public_key_owner': PUBLIC_KEY_GENESIS, 'unspent': 1}],
+            'database': self.database.transactions,
+        }
+
+        self.block_data = {
+            'hash': '',
+            'timestamp': '',
+            'nonce': '',
+            'num_transactions': 2,
+            'is_orphan': 0,
+            'previous_block_hash': GENESIS_BLOCK_HASH,
+            'height': 2,
+            'transactions': [transaction_data, coin_base_transaction_data],
+            'database': self.database,
+        }
+
+    def tearDown(self):
+        """ Destroy database.
+        """
+        os.system('rm {}'.format(self.path))
+
+    def test_snapshot(self):
+        """ Test that a snapshot imported into a new database gives the same
+            chain and unspent outputs, and that a corrupt one is refused.
+        """
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+        spending = new_block.transactions[0]
+
+        stream = io.BytesIO()
+        self.assertEqual(snapshot.Database(file_name=self.file_name).export_snapshot(stream), 2)
+
+        file_name = 'test_database_snapshot'
+        path = os.path.join(default_data_directory(), file_name)
+
+        try:
+            imported = snapshot.Database(file_name=file_name)
+            corrupt = stream.getvalue()[:-1] + chr(ord(stream.getvalue()[-1]) ^ 1)
+
+            with self.assertRaises(ValueError):
+                imported.import_snapshot(io.BytesIO(corrupt))
+
+            reader = snapshot.SnapshotReader(io.BytesIO(stream.getvalue()))
+            tampered = io.BytesIO()
+            writer = snapshot.SnapshotWriter(tampered, reader.height)
+
+            for record_type, fields in reader.records():
+                if record_type == snapshot.RECORD_HEADER:
+                    block_hash, header = fields
+                    nonce = header[-1] if block_hash.encode('hex') == GENESIS_BLOCK_HASH else chr(ord(header[-1]) ^ 1)
+                    writer.write_header(block_hash, header[:-1] + nonce)
+                else:
+                    writer.write_output(*fields)
+            writer.close()
+
+            with self.assertRaisesRegexp(ValueError, 'does not match its hash'):
+                imported.import_snapshot(io.BytesIO(tampered.getvalue()))
+
+            self.assertEqual(imported.blocks.get_height(), 1)
+            self.assertEqual(imported.import_snapshot(io.BytesIO(stream.getvalue())), (2, 3))
+
+            with self.assertRaises(ValueError):
+                imported.import_snapshot(io.BytesIO(stream.getvalue()))
+
+            indiecoin.blockchain.database._managers.clear()
+            blocks = block.Database(file_name=file_name)
+            self.assertEqual(blocks.get_height(), 2)
+            self.assertEqual(blocks.get_block_hash(2), new_block.hash)
+            self.assertTrue(blocks.is_pruned(new_block.hash))
+            self.assertEqual(blocks.transactions.get_output(spending.hash, 1).amount, 25)
+            self.assertIsNone(blocks.transactions.get_output(self.transaction.hash, 0))
+        finally:
+            indiecoin.blockchain.database.get_connection_manager(path).close()
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
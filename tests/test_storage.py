@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+
+from context import indiecoin
+from context import GENESIS_BLOCK_HASH, PUBLIC_KEY_GENESIS, PRIVATE_KEY_GENESIS
+from indiecoin.blockchain import block, storage
+from indiecoin.util import default_data_directory
+
+
+class MemoryStorageTestCase(unittest.TestCase):
+    """ Test the in memory storage backend.
+    """
+    def setUp(self):
+        """ Creates a memory storage and block data spending the genesis output.
+        """
+        self.storage = storage.MemoryStorage()
+        genesis = self.storage.get_block(GENESIS_BLOCK_HASH)
+        self.transaction = genesis.transactions[0]
+        address = indiecoin.wallet.address.Address(private_key=PRIVATE_KEY_GENESIS)
+
+        transaction_data = {
+            'hash': '',
+            'block_hash': '',
+            'num_inputs': 1,
+            'num_outputs': 1,
+            'timestamp': '1490477410',
+            'is_coinbase': 0,
+            'is_orphan': 0,
+            'tx_inputs': [{
+                'signature': address.sign(self.transaction.hash),
+                'hash_transaction': self.transaction.hash,
+                'prev_out_index': 0,
+                'database': self.storage,
+            }],
+            'tx_outputs': [{
+                'amount': 50,
+                'public_key_owner': PUBLIC_KEY_GENESIS,
+                'unspent': 1,
+            }],
+            'database': self.storage,
+        }
+
+        self.block_data = {
+            'hash': '',
+            'timestamp': '',
+            'nonce': '',
+            'num_transactions': 1,
+            'is_orphan': 0,
+            'previous_block_hash': GENESIS_BLOCK_HASH,
+            'height': 2,
+            'transactions': [transaction_data],
+            'database': self.storage,
+        }
+
+    def test_genesis_loaded(self):
+        """ Test that a new memory storage starts with the genesis block.
+        """
+        self.assertEqual(self.storage.get_height(), 1)
+        self.assertEqual(self.storage.get_block_height(1).hash, GENESIS_BLOCK_HASH)
+        self.assertTrue(self.storage.get_output(self.transaction.hash, 0).unspent)
+        self.assertIsNone(self.storage.get_block_height('not a height'))
+
+    def test_save_block(self):
+        """ Test saving a block spends its inputs and makes it queryable.
+        """
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+
+        self.assertEqual(self.storage.get_height(), 2)
+        self.assertEqual(self.storage.get_block(new_block.hash).hash, new_block.hash)
+        self.assertFalse(self.storage.get_output(self.transaction.hash, 0).unspent)
+        self.assertFalse(self.storage.get_transaction(self.transaction.hash).tx_outputs[0].unspent)
+
+        spending = new_block.transactions[0]
+        self.assertTrue(self.storage.is_spent_by(self.transaction.hash, 0, spending.hash))
+        self.assertTrue(self.storage.get_output(spending.hash, 0).unspent)
+
+    def test_double_spend_rolled_back(self):
+        """ Test that a batch spending the same output twice leaves the
+            storage untouched.
+        """
+        first_block = block.Block(**self.block_data)
+        self.block_data['timestamp'] = '1'
+        second_block = block.Block(**self.block_data)
+
+        with self.assertRaises(AssertionError):
+            self.storage.save_blocks([first_block, second_block])
+
+        self.assertEqual(self.storage.get_height(), 1)
+        self.assertIsNone(self.storage.get_block(first_block.hash))
+        self.assertTrue(self.storage.get_output(self.transaction.hash, 0).unspent)
+        self.assertTrue(self.storage.get_transaction(self.transaction.hash).tx_outputs[0].unspent)
+
+    def test_transaction_rolled_back(self):
+        """ Test that a block saved in a transaction that rolls back leaves
+            the outputs it spent unspent.
+        """
+        new_block = block.Block(**self.block_data)
+
+        with self.assertRaises(RuntimeError):
+            with self.storage.transaction():
+                self.storage.save_block(new_block)
+                raise RuntimeError('Rolled back')
+
+        self.assertIsNone(self.storage.get_block(new_block.hash))
+        self.assertTrue(self.storage.get_output(self.transaction.hash, 0).unspent)
+        self.assertTrue(self.storage.get_transaction(self.transaction.hash).tx_outputs[0].unspent)
+
+    def test_iter_blocks(self):
+        """ Test iterating over the blocks of a memory storage.
+        """
+        new_block = block.Block(**self.block_data)
+        new_block.save()
+
+        self.assertEqual([b.hash for b in self.storage.iter_blocks()], [GENESIS_BLOCK_HASH, new_block.hash])
+        self.assertEqual([h.height for h in self.storage.iter_blocks(2, headers_only=True)], [2])
+
+    def test_blockchain_over_memory(self):
+        """ Test that BlockChain queries a memory storage.
+        """
+        blockchain = indiecoin.blockchain.BlockChain(database=self.storage)
+
+        self.assertEqual(blockchain.get_height(), 1)
+        self.assertEqual(blockchain.get_transaction(self.transaction.hash).hash, self.transaction.hash)
+
+    def test_configure_backend(self):
+        """ Test that the configured backend is the default storage.
+        """
+        try:
+            storage.configure(storage.BACKEND_MEMORY)
+            self.assertIs(storage.default_storage(), storage.default_storage())
+            self.assertIsInstance(storage.default_storage(), storage.MemoryStorage)
+        finally:
+            storage.configure(storage.BACKEND_SQLITE)
+
+        self.assertIsInstance(storage.default_storage(), storage.SqliteStorage)
+        self.assertIs(storage.default_storage(), storage.default_storage())
+
+        with self.assertRaises(ValueError):
+            storage.configure('postgres')
+
+
+class SqliteStorageTestCase(unittest.TestCase):
+    """ Test the sqlite storage backend.
+    """
+    def setUp(self):
+        self.file_name = 'test_database'
+        self.path = os.path.join(default_data_directory(), self.file_name)
+
+    def tearDown(self):
+        """ Destroy database.
+        """
+        os.system('rm {}'.format(self.path))
+
+    def test_sqlite_storage(self):
+        """ Test that a sqlite storage and a wrapped block.Database read
+            the same chain.
+        """
+        sqlite_storage = storage.SqliteStorage(file_name=self.file_name)
+        blockchain = indiecoin.blockchain.BlockChain(
+            database=block.Database(file_name=self.file_name))
+
+        self.assertEqual(sqlite_storage.get_height(), blockchain.get_height())
+        self.assertEqual(sqlite_storage.get_block(GENESIS_BLOCK_HASH).hash, GENESIS_BLOCK_HASH)
+        self.assertEqual(
+            blockchain.get_block_height(1).transactions[0].hash,
+            sqlite_storage.get_block_transactions(GENESIS_BLOCK_HASH)[0].hash)
+
+    def test_stale_after_removed(self):
+        """ Test that a sqlite storage is stale once its file is removed.
+        """
+        sqlite_storage = storage.SqliteStorage(file_name=self.file_name)
+        self.assertFalse(sqlite_storage.is_stale())
+
+        os.remove(self.path)
+        self.assertTrue(sqlite_storage.is_stale())
+        self.assertFalse(storage.SqliteStorage(file_name=self.file_name).is_stale())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -64,6 +64,27 @@ class TransactionInputTestCase(unittest.TestCase):
         self.assertEqual(self.transaction.hash, tx_input.hash_transaction)
         self.assertEqual(tx_input.amount, 50)
 
+    def test_prev_out_looked_up_lazily(self):
+        """ Test that the referenced output is only read when it is needed,
+            and only once.
+        """
+        lookups = []
+        get_output = self.database.get_output
+
+        def counted_get_output(hash_transaction, out_index):
+            lookups.append((hash_transaction, out_index))
+            return get_output(hash_transaction, out_index)
+
+        self.database.get_output = counted_get_output
+        tx_input = transaction.TransactionInput(**self.tx_input_data)
+        self.assertEqual(lookups, [])
+
+        self.assertEqual(tx_input.amount, 50)
+        self.assertTrue(tx_input.unspent)
+        self.assertTrue(tx_input.validate_signature())
+        self.assertEqual(lookups, [(self.transaction.hash, 0)])
+        self.assertNotIn('__prev_out_loaded', tx_input.serialize())
+
     def test_create_from_json_string(self):
         """ Create an TransactionInput object from a string JSON.
         """
@@ -183,6 +204,74 @@ class TransactionTestCase(unittest.TestCase):
         except AssertionError as e:
             self.assertEqual(e[0], 'Transaction not valid')
 
+    def test_from_storage_not_validated(self):
+        """ Test that a transaction built from storage skips validation.
+        """
+        change = self.transaction_data['tx_inputs'][0]['signature'].replace('1', '2')
+        self.transaction_data['tx_inputs'][0]['signature'] = change
+        self.transaction_data['hash'] = 'a' * 64
+
+        trans = transaction.Transaction.from_storage(**self.transaction_data)
+
+        self.assertEqual(trans.hash, 'a' * 64)
+        self.assertFalse(trans.is_valid())
+
+    def test_hash_must_match_encoding(self):
+        """ Test that a transaction given a hash other than the one of its
+            binary encoding is not valid.
+        """
+        trans = transaction.Transaction(**self.transaction_data)
+
+        with self.assertRaises(AssertionError):
+            transaction.Transaction(**dict(self.transaction_data, hash='a' * 64))
+
+        self.assertTrue(transaction.Transaction(**dict(self.transaction_data, hash=trans.hash)).is_valid())
+
+    def test_bytes_round_trip(self):
+        """ Test that the binary encoding decodes to the same transaction
+            and that its hash does not depend on types or local state.
+        """
+        trans = transaction.Transaction(**self.transaction_data)
+        data = trans.to_bytes()
+        decoded = transaction.Transaction.from_bytes(data, database=self.database)
+
+        self.assertEqual(decoded.hash, trans.hash)
+        self.assertEqual(decoded.to_bytes(), data)
+        self.assertEqual(decoded.tx_inputs[0].signature, trans.tx_inputs[0].signature)
+        self.assertEqual(decoded.tx_outputs[1].amount, 25)
+
+        local = transaction.Transaction.from_storage(**dict(
+            self.transaction_data, timestamp=int(trans.timestamp), is_orphan=1,
+            tx_outputs=[dict(tx_out, unspent=0) for tx_out in self.transaction_outputs]))
+        self.assertEqual(local.valid_hash(), decoded.hash)
+
+        with self.assertRaises(ValueError):
+            transaction.Transaction.from_bytes(data[:-1], database=self.database)
+
+        with self.assertRaises(ValueError):
+            transaction.Transaction.from_bytes(data + '\x00', database=self.database)
+
+    def test_memoized(self):
+        """ Test that the encoding, hash and JSON are computed once and
+            that the setters only drop the JSON.
+        """
+        trans = transaction.Transaction(**self.transaction_data)
+        data = trans.to_bytes()
+        text = trans.to_json()
+
+        self.assertIs(trans.to_bytes(), data)
+        self.assertIs(trans.to_json(), text)
+        self.assertEqual(json.loads(text), json.loads(json.dumps(trans.serialize())))
+
+        trans.set_block_hash(GENESIS_BLOCK_HASH)
+        self.assertEqual(json.loads(trans.to_json())['block_hash'], GENESIS_BLOCK_HASH)
+
+        trans.set_output_spent(1)
+        self.assertFalse(json.loads(trans.to_json())['tx_outputs'][1]['unspent'])
+        self.assertIs(trans.to_bytes(), data)
+        self.assertEqual(trans.valid_hash(), trans.hash)
+        self.assertNotIn('__json', trans.serialize())
+
     def test_save_database(self):
         """ Test saving a transaction object to database.
         """
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+
+from context import indiecoin
+from context import GENESIS_BLOCK_HASH, PUBLIC_KEY_GENESIS, PRIVATE_KEY_GENESIS
+from indiecoin.blockchain import block, storage, writer
+from indiecoin.util import default_data_directory
+
+
+class ChainWriterTestCase(unittest.TestCase):
+    """ Test the single writer of the chain state.
+    """
+    def setUp(self):
+        """ Creates a database and the data of a block spending the genesis output.
+        """
+        self.file_name = 'test_database'
+        self.path = os.path.join(default_data_directory(), self.file_name)
+        self.database = block.Database(file_name=self.file_name)
+        self.storage = storage.SqliteStorage(blocks=self.database)
+        self.transaction = self.database.get_block(GENESIS_BLOCK_HASH).transactions[0]
+        address = indiecoin.wallet.address.Address(private_key=PRIVATE_KEY_GENESIS)
+
+        self.transaction_data = {
+            'hash': '',
+            'block_hash': '',
+            'num_inputs': 1,
+            'num_outputs': 1,
+            'timestamp': '1490477410',
+            'is_coinbase': 0,
+            'is_orphan': 0,
+            'tx_inputs': [{
+                'signature': address.sign(self.transaction.hash),
+                'hash_transaction': self.transaction.hash,
+                'prev_out_index': 0,
+            }],
+            'tx_outputs': [{
+                'amount': 50,
+                'public_key_owner': PUBLIC_KEY_GENESIS,
+                'unspent': 1,
+            }],
+        }
+
+    def tearDown(self):
+        """ Destroy database.
+        """
+        os.system('rm {}'.format(self.path))
+
+    def save_block(self, timestamp):
+        """ Writer job building and saving a block at height 2.
+        """
+        new_block = block.Block(
+            hash='', timestamp=timestamp, nonce='', num_transactions=1, is_orphan=0,
+            previous_block_hash=GENESIS_BLOCK_HASH, height=2,
+            transactions=[dict(self.transaction_data, timestamp=timestamp, database=self.storage)],
+            database=self.database)
+        new_block.save()
+        return new_block
+
+    def test_group_commit(self):
+        """ Test that jobs submitted together are committed together and a
+            competing block fails on its own.
+        """
+        chain_writer = writer.ChainWriter(storage=self.storage, window=0.5)
+        callbacks = []
+
+        def job(value):
+            chain_writer.after_commit(lambda: callbacks.append(value))
+            return value
+
+        futures = [chain_writer.submit(job, 1), chain_writer.submit(self.save_block, '1'),
+                   chain_writer.submit(self.save_block, '2'), chain_writer.submit(job, 2)]
+
+        self.assertEqual(futures[0].result(), 1)
+        self.assertEqual(futures[1].result().timestamp, '1')
+        self.assertEqual(futures[3].result(), 2)
+
+        with self.assertRaises(AssertionError):
+            futures[2].result()
+
+        chain_writer.close()
+
+        self.assertEqual(callbacks, [1, 2])
+        self.assertEqual(chain_writer.jobs, 3)
+        self.assertEqual(self.database.get_height(), 2)
+        self.assertEqual(self.database.get_block_height(2).hash, futures[1].result().hash)
+        self.assertFalse(self.database.transactions.get_output(self.transaction.hash, 0).unspent)
+
+    def test_memory_storage(self):
+        """ Test that a failing group leaves a memory storage untouched
+            before its jobs run again one by one.
+        """
+        memory = storage.MemoryStorage()
+        chain_writer = writer.ChainWriter(storage=memory, window=0.5)
+        self.database = memory
+        self.storage = memory
+
+        first = chain_writer.submit(self.save_block, '1')
+        second = chain_writer.submit(self.save_block, '2')
+
+        first_block = first.result()
+        self.assertEqual(memory.get_block_height(2).hash, first_block.hash)
+
+        with self.assertRaises(AssertionError):
+            second.result()
+
+        chain_writer.close()
+        self.assertEqual(chain_writer.commits, 1)
+        self.assertEqual(memory.get_height(), 2)
+
+    def test_replay_safe_jobs(self):
+        """ Test that iterators are refused as job arguments and that a
+            storage that can not be reached fails jobs, not the writer.
+        """
+        class Unreachable(object):
+            def transaction(self):
+                raise IOError('Storage unreachable')
+
+        chain_writer = writer.ChainWriter(storage=Unreachable())
+
+        with self.assertRaises(TypeError):
+            chain_writer.submit(list, (i for i in range(2)))
+
+        with self.assertRaises(IOError):
+            chain_writer.submit(list, [1]).result(1)
+
+        chain_writer.storage = self.storage
+        self.assertEqual(chain_writer.submit(list, [1]).result(1), [1])
+        chain_writer.close()
+
+    def test_callback_errors(self):
+        """ Test that a failing after_commit callback fails the future of
+            the job that registered it, not the other jobs of its group.
+        """
+        chain_writer = writer.ChainWriter(storage=self.storage, window=0.5)
+
+        def job(value):
+            chain_writer.after_commit(lambda: 1 / value)
+            return value
+
+        futures = [chain_writer.submit(job, 1), chain_writer.submit(job, 0), chain_writer.submit(job, 2)]
+
+        self.assertEqual(futures[0].result(1), 1)
+        self.assertEqual(futures[2].result(1), 2)
+
+        with self.assertRaises(ZeroDivisionError):
+            futures[1].result(1)
+
+        self.assertEqual(chain_writer.commits, 1)
+        chain_writer.close()
+
+    def test_writer_death(self):
+        """ Test that pending and later jobs fail once the writer thread
+            dies instead of waiting forever.
+        """
+        chain_writer = writer.ChainWriter(storage=self.storage, window=0.5)
+
+        def die():
+            raise SystemExit()
+
+        futures = [chain_writer.submit(list, [1]), chain_writer.submit(die)]
+
+        for future in futures + [chain_writer.submit(list, [2])]:
+            with self.assertRaises(SystemExit):
+                future.result(1)
+
+        chain_writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()